@@ -0,0 +1,179 @@
+'''adh_bench.py - end-to-end benchmarks of analyze and recommend against adh_mockarm
+
+For every estate size, a mock ARM server and the measured client each run in their own
+process, so the client's peak RSS is not mixed with the server's. Reported per estate:
+
+    crawl       wall time of analyze (DedicateHostCache.build_cache) with --workers requests in flight,
+                paced by the client-side rate governor (settings.ARM_READ_RATE, or --read-rate)
+    requests    ARM calls made by the crawl, and how many of them were throttled (429)
+    peak RSS    peak resident memory of the client process after the crawl and the recommends
+    recommend   latency percentiles of adh_mng.recommend_vm_placement (lock, snapshot load, find)
+    warm        latency percentiles of find_host on the in-memory cache (serve mode)
+
+    python adh_bench.py --hosts 10 100 1000 10000 --latency 0.02 --throttle 0.01
+'''
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from settings import get_crawl_workers
+
+BENCH_SIZES = (10, 100, 1000, 10000)
+RECOMMEND_SIZES = ('Standard_D2s_v3', 'Standard_D8s_v3', 'Standard_E4s_v3', 'Standard_E16s_v3')
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    '''Nearest-rank percentiles of a list of samples, {point: value}.'''
+    ordered = sorted(samples)
+    if not ordered:
+        return {point: None for point in points}
+    return {point: ordered[min(len(ordered) - 1, max(0, -(-point * len(ordered) // 100) - 1))] for point in points}
+
+
+def peak_rss():
+    '''Peak resident set size of this process in bytes, or None if it can not be measured.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_mock(hosts, options, ready):
+    '''Process target: serve a MockEstate of hosts until terminated; sends the endpoint to ready.'''
+    from adh_mockarm import MockARMServer, MockEstate
+    server = MockARMServer(MockEstate(hosts), **options)
+    ready.send(server.endpoint)
+    server.serve_forever()
+
+
+def run_client(endpoint, subscription_id, workers, recommends, seed, read_rate, results):
+    '''Process target: crawl the mock estate, then time recommendations; sends the metrics to results.'''
+    os.environ['AZURE_RM_ENDPOINT'] = endpoint
+    # every crawl is measured cold, without revalidating responses cached by an earlier run
+    os.environ['ADH_RESPONSE_CACHE'] = ''
+    logging.disable(logging.CRITICAL)
+    import adh_mng
+    from adh_cache import DedicateHostCache
+    from restfns import RateGovernor, get_session, set_rate_governor
+
+    if read_rate:
+        set_rate_governor(RateGovernor(read_rate=read_rate, read_burst=max(1, int(read_rate * 2))))
+
+    get_session().delete(endpoint + '/mockarm/stats')
+    local_cache = DedicateHostCache()
+    start = time.perf_counter()
+    returnObj = local_cache.build_cache('mock-token', subscription_id, None, None, None, workers)
+    crawl_time = time.perf_counter() - start
+    stats = get_session().get(endpoint + '/mockarm/stats').json()
+    if returnObj.code != 0:
+        results.send({'error': returnObj.message})
+        return
+
+    rand = random.Random(seed)
+    locations = sorted(set(dhg.location for dhg in local_cache.host_group_list.values())) or ['eastus']
+    queries = [(rand.choice(locations), rand.choice(RECOMMEND_SIZES)) for i in range(recommends)]
+    warm = []
+    for location, vm_size in queries:
+        start = time.perf_counter()
+        local_cache.find_host(location, None, None, vm_size)
+        warm.append(time.perf_counter() - start)
+
+    cold = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        adh_mng.save_cache(local_cache)
+        for location, vm_size in queries:
+            start = time.perf_counter()
+            adh_mng.recommend_vm_placement('mock-token', subscription_id, location, None, None, vm_size,
+                                           None, None)
+            cold.append(time.perf_counter() - start)
+
+    results.send({'hosts': sum(len(dhg.host_list) for dhg in local_cache.host_group_list.values()),
+                  'crawl_seconds': crawl_time, 'requests': stats['requests'], 'throttled': stats['throttled'],
+                  'peak_rss': peak_rss(), 'recommend': percentiles(cold), 'warm': percentiles(warm)})
+
+
+def bench_estate(hosts, workers, recommends, mock_options, seed=0, read_rate=None):
+    '''Benchmark one estate size; returns the metrics dictionary of run_client.'''
+    from adh_mockarm import MOCK_SUBSCRIPTION
+    context = multiprocessing.get_context('spawn')
+    mock_end, ready = context.Pipe(False)
+    mock = context.Process(target=run_mock, args=(hosts, mock_options, ready), daemon=True)
+    mock.start()
+    try:
+        endpoint = mock_end.recv()
+        client_end, results = context.Pipe(False)
+        client = context.Process(target=run_client,
+                                 args=(endpoint, MOCK_SUBSCRIPTION, workers, recommends, seed, read_rate, results))
+        client.start()
+        metrics = client_end.recv()
+        client.join()
+        return metrics
+    finally:
+        mock.terminate()
+        mock.join()
+
+
+def format_report(rows):
+    '''Render the benchmark rows as a text table.'''
+    def ms(seconds, scale=1000):
+        return '-' if seconds is None else '{:.2f}'.format(seconds * scale)
+
+    lines = ['{:>7} {:>9} {:>9} {:>9} {:>9}   {:>23}   {:>23}'.format(
+        'hosts', 'crawl s', 'requests', 'throttled', 'RSS MB', 'recommend p50/95/99 ms', 'warm p50/95/99 us')]
+    for row in rows:
+        if 'error' in row:
+            lines.append('{:>7} error: {}'.format(row.get('estate', ''), row['error']))
+            continue
+        rss = '-' if row['peak_rss'] is None else '{:.1f}'.format(row['peak_rss'] / 1048576.0)
+        lines.append('{:>7} {:>9.2f} {:>9} {:>9} {:>9}   {:>23}   {:>23}'.format(
+            row['hosts'], row['crawl_seconds'], row['requests'], row['throttled'], rss,
+            '/'.join(ms(row['recommend'][point]) for point in (50, 95, 99)),
+            '/'.join(ms(row['warm'][point], 1000000) for point in (50, 95, 99))))
+    return '\n'.join(lines)
+
+
+def main():
+    '''Run the benchmarks and print a table (or JSON).'''
+    arg_parser = argparse.ArgumentParser(prog='adh_bench')
+    arg_parser.add_argument('--hosts', type=int, nargs='+', default=list(BENCH_SIZES), help='estate sizes')
+    arg_parser.add_argument('--workers', '-w', type=int, default=get_crawl_workers(), help='crawl workers')
+    arg_parser.add_argument('--recommends', type=int, default=200, help='recommendations timed per estate')
+    arg_parser.add_argument('--page-size', type=int, default=100, help='items per page of list calls')
+    arg_parser.add_argument('--latency', type=float, default=0.02, help='seconds the mock adds to every call')
+    arg_parser.add_argument('--throttle', type=float, default=0.0, help='fraction of calls answered 429')
+    arg_parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of throttled calls')
+    arg_parser.add_argument('--read-rate', type=float, default=None,
+                            help='reads per second allowed by the client rate governor (default see settings)')
+    arg_parser.add_argument('--json', action='store_true', default=False, help='print JSON instead of a table')
+    args = arg_parser.parse_args()
+
+    mock_options = {'page_size': args.page_size, 'latency': args.latency, 'throttle': args.throttle,
+                    'retry_after': args.retry_after}
+    rows = []
+    for hosts in args.hosts:
+        row = bench_estate(hosts, args.workers, args.recommends, mock_options, read_rate=args.read_rate)
+        row['estate'] = hosts
+        rows.append(row)
+        if not args.json:
+            sys.stderr.write('{} hosts done\n'.format(hosts))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print(format_report(rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,67 @@
 '''dh_crud.py - basic dedicated hosts operations'''
 import json
 import sys
+import threading
+import time
+from array import array
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from adh_return import *
 from adh_crp import *
+from restfns import RestError, check_response
+from adh_index import PlacementIndex
+from adh_capacity import CapacityView
+from adh_skus import SKUS, VM_SIZES, find_vm_size_ordinal, vm_size_ordinal
+from adh_placement import HostState, get_strategy, plan_batch
+from settings import get_delta_sync_overlap, get_delta_sync_window
 
 import logging
 
-log_format = " %(asctime)s [%(levelname)s] %(message)s"
 logger = logging.getLogger('example')
-logging.basicConfig(format=log_format, level=logging.DEBUG)
-
-class SKUS:
-    vm_skus = {"Standard_D2s_v3":{"cpu_count":2,"hyper_threading":2,"mem_size":8}, \
-        "Standard_D4s_v3":{"cpu_count":4,"hyper_threading":2,"mem_size":16}, \
-        "Standard_D8s_v3":{"cpu_count":8,"hyper_threading":2,"mem_size":32}, \
-        "Standard_D16s_v3":{"cpu_count":16,"hyper_threading":2,"mem_size":64}, \
-        "Standard_D32s_v3":{"cpu_count":32,"hyper_threading":2,"mem_size":128}, \
-        "Standard_D48s_v3":{"cpu_count":48,"hyper_threading":2,"mem_size":192}, \
-        "Standard_D64s_v3":{"cpu_count":64,"hyper_threading":2,"mem_size":256}, \
-        "Standard_E2s_v3":{"cpu_count":2,"hyper_threading":2,"mem_size":16}, \
-        "Standard_E4s_v3":{"cpu_count":4,"hyper_threading":2,"mem_size":32}, \
-        "Standard_E8s_v3":{"cpu_count":8,"hyper_threading":2,"mem_size":64}, \
-        "Standard_E16s_v3":{"cpu_count":16,"hyper_threading":2,"mem_size":128}, \
-        "Standard_E32s_v3":{"cpu_count":32,"hyper_threading":2,"mem_size":256}, \
-        "Standard_E48s_v3":{"cpu_count":48,"hyper_threading":2,"mem_size":384}, \
-        "Standard_E64s_v3":{"cpu_count":64,"hyper_threading":2,"mem_size":432} \
-             }
-    host_skus = {"DSv3-Type1":{"core_count":64,"mem_size":440}, \
-                 "DSv3-Type2":{"core_count":64,"mem_size":640},
-                 "ESv3-Type1":{"core_count":64,"mem_size":440},
-                 "FSv2-Type2":{"core_count":72,"mem_size":440}, }
-
-    host_sku_to_vm_skus = {"DSv3-Type1":{"Standard_D2s_v3","Standard_D4s_v3","Standard_D8s_v3", \
-        "Standard_D16s_v3","Standard_D32s_v3","Standard_D64s_v3"}, \
-        "DSv3-Type2":{"Standard_D2s_v3","Standard_D4s_v3","Standard_D8s_v3", \
-        "Standard_D16s_v3","Standard_D32s_v3","Standard_D48s_v3","Standard_D64s_v3"} , \
-        "ESv3-Type1":{"Standard_E2s_v3","Standard_E4s_v3","Standard_E8s_v3", \
-        "Standard_E16s_v3","Standard_E32s_v3","Standard_E48s_v3","Standard_E64s_v3"} , \
-        "ESv3-Type2":{"Standard_E2s_v3","Standard_E4s_v3","Standard_E8s_v3", \
-        "Standard_E16s_v3","Standard_E32s_v3","Standard_E64s_v3"},
-        "FSv2-Type2":{"Standard_F2s_v2","Standard_F4s_v2","Standard_F8s_v2", \
-        "Standard_F16s_v2","Standard_F32s_v2","Standard_F64s_v2"} } 
-    
-    def host_sku_for_vm_size (self,vm_size):
-        for host_sku,vm_sizes in self.host_sku_to_vm_skus.items():
-           if vm_size in vm_sizes:
-               return host_sku
-        return None
 
-class VM:
+# error codes of a GET on a resource (or parent resource) that does not exist
+NOT_FOUND_CODES = ('NotFound', 'ResourceNotFound', 'ParentResourceNotFound')
+
+class Compact:
+    '''Pickle support for the __slots__ classes of the cache.
+
+    Also loads the __dict__ state of objects pickled before the classes had __slots__;
+    attributes that no longer exist are dropped, missing ones keep their defaults.
+    '''
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (__dict__ state, __slots__ state) of the default object pickling
+            state = dict(state[0] or {}, **(state[1] or {}))
+        self.__init__()
+        for name, value in state.items():
+            if name in self.__slots__:
+                setattr(self, name, value)
+
+
+class VM(Compact):
+    __slots__ = ('name', 'id', 'size')
+    hyper_threading_ratio = 1
+
     def __init__(self):            
         self.name = ""
         self.id = ""
         self.size = ""
-        # calculated host attributes
-        self.core_count = 0
-        self.mem_size = 0 
-        self.hyper_threading_ratio = 1
+
+    @property
+    def core_count(self):
+        vm_sku = SKUS.vm_skus.get(self.size)
+        return vm_sku["cpu_count"] if vm_sku else 0
+
+    @property
+    def mem_size(self):
+        vm_sku = SKUS.vm_skus.get(self.size)
+        return vm_sku["mem_size"] if vm_sku else 0
 
     def init (self,vm_obj):
         print ("TBD")
@@ -68,15 +72,86 @@ class VM:
                 curr_vm (str): VM Object representation
         '''
         self.name = curr_vm['name']
-        self.id = curr_vm['id']
-        self.size = curr_vm['properties']['hardwareProfile']['vmSize']
-        # calculated host attributes
-        self.core_count = 0
-        self.mem_size = 0 
-        self.hyper_threading_ratio = 1
+        # the id stays the upper-cased, interned key of the host's vm_list
+        if not self.id:
+            self.id = sys.intern(curr_vm['id'].upper())
+        self.size = sys.intern(curr_vm['properties']['hardwareProfile']['vmSize'])
         
 
-class Host:
+class AllocatableVMs(MutableMapping):
+    '''Allocatable VM counts of a host, keyed by VM size.
+
+    The counts are held in a fixed-width array indexed by the ordinal of the size in
+    adh_skus.VM_SIZES; -1 marks a size the host does not offer.
+    '''
+    __slots__ = ('counts',)
+
+    def __init__(self, counts=None):
+        self.counts = array('i')
+        if counts:
+            self.update(counts)
+
+    def __getitem__(self, vm_size):
+        ordinal = find_vm_size_ordinal(vm_size)
+        if ordinal is None or ordinal >= len(self.counts) or self.counts[ordinal] < 0:
+            raise KeyError(vm_size)
+        return self.counts[ordinal]
+
+    def get(self, vm_size, default=None):
+        ordinal = find_vm_size_ordinal(vm_size)
+        if ordinal is None or ordinal >= len(self.counts) or self.counts[ordinal] < 0:
+            return default
+        return self.counts[ordinal]
+
+    def __contains__(self, vm_size):
+        ordinal = find_vm_size_ordinal(vm_size)
+        return ordinal is not None and ordinal < len(self.counts) and self.counts[ordinal] >= 0
+
+    def __setitem__(self, vm_size, count):
+        ordinal = vm_size_ordinal(vm_size)
+        if ordinal >= len(self.counts):
+            self.counts.extend([-1] * (ordinal + 1 - len(self.counts)))
+        self.counts[ordinal] = count
+
+    def __delitem__(self, vm_size):
+        if vm_size not in self:
+            raise KeyError(vm_size)
+        self.counts[find_vm_size_ordinal(vm_size)] = -1
+
+    def __iter__(self):
+        for ordinal, count in enumerate(self.counts):
+            if count >= 0:
+                yield VM_SIZES[ordinal]
+
+    def __len__(self):
+        return sum(1 for count in self.counts if count >= 0)
+
+    def items(self):
+        return [(VM_SIZES[ordinal], count) for ordinal, count in enumerate(self.counts) if count >= 0]
+
+    def copy(self):
+        allocatable = AllocatableVMs()
+        allocatable.counts = array('i', self.counts)
+        return allocatable
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __reduce__(self):
+        # by size name: ordinals are only valid within one process
+        return (AllocatableVMs, (dict(self.items()),))
+
+    def __repr__(self):
+        return 'AllocatableVMs({!r})'.format(dict(self.items()))
+
+
+class Host(Compact):
+    __slots__ = ('name', 'group_name', 'location', 'id', 'sku', 'vm_list', 'fault_domain', 'subscription_id',
+                 'resource_group', 'allocatableVMs', 'placed_vms', 'base_allocatableVMs', 'total_cores',
+                 'total_mem', 'utilized_cores', 'utilized_mem', 'available_cores', 'available_mem')
+
     def __init__(self):            
         self.name = ""
         self.group_name = ""
@@ -87,7 +162,10 @@ class Host:
         self.fault_domain = ""
         self.subscription_id =""
         self.resource_group=""
-        self.allocatableVMs ={}
+        self.allocatableVMs = AllocatableVMs()
+        # VMs placed on the host since its instance view was read (see consume)
+        self.placed_vms = None
+        self.base_allocatableVMs = None
 
         # calculated host attributes
         self.total_cores = 0
@@ -96,6 +174,13 @@ class Host:
         self.utilized_mem = 0 
         self.available_cores = 0
         self.available_mem =0
+
+    def __setstate__(self, state):
+        Compact.__setstate__(self, state)
+        if not isinstance(self.allocatableVMs, AllocatableVMs):
+            self.allocatableVMs = AllocatableVMs(self.allocatableVMs)
+        if self.base_allocatableVMs is not None and not isinstance(self.base_allocatableVMs, AllocatableVMs):
+            self.base_allocatableVMs = AllocatableVMs(self.base_allocatableVMs)
     
     def calculate_utilization(self):
         '''Calculate the utilization of the host. Fill in the host size and then iterate all hosted VMs to calculate utilization. 
@@ -109,16 +194,11 @@ class Host:
         
         for vm_name, vm in self.vm_list.items():
             if vm.size:
-                vm.core_count = SKUS.vm_skus[vm.size]["cpu_count"]
-                self.utilized_cores += vm.core_count
-                vm.mem_size = SKUS.vm_skus[vm.size]["mem_size"]
-                self.utilized_mem += vm.mem_size
+                self.utilized_cores += SKUS.vm_skus[vm.size]["cpu_count"]
+                self.utilized_mem += SKUS.vm_skus[vm.size]["mem_size"]
         
         self.available_cores=self.total_cores - self.utilized_cores
         self.available_mem = self.total_mem - self.utilized_mem
-        
-        logger.debug ("DedicatedHost: %s, group %s, %s, FD: %s ,%d VMs, Utilization(used/total): Cores %d / %d; Mem %d / %d", \
-            self.name,self.group_name, self.sku, self.fault_domain, len(self.vm_list), self.utilized_cores, self.total_cores,self.utilized_mem, self.total_mem)
     
     def rank_allocation_OLD(self,vm_size):
         vm_size_list = SKUS.host_sku_to_vm_skus[self.sku]
@@ -132,44 +212,113 @@ class Host:
             return 0.0
         return  max (req_cores/self.available_cores , req_mem/self.available_mem)        
 
-    def rank_allocation(self,vm_size):
-        vm_size_list = SKUS.host_sku_to_vm_skus[self.sku]
+    def rank_allocation(self,vm_size, strategy=None):
+        '''Rank the host for a VM of vm_size: 0 if it does not fit, higher is better.
+            Args:
+                vm_size (str): The size of the VM we wish to place
+                strategy (str): Placement strategy, see adh_placement (optional, default: most allocatable slots)
+        '''
+        if strategy is not None:
+            return get_strategy(strategy).rank(self, vm_size)
         # First, check if the VM size is even supported            
         if vm_size in self.allocatableVMs:
            return self.allocatableVMs[vm_size]
         return 0
         
 
-   
+    def consume (self, vm_size, count=1):
+        '''Take count VMs of vm_size off the allocatable VM counts of the host.
+
+        The counts of every other size shrink by the cores/memory the new VMs use, measured
+        against the counts of the last instance view, so placing many small VMs one at a time
+        does not over-count the capacity lost for larger sizes.
+            Args:
+                vm_size (str): The size of the placed VMs
+                count (int): Number of VMs placed (negative to give slots back)
+        '''
+        if self.base_allocatableVMs is None:
+            self.base_allocatableVMs = self.allocatableVMs.copy()
+            self.placed_vms = {}
+        self.placed_vms[vm_size] = max(0, self.placed_vms.get(vm_size, 0) + count)
+        placed_cores = 0
+        placed_mem = 0
+        for placed_size, placed_count in self.placed_vms.items():
+            if placed_size in SKUS.vm_skus:
+                placed_cores += SKUS.vm_skus[placed_size]["cpu_count"] * placed_count
+                placed_mem += SKUS.vm_skus[placed_size]["mem_size"] * placed_count
+        for size, base_count in self.base_allocatableVMs.items():
+            if size in SKUS.vm_skus:
+                used = max(-(-placed_cores // SKUS.vm_skus[size]["cpu_count"]),
+                           -(-placed_mem // SKUS.vm_skus[size]["mem_size"]))
+            else:
+                used = self.placed_vms.get(size, 0)
+            self.allocatableVMs[size] = max(0, base_count - used)
+
     def populate_host (self, curr_host, dhg_name,subscription_id, access_token):
         '''Populate a dedicated host with host object including VM IDs
             Args:
                 curr_host (str): Dedicated Host JSON object 
         '''
-        self.subscription_id = subscription_id
+        self.load_host(curr_host, dhg_name, subscription_id)
+        self.fetch_instance_view(access_token)
+
+    def load_host (self, curr_host, dhg_name, subscription_id):
+        '''Fill the host attributes and VM IDs from a host JSON object, without any REST call
+            Args:
+                curr_host (str): Dedicated Host JSON object 
+                dhg_name (str): Name of the host group the host belongs to
+                subscription_id (str): Azure subscription id.
+        '''
+        # names shared by many hosts and VMs are interned, so the cache holds one copy of each
+        self.subscription_id = sys.intern(subscription_id)
         self.name = curr_host['name']
-        self.sku = curr_host['sku']['name']
-        self.location = curr_host['location']
+        self.sku = sys.intern(curr_host['sku']['name'])
+        self.location = sys.intern(curr_host['location'])
         self.id = curr_host['id']
         resource_id = self.id.split("/")
-        self.resource_group =(resource_id[4])
+        self.resource_group = sys.intern(resource_id[4])
 
-        self.group_name = dhg_name
+        self.group_name = sys.intern(dhg_name)
         if 'faultDomain' in curr_host['properties']:
             self.fault_domain = curr_host['properties']['faultDomain']
         for curr_vm in curr_host['properties']['virtualMachines']:
             vm = VM()
-            vm.id = curr_vm['id'].upper()
+            vm.id = sys.intern(curr_vm['id'].upper())
             self.vm_list[vm.id]=vm
             # logger.debug ("populate a VM %s",vm.id)
+
+    def has_changed (self, curr_host):
+        '''Return True if a freshly listed host JSON object differs in SKU or VMs from this host.'''
+        if curr_host['sku']['name'] != self.sku:
+            return True
+        vm_ids = curr_host['properties']['virtualMachines']
+        if len(vm_ids) != len(self.vm_list):
+            return True
+        for curr_vm in vm_ids:
+            if curr_vm['id'].upper() not in self.vm_list:
+                return True
+        return False
+
+    def fetch_instance_view (self, access_token):
+        '''GET the host instance view and fill in the allocatable VM counts
+            Args:
+                access_token (str): A valid Azure authentication token.
+        '''
         host_instance_view = get_dh(access_token, self.subscription_id, self.resource_group,self.group_name, self.name)
+        check_response(self.id, host_instance_view)
+        self.load_instance_view(host_instance_view)
+
+    def load_instance_view (self, host_instance_view):
+        '''Fill in the allocatable VM counts from a host JSON object expanded with its instance view.'''
         for allocable_sku in host_instance_view['properties']['instanceView']['availableCapacity']['allocatableVMs']:
             self.allocatableVMs[allocable_sku['vmSize']]=int(allocable_sku['count'])
 
     def init(self,host_obj):
         print ("TBD")
 
-class HostGroup:
+class HostGroup(Compact):
+    __slots__ = ('id', 'resource_group', 'name', 'location', 'az', 'subscription_id', 'host_list')
+
     def __init__(self):            
         self.id =""
         self.resource_group = ""
@@ -180,7 +329,22 @@ class HostGroup:
         self.host_list = {}
 
     def populate_host_group(self, dhg,access_token, subscription_id,resource_group):
+        '''Populate the host group and all of its hosts.
+            Args:
+                dhg (str): Dedicated Host Group JSON object
+                access_token (str): A valid Azure authentication token.
+                subscription_id (str): Azure subscription id.
+                resource_group (str): Azure resource group name.
+        '''
         # logger.debug ("HostGroup:populate_cache")
+        hosts_json = self.list_hosts(dhg, access_token, subscription_id)
+        self.populate_hosts(hosts_json, access_token, subscription_id)
+
+    def list_hosts(self, dhg, access_token, subscription_id):
+        '''Fill the host group attributes and list its hosts.
+            Returns:
+                HTTP response. JSON body of the list of dedicated hosts properties.
+        '''
         self.name = dhg['name']
         self.location = dhg['location']
         self.subscription_id = subscription_id
@@ -192,8 +356,14 @@ class HostGroup:
         self.resource_group =(resource_id[4])
         # hosts_json = azurerm.list_dh(access_token, subscription_id,self.resource_group,dhg['name'])    
         hosts_json = list_dh(access_token, subscription_id,self.resource_group,dhg['name'])    
+        check_response(self.id, hosts_json)
             
         logger.debug ("HostGroup:%s, Location %s, AZ %s,  %s with %d hosts", self.name, self.location, self.az,self.id, len(hosts_json['value']))
+        return hosts_json
+
+    def populate_hosts(self, hosts_json, access_token, subscription_id):
+        '''Create a Host for every listed host and fetch its instance view.
+        '''
         for curr_host in hosts_json['value']:
             dh = Host()
             dh.populate_host (curr_host, self.name, subscription_id,access_token)
@@ -206,57 +376,672 @@ class HostGroup:
 class DedicateHostCache:
     def __init__(self):            
         self.host_group_list = {}
+        self.placement_index = None
+        # per subscription, time the last crawl or sync of the whole subscription started;
+        # sync_cache reads the changes made since then
+        self.synced = {}
+
+    def merge (self, other):
+        '''Add the host groups and sync times of another cache, e.g. one crawled for another subscription.'''
+        self.host_group_list.update(other.host_group_list)
+        self.synced.update(other.synced)
+        self.placement_index = None
+
+    def build_index (self):
+        '''(Re)build the placement index from the host groups in the cache.'''
+        self.placement_index = PlacementIndex()
+        for host_group_id, host_group in self.host_group_list.items():
+            for host_id, host in host_group.host_list.items():
+                self.placement_index.add(host_group, host)
+        return self.placement_index
 
-    def populate_host_groups (self, dhgList,access_token, subscription_id, resource_group):
+    def get_placement_index (self):
+        '''Return the placement index, building it on first use (e.g. after loading a snapshot).'''
+        if getattr(self, 'placement_index', None) is None:
+            self.build_index()
+        return self.placement_index
+
+    def capacity_view (self, use_numpy=None):
+        '''Return a CapacityView (see adh_capacity) of the hosts in the cache, for utilization and
+        capacity questions over many hosts at once.'''
+        return CapacityView(self, use_numpy)
+
+    def find_host (self, location, zone, faultDomain, vm_size, resource_group=None, host_group=None, strategy=None):
+        '''Find the best host for a VM size.
+
+            The placement index lists the hosts of the location/zone/FD/size by allocatable count,
+            so with the default strategy the first host that passes the group filters is the best
+            one. Other strategies rank every listed host.
+
+            Returns:
+                (HostGroup, Host) of the best ranked host matching the filters, or None.
+        '''
+        best = None
+        best_rank = 0
+        skipped = 0
+        ranked = 0
+        for host_grp, host, host_ranking in self.get_placement_index().candidates(location, zone, faultDomain, vm_size):
+            if host_group and (host_group.lower() != host_grp.name.lower()):
+                skipped += 1
+                continue
+            if (resource_group and host_grp.resource_group.lower() != resource_group.lower()):
+                skipped += 1
+                continue
+            if strategy is None:
+                best = (host_grp, host)
+                break
+            ranked += 1
+            host_ranking = host.rank_allocation(vm_size, strategy)
+            if host_ranking > best_rank:
+                best = (host_grp, host)
+                best_rank = host_ranking
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug ("adh_cache: find_host %s in %s: %d hosts filtered out by group, %d ranked, best %s",
+                          vm_size, location, skipped, ranked, best[1].name if best else None)
+        return best
+
+    def place_vm (self, location, zone, faultDomain, vm_size, resource_group=None, host_group=None, strategy=None):
+        '''Find the best host for a VM size and take the slot off its allocatable VM counts.
+
+            Returns:
+                (HostGroup, Host) the VM was placed on, or None.
+        '''
+        found = self.find_host(location, zone, faultDomain, vm_size, resource_group, host_group, strategy)
+        if found is not None:
+            found[1].consume(vm_size)
+            self.placement_index.update(found[1])
+        return found
+
+    def plan_placement (self, vm_requests, location, resource_group=None, host_group=None, strategy=None):
+        '''Plan the placement of a batch of VMs, updating the allocatable VM counts as it goes.
+
+            Args:
+                vm_requests (list): Dictionaries with 'size', 'count' (default 1) and optional 'zone'
+                    and 'faultdomain'
+                location (str): Azure region. E.g. westus.
+                resource_group (str): Limit to host groups in this resource group (optional)
+                host_group (str): Limit to this host group (optional)
+                strategy (str): Placement strategy, see adh_placement (optional, default: most allocatable slots)
+
+            Returns:
+                A dictionary with the 'placements' (host id, size, count) and the 'overflow' that did
+                not fit, with the host SKU and number of new hosts it would need.
+        '''
+        host_states = []
+        for host_grp_id, host_grp in self.host_group_list.items():
+            if location and host_grp.location.lower() != location.lower():
+                continue
+            if host_group and (host_group.lower() != host_grp.name.lower()):
+                continue
+            if (resource_group and host_grp.resource_group.lower() != resource_group.lower()):
+                continue
+            for host_id, host in host_grp.host_list.items():
+                host_states.append(HostState(host, host_grp, len(host_states)))
+        plan = plan_batch(host_states, vm_requests, strategy)
+        if getattr(self, 'placement_index', None) is not None:
+            for placement in plan['placements']:
+                self.placement_index.update(self.placement_index.hosts[placement['host']][1])
+        return plan
+
+    def add_host (self, host_json):
+        '''Add a host to its host group and the placement index, e.g. one that was just created.
+
+            Args:
+                host_json (dict): Dedicated host JSON object expanded with its instance view
+
+            Returns:
+                (HostGroup, Host), or None if the host group is not in the cache.
+        '''
+        group_id = host_json['id'].upper().rsplit('/HOSTS/', 1)[0]
+        for host_grp_id, host_grp in self.host_group_list.items():
+            if host_grp.id.upper() == group_id:
+                break
+        else:
+            return None
+        dh = Host()
+        dh.load_host (host_json, host_grp.name, host_grp.subscription_id)
+        dh.load_instance_view (host_json)
+        if dh.sku in SKUS.host_skus:
+            dh.calculate_utilization()
+        host_grp.host_list[dh.name] = dh
+        self.get_placement_index().add(host_grp, dh)
+        return host_grp, dh
+
+    def populate_host_groups (self, dhgList,access_token, subscription_id, resource_group, max_workers=None):
+        '''Populate all host groups in the list.
+            Args:
+                dhgList (str): JSON body of the list of dedicated host groups, or an iterator of
+                    host group JSON objects (e.g. iter_dhg_sub) which is consumed as pages arrive
+                access_token (str): A valid Azure authentication token.
+                subscription_id (str): Azure subscription id.
+                resource_group (str): Azure resource group name.
+                max_workers (int): Crawl groups and hosts with this many parallel requests (optional, serial if not set)
+        '''
         # logger.debug ("DedicateHosthost_groups:populate_cache")
-        
-        for curr_dhg in dhgList['value']:
-            logger.debug("Iterating DHG "+curr_dhg['name'])
-            dhg = HostGroup()
-            dhg.populate_host_group(curr_dhg,access_token, subscription_id,resource_group)
-            self.host_group_list[curr_dhg['id']] = dhg
+        if isinstance(dhgList, dict):
+            dhgList = dhgList['value']
+        if not max_workers or max_workers <= 1:
+            for curr_dhg in dhgList:
+                dhg = HostGroup()
+                dhg.populate_host_group(curr_dhg,access_token, subscription_id,resource_group)
+                self.host_group_list[curr_dhg['id']] = dhg
+            return
+
+        for dhg in self.crawl_host_groups(dhgList, access_token, subscription_id, max_workers)[0]:
+            self.host_group_list[dhg.id] = dhg
+
+    def crawl_host_groups (self, dhgList, access_token, subscription_id, max_workers=None, previous=None):
+        '''List the hosts of every group and fetch the host instance views.
+
+            Args:
+                dhgList: Iterator of host group JSON objects
+                access_token (str): A valid Azure authentication token.
+                subscription_id (str): Azure subscription id.
+                max_workers (int): Number of parallel requests (optional, serial if not set)
+                previous (dict): Host groups of an earlier crawl, keyed by id (optional). Hosts whose
+                    SKU and VM list did not change are reused without fetching their instance view.
+
+            Returns:
+                The list of crawled HostGroup objects in listing order, and a dictionary with
+                the number of new, changed and unchanged hosts.
+        '''
+        stats = {'new': 0, 'changed': 0, 'unchanged': 0}
+        if max_workers and max_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            executor = InlineExecutor()
+        # Two stages on one bounded pool: list the hosts of every group, then fetch all
+        # host instance views. Neither stage waits on work queued behind it, so the
+        # pool can not deadlock whatever its size.
+        try:
+            groups = []
+            for curr_dhg in dhgList:
+                dhg = HostGroup()
+                groups.append((dhg, executor.submit(dhg.list_hosts, curr_dhg, access_token, subscription_id)))
+            host_futures = []
+            for dhg, hosts_future in groups:
+                hosts_json = hosts_future.result()
+                previous_group = previous.get(dhg.id) if previous else None
+                for curr_host in hosts_json['value']:
+                    previous_host = previous_group.host_list.get(curr_host['name']) if previous_group else None
+                    if previous_host is not None and not previous_host.has_changed(curr_host):
+                        stats['unchanged'] += 1
+                        host_futures.append((dhg, previous_host, None))
+                        continue
+                    stats['changed' if previous_host is not None else 'new'] += 1
+                    dh = Host()
+                    dh.load_host (curr_host, dhg.name, subscription_id)
+                    host_futures.append((dhg, dh, executor.submit(dh.fetch_instance_view, access_token)))
+            for dhg, dh, future in host_futures:
+                if future is not None:
+                    future.result()
+                dhg.host_list[dh.name]= dh
+        finally:
+            # on error, drop the queued requests instead of finishing the crawl
+            executor.shutdown(wait=True, cancel_futures=True)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug ("adh_cache: crawled %d host groups, %d hosts (%d new, %d changed, %d unchanged)",
+                          len(groups), len(host_futures), stats['new'], stats['changed'], stats['unchanged'])
+        return [dhg for dhg, hosts_future in groups], stats
 
-    def update_vm_info (self,vm_list):
+    def update_vm_info (self,vm_list, only_unsized=False):
+            '''Fill in VM details and recalculate the utilization of every host.
+                Args:
+                    vm_list: Dictionary of (name, size) keyed by upper-cased VM id (see
+                        collect_hosted_vms), or an iterator of VM JSON objects (e.g. iter_vms_sub)
+                        which is joined page by page against the hosted VMs
+                    only_unsized (bool): Only fill in VMs without a size (optional)
+            '''
             # logger.debug ("DedicateHosthost_groups:update_vm_info")
-            for host_group_id, host_group in self.host_group_list.items():
-                for host_id, host in host_group.host_list.items():
-                    for vm_id, vm in host.vm_list.items():
-                        if vm_id in vm_list:
-                            vm.populate_vm (vm_list[vm_id])
-                    host.calculate_utilization()
-                        
-    def build_cache (self,access_token, subscription_id,location, resource_group, host_group):
+            missing = 0
+            unknown = set()
+            if isinstance(vm_list, dict):
+                for host_group_id, host_group in self.host_group_list.items():
+                    for host_id, host in host_group.host_list.items():
+                        for vm_id, vm in host.vm_list.items():
+                            if only_unsized and vm.size:
+                                continue
+                            curr_vm = vm_list.get(vm_id)
+                            if curr_vm is not None:
+                                vm.name, vm.size = curr_vm
+                                if vm.size not in SKUS.vm_skus:
+                                    unknown.add(vm.size)
+                            else:
+                                missing += 1
+            else:
+                # hash index of the hosted VMs, built once; the listing is joined against it
+                hosted_vms = {}
+                for host_group_id, host_group in self.host_group_list.items():
+                    for host_id, host in host_group.host_list.items():
+                        hosted_vms.update(host.vm_list)
+                for curr_vm in vm_list:
+                    vm = hosted_vms.pop(curr_vm['id'].upper(), None)
+                    if vm is not None and not (only_unsized and vm.size):
+                        vm.populate_vm (curr_vm)
+                        if vm.size not in SKUS.vm_skus:
+                            unknown.add(vm.size)
+                missing = len(hosted_vms)
+            if missing:
+                logger.info ("adh_cache: %d hosted VMs were not in the VM listing", missing)
+            unknown.discard("")
+            if unknown:
+                logger.warning ("adh_cache: VM sizes missing from the SKU catalog count as 0 cores and memory: %s",
+                                ', '.join(sorted(unknown)))
+            self.capacity_view().apply_utilization()
+            self.log_utilization()
+
+    def log_utilization (self):
+        '''Log the totals of the host utilization in one debug line (nothing when debug is off).'''
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        hosts = vms = used_cores = total_cores = used_mem = total_mem = 0
+        for host_group_id, host_group in self.host_group_list.items():
+            for host_id, host in host_group.host_list.items():
+                hosts += 1
+                vms += len(host.vm_list)
+                used_cores += host.utilized_cores
+                total_cores += host.total_cores
+                used_mem += host.utilized_mem
+                total_mem += host.total_mem
+        logger.debug ("adh_cache: %d groups, %d hosts, %d VMs, Utilization(used/total): Cores %d / %d; Mem %d / %d",
+                      len(self.host_group_list), hosts, vms, used_cores, total_cores, used_mem, total_mem)
+
+    def build_cache (self,access_token, subscription_id,location, resource_group, host_group, max_workers=None,
+                     vm_info=True):
         '''Analyze a Dedicated Host Group.
 
+        With vm_info, the VMs of the subscription are listed once (paged, alongside the host
+        crawl) and joined to the hosts by id to fill in the VM sizes and the host utilization.
+
         Args:
             access_token (str): A valid Azure authentication token.
             subscription_id (str): Azure subscription id.
             resource_group (str): Azure resource group name.
             location (str): Azure region. E.g. westus.
             host_group (str): A specific dedicated host group to analyze (optional)
+            max_workers (int): Number of parallel requests for the crawl (optional, serial if not set)
+            vm_info (bool): Fill in the VM sizes and host utilization (optional, default True)
 
         Returns:
             Object representation of the dedicated host group.
         '''
         logger.debug ("adh_cache: build_cache")
-        if not resource_group:
-            dhg_list = list_dhg_sub(access_token, subscription_id)
-            #NO-VM vm_list = list_vms_sub(access_token,subscription_id)
-        elif resource_group  and not host_group:
-            dhg_list = list_dhg(access_token, subscription_id,resource_group)
-            #NO-VM vm_list = list_vms(access_token,subscription_id,resource_group)
-        else:
+        started = time.time()
+        dhg_list = list_host_groups(access_token, subscription_id, resource_group, host_group)
+        if dhg_list is None:
             logger.warn ("dhg_mng : analyze_dhg nunsupported parameters")
             return ADH_Return (-1,'analyze_dhg nunsupported parameters')
-        if 'error' in dhg_list:
-            logger.warn ("dhg_mng : analyze_dhg returned error:"+dhg_list['error']['code'])
-            return ADH_Return (-1,'analyze_dhg internal error')
-        self.populate_host_groups(dhg_list,access_token, subscription_id, resource_group)
+        # the VM listing streams in on its own thread while the hosts are crawled
+        vm_executor = ThreadPoolExecutor(max_workers=1) if vm_info else None
+        stop_listing = threading.Event()
+        hosted_vms = vm_executor.submit(collect_hosted_vms, access_token, subscription_id,
+                                        stop_listing) if vm_info else None
+        try:
+            # host groups are crawled page by page as the listing streams in
+            try:
+                self.populate_host_groups(dhg_list,access_token, subscription_id, resource_group, max_workers)
+            except RestError as error:
+                logger.warning ("dhg_mng : analyze_dhg returned error: %s", error)
+                return ADH_Return (-1,'analyze_dhg internal error: ' + error.code)
+            if hosted_vms is not None:
+                self.join_vms(hosted_vms.result)
+        finally:
+            # on error, stop the listing instead of waiting for the rest of the subscription's VMs
+            stop_listing.set()
+            if vm_executor is not None:
+                vm_executor.shutdown(wait=False, cancel_futures=True)
+        if not resource_group and not host_group:
+            # only a crawl of the whole subscription is a starting point for sync_cache
+            self.synced[subscription_id] = started
+        self.build_index()
         return ADH_Return (0,'success')
 
-        #NO-VM vm_dictionary={}
-        #NO-VM for vm in vm_list['value']:
-        #NO-VM     vm_dictionary[vm['id'].upper()]=vm
-        
-        #NO-VM resource_group(vm_dictionary)
-        
+    def join_vms (self, fetch_vms, only_unsized=False):
+        '''Fill in the VM sizes from a VM listing and recalculate the utilization.
+
+        A failed VM listing is logged and leaves the sizes of the VMs not listed yet as they were.
+
+            Args:
+                fetch_vms: Callable returning the collect_hosted_vms dictionary, or a VM iterator
+                    such as iter_vms_sub (see update_vm_info)
+                only_unsized (bool): Only fill in VMs without a size (optional)
+        '''
+        try:
+            self.update_vm_info(fetch_vms(), only_unsized)
+        except RestError as error:
+            logger.warning ("adh_cache: listing the VMs failed, VM sizes are not all updated: %s", error)
+            self.capacity_view().apply_utilization()
+
+
+    def refresh_cache (self,access_token, subscription_id,location, resource_group, host_group, max_workers=None,
+                       vm_info=True):
+        '''Incrementally refresh the cache against the current host group and host listing.
+
+        Only hosts that are new, or whose SKU or virtualMachines list changed, have their instance
+        view fetched again. Hosts and groups that no longer exist are dropped. Groups outside the
+        refreshed subscription / resource group are kept as they are.
+
+        Args:
+            access_token (str): A valid Azure authentication token.
+            subscription_id (str): Azure subscription id.
+            resource_group (str): Azure resource group name.
+            location (str): Azure region. E.g. westus.
+            host_group (str): A specific dedicated host group to analyze (optional)
+            max_workers (int): Number of parallel requests for the crawl (optional, serial if not set)
+            vm_info (bool): Fill in the VM sizes of new and changed hosts, with one VM listing (optional, default True)
+
+        Returns:
+            ADH_Return; body holds a dictionary with the number of new, changed, unchanged and deleted hosts.
+        '''
+        logger.debug ("adh_cache: refresh_cache")
+        started = time.time()
+        dhg_list = list_host_groups(access_token, subscription_id, resource_group, host_group)
+        if dhg_list is None:
+            logger.warn ("dhg_mng : refresh_cache nunsupported parameters")
+            return ADH_Return (-1,'refresh_cache nunsupported parameters')
+        try:
+            groups, stats = self.crawl_host_groups(dhg_list, access_token, subscription_id, max_workers,
+                                                   self.host_group_list)
+        except RestError as error:
+            logger.warning ("dhg_mng : refresh_cache returned error: %s", error)
+            return ADH_Return (-1,'refresh_cache internal error: ' + error.code)
+
+        def in_scope(dhg):
+            if dhg.subscription_id != subscription_id:
+                return False
+            return not resource_group or dhg.resource_group.lower() == resource_group.lower()
+
+        refreshed = {}
+        for dhg_id, dhg in self.host_group_list.items():
+            if not in_scope(dhg):
+                refreshed[dhg_id] = dhg
+        for dhg in groups:
+            refreshed[dhg.id] = dhg
+        stats['deleted'] = 0
+        for dhg_id, dhg in self.host_group_list.items():
+            if in_scope(dhg):
+                current = refreshed.get(dhg_id)
+                for host_name in dhg.host_list:
+                    if current is None or host_name not in current.host_list:
+                        stats['deleted'] += 1
+        self.host_group_list = refreshed
+        if vm_info and (stats['new'] or stats['changed']):
+            # the hosts are known: join the listing against them as it streams in
+            self.join_vms(lambda: iter_vms_sub(access_token, subscription_id), only_unsized=True)
+        if not resource_group and not host_group:
+            self.synced[subscription_id] = started
+        self.build_index()
+
+        returnObj = ADH_Return (0,'success')
+        returnObj.body = stats
+        return returnObj
+
+    def sync_cache (self,access_token, subscription_id,location, resource_group, host_group, max_workers=None,
+                    vm_info=True):
+        '''Apply the changes made since the last crawl or sync, as read from the Resource Graph change feed.
+
+        Only what changed is read again: the host groups in the feed are fetched with their host
+        listing, and the hosts in the feed, or that a changed VM left or landed on, with their
+        instance view. Hosts and groups that no longer exist are dropped. Changed VMs are looked
+        up by id to fill in their sizes; every other VM keeps the size it had.
+
+        Falls back to refresh_cache when the cache has no sync time (it was never crawled as a
+        whole subscription), its last sync is older than settings.DELTA_SYNC_WINDOW, or the change
+        query fails.
+
+        Args:
+            access_token (str): A valid Azure authentication token.
+            subscription_id (str): Azure subscription id.
+            resource_group (str): Azure resource group name.
+            location (str): Azure region. E.g. westus.
+            host_group (str): A specific dedicated host group to analyze (optional)
+            max_workers (int): Number of parallel requests (optional, serial if not set)
+            vm_info (bool): Fill in the sizes of changed VMs (optional, default True)
+
+        Returns:
+            ADH_Return; body holds a dictionary with the number of new, changed, unchanged and deleted
+            hosts, the number of changes read, and the mode: 'delta', or 'refresh' after a fallback.
+        '''
+        logger.debug ("adh_cache: sync_cache")
+        started = time.time()
+        synced = (getattr(self, 'synced', None) or {}).get(subscription_id)
+
+        def refresh(reason):
+            logger.info ("adh_cache: %s, running a refresh instead of a delta sync", reason)
+            returnObj = self.refresh_cache(access_token, subscription_id, location, resource_group, host_group,
+                                           max_workers, vm_info)
+            if returnObj.code == 0:
+                returnObj.body.update(mode='refresh', changes=None)
+            return returnObj
+
+        if synced is None:
+            return refresh("the cache has no sync time")
+        if started - synced > get_delta_sync_window():
+            return refresh("the last sync is older than the change feed window")
+        try:
+            changes = list(iter_resource_changes(access_token, subscription_id, synced - get_delta_sync_overlap()))
+        except RestError as error:
+            return refresh("the change query failed ({})".format(error))
+
+        def in_scope(resource_id):
+            return not resource_group or resource_id.split('/')[4].lower() == resource_group.lower()
+
+        groups_by_id = {dhg_id.upper(): dhg_id for dhg_id in self.host_group_list}
+        hosts_by_id = {}
+        known_vms = {}
+        for dhg_id, dhg in self.host_group_list.items():
+            for host in dhg.host_list.values():
+                hosts_by_id[host.id.upper()] = host
+                for vm_id, vm in host.vm_list.items():
+                    known_vms[vm_id] = (host, vm)
+
+        # resource ids keyed by their upper-cased form
+        changed_groups = {}
+        changed_hosts = {}
+        changed_vms = set()
+        for change in changes:
+            resource_id = change['targetResourceId']
+            resource_type = change['targetResourceType'].lower()
+            if resource_type == HOST_GROUP_TYPE:
+                changed_groups[resource_id.upper()] = resource_id
+            elif resource_type == HOST_TYPE:
+                changed_hosts[resource_id.upper()] = resource_id
+            elif resource_type == VM_TYPE:
+                changed_vms.add(resource_id.upper())
+
+        # the hosts a changed VM left (from the cache) or landed on (from the VM lookup)
+        vm_rows = {}
+        try:
+            if changed_vms:
+                for curr_vm in iter_vms_by_id(access_token, subscription_id, sorted(changed_vms)):
+                    vm_rows[curr_vm['id'].upper()] = curr_vm
+        except RestError as error:
+            return refresh("the VM lookup failed ({})".format(error))
+        for vm_id in changed_vms:
+            if vm_id in known_vms:
+                host_id = known_vms[vm_id][0].id
+                changed_hosts[host_id.upper()] = host_id
+            properties = vm_rows.get(vm_id, {}).get('properties', {})
+            if 'host' in properties:
+                changed_hosts[properties['host']['id'].upper()] = properties['host']['id']
+            elif 'hostGroup' in properties:
+                # automatically placed: the host is only in the VM instance view, read the whole group
+                dhg = self.host_group_list.get(groups_by_id.get(properties['hostGroup']['id'].upper()))
+                for host in (dhg.host_list.values() if dhg is not None else ()):
+                    changed_hosts[host.id.upper()] = host.id
+        for host_key, host_id in list(changed_hosts.items()):
+            group_key = host_key.rsplit('/HOSTS/', 1)[0]
+            if not in_scope(host_id):
+                del changed_hosts[host_key]
+            elif group_key not in groups_by_id:
+                # a host of a group the cache does not have yet: list the whole group
+                changed_groups[group_key] = host_id[:len(group_key)]
+        changed_groups = {key: group_id for key, group_id in changed_groups.items() if in_scope(group_id)}
+
+        stats = {'new': 0, 'changed': 0, 'deleted': 0}
+        fresh = []
+        if max_workers and max_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            executor = InlineExecutor()
+        try:
+            # changed groups first, with their host listing; then the changed hosts they did not re-read
+            group_reads = []
+            for group_key, group_id in changed_groups.items():
+                resource_id = group_id.split('/')
+                group_reads.append((group_key, executor.submit(read_resource, get_dhg, group_id, access_token,
+                                                               subscription_id, resource_id[4], resource_id[8])))
+            listed = []
+            for group_key, future in group_reads:
+                dhg_json = future.result()
+                if dhg_json is not None:
+                    listed.append(dhg_json)
+                elif group_key in groups_by_id:
+                    stats['deleted'] += len(self.host_group_list.pop(groups_by_id[group_key]).host_list)
+            if listed:
+                groups = self.crawl_host_groups(listed, access_token, subscription_id, max_workers,
+                                                self.host_group_list)[0]
+                for dhg in groups:
+                    previous_group = self.host_group_list.pop(groups_by_id.get(dhg.id.upper()), None)
+                    for host in dhg.host_list.values():
+                        previous_host = previous_group.host_list.get(host.name) if previous_group else None
+                        if previous_host is not host:
+                            stats['changed' if previous_host is not None else 'new'] += 1
+                            fresh.append(host)
+                    if previous_group is not None:
+                        stats['deleted'] += sum(1 for name in previous_group.host_list if name not in dhg.host_list)
+                    self.host_group_list[dhg.id] = dhg
+                groups_by_id = {dhg_id.upper(): dhg_id for dhg_id in self.host_group_list}
+
+            fetched = set(host.id.upper() for host in fresh)
+            host_reads = []
+            for host_key, host_id in changed_hosts.items():
+                if host_key not in fetched:
+                    resource_id = host_id.split('/')
+                    host_reads.append((host_key, executor.submit(read_resource, get_dh, host_id, access_token,
+                                                                 subscription_id, resource_id[4], resource_id[8],
+                                                                 resource_id[10])))
+            for host_key, future in host_reads:
+                host_json = future.result()
+                dhg = self.host_group_list.get(groups_by_id.get(host_key.rsplit('/HOSTS/', 1)[0]))
+                if dhg is None:
+                    continue
+                previous_host = hosts_by_id.get(host_key)
+                if host_json is None:
+                    if previous_host is not None and dhg.host_list.get(previous_host.name) is previous_host:
+                        del dhg.host_list[previous_host.name]
+                        stats['deleted'] += 1
+                    continue
+                dh = Host()
+                dh.load_host (host_json, dhg.name, subscription_id)
+                dh.load_instance_view (host_json)
+                stats['changed' if dh.name in dhg.host_list else 'new'] += 1
+                dhg.host_list[dh.name] = dh
+                fresh.append(dh)
+        except RestError as error:
+            logger.warning ("dhg_mng : sync_cache returned error: %s", error)
+            return ADH_Return (-1,'sync_cache internal error: ' + error.code)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if fresh:
+            # VMs that did not change keep their size; changed ones, and the VMs of hosts new to
+            # the cache, take it from a lookup by id
+            unknown = set()
+            for host in fresh:
+                for vm_id, vm in host.vm_list.items():
+                    if vm_id not in vm_rows and vm_id in known_vms:
+                        vm.name = known_vms[vm_id][1].name
+                        vm.size = known_vms[vm_id][1].size
+                    elif vm_id not in vm_rows:
+                        unknown.add(vm_id)
+            try:
+                if unknown and vm_info:
+                    for curr_vm in iter_vms_by_id(access_token, subscription_id, sorted(unknown)):
+                        vm_rows[curr_vm['id'].upper()] = curr_vm
+            except RestError as error:
+                logger.warning ("adh_cache: VM lookup failed, %d VM sizes are not filled in: %s", len(unknown), error)
+            if vm_info:
+                for host in fresh:
+                    for vm_id, vm in host.vm_list.items():
+                        if vm_id in vm_rows:
+                            vm.populate_vm (vm_rows[vm_id])
+            self.capacity_view().apply_utilization()
+        if not resource_group and not host_group:
+            self.synced[subscription_id] = started
+        self.build_index()
+        stats['unchanged'] = sum(len(dhg.host_list) for dhg in self.host_group_list.values()) - \
+            stats['new'] - stats['changed']
+        stats.update(mode='delta', changes=len(changes))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug ("adh_cache: delta sync of %d changes: %d groups and %d hosts read, %d VMs looked up",
+                          len(changes), len(changed_groups), len(changed_hosts), len(changed_vms))
+        returnObj = ADH_Return (0,'success')
+        returnObj.body = stats
+        return returnObj
+
+
+def list_host_groups (access_token, subscription_id, resource_group, host_group):
+    '''Stream the host groups in scope of an analyze or refresh.
+
+    Returns:
+        An iterator of host group JSON objects, or None for an unsupported combination of parameters.
+    '''
+    if not resource_group:
+        return iter_dhg_sub(access_token, subscription_id)
+    elif resource_group  and not host_group:
+        return iter_dhg(access_token, subscription_id,resource_group)
+    return None
+
+
+def collect_hosted_vms (access_token, subscription_id, stop=None):
+    '''List the VMs of a subscription page by page and keep the name and size of the ones on dedicated hosts.
+
+    Used while the hosts are still being crawled, so the VMs can not be joined yet; only two
+    strings are kept per hosted VM and every page is dropped once read. VMs of a host can live
+    in any resource group, so the whole subscription is listed.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        stop (threading.Event): Stop listing once set, e.g. when the host crawl failed (optional)
+
+    Returns:
+        A dictionary of (name, size) of the VMs with a host or host group, keyed by upper-cased VM id.
+    '''
+    hosted_vms = {}
+    for curr_vm in iter_vms_sub(access_token, subscription_id):
+        if stop is not None and stop.is_set():
+            break
+        properties = curr_vm.get('properties', {})
+        if 'host' in properties or 'hostGroup' in properties:
+            hosted_vms[sys.intern(curr_vm['id'].upper())] = (
+                curr_vm['name'], sys.intern(properties['hardwareProfile']['vmSize']))
+    return hosted_vms
+
+
+
+def read_resource (fetch, resource_id, *args):
+    '''Call an adh_crp GET function and check the response.
+
+    Returns:
+        The JSON body, or None if the resource no longer exists. Raises RestError for other errors.
+    '''
+    response = fetch(*args)
+    if 'error' in response and response['error'].get('code') in NOT_FOUND_CODES:
+        return None
+    return check_response(resource_id, response)
+
+class InlineExecutor:
+    '''Executor stand-in that runs every submitted call immediately, for the serial crawl.'''
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
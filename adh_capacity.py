@@ -0,0 +1,345 @@
+'''adh_capacity.py - columnar capacity view over the dedicated host cache
+
+A CapacityView lays the hosts of a DedicateHostCache out as columns: one row per host, one
+column per VM size (the ordinals of adh_skus.VM_SIZES). Per host it holds
+
+    allocatable     allocatable VM counts per size (-1 = size not offered)
+    vm_counts       hosted VMs per size
+    total_cores, total_mem, used_cores, used_mem, free_cores, free_mem
+
+Utilization, fit checks and capacity summaries are computed with batched array operations when
+NumPy is installed (pip install adh-mng[capacity]), and with plain Python loops over the same
+columns otherwise. The view is a copy: build a new one after the cache changes.
+
+    view = local_cache.capacity_view()
+    view.fit_count('Standard_D8s_v3', location='eastus2', zone='2')
+    view.summary(by=('location', 'fault_domain'))
+'''
+import csv
+import io
+import json
+from array import array
+
+from adh_index import attribute_key, location_key
+from adh_skus import SKUS, VM_SIZES, find_vm_size_ordinal, vm_size_ordinal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FILTER_COLUMNS = ('location', 'zone', 'fault_domain', 'resource_group', 'host_group')
+GROUP_COLUMNS = FILTER_COLUMNS + ('sku', 'subscription')
+SUMMARY_COLUMNS = ('hosts', 'empty_hosts', 'vms', 'total_cores', 'used_cores', 'free_cores', 'total_mem', 'used_mem',
+                   'free_mem')
+
+
+def _size_demand(vm_sizes):
+    cores = []
+    mem = []
+    for vm_size in vm_sizes:
+        vm_sku = SKUS.vm_skus.get(vm_size)
+        cores.append(vm_sku["cpu_count"] if vm_sku else 0)
+        mem.append(vm_sku["mem_size"] if vm_sku else 0)
+    return cores, mem
+
+
+class CapacityView:
+    '''Columns of the hosts in a cache, see the module docstring.
+
+    Args:
+        local_cache (DedicateHostCache): The cache.
+        use_numpy (bool): Compute with NumPy (optional, default: if it is installed)
+    '''
+
+    def __init__(self, local_cache, use_numpy=None):
+        self.numpy = numpy is not None if use_numpy is None else use_numpy and numpy is not None
+        self.hosts = []
+        labels = {column: [] for column in GROUP_COLUMNS}
+        allocatable = []
+        vm_sizes = []
+        total_cores = []
+        total_mem = []
+        for host_group in local_cache.host_group_list.values():
+            for host in host_group.host_list.values():
+                self.hosts.append((host_group, host))
+                labels['location'].append(location_key(host_group.location))
+                labels['zone'].append(attribute_key(host_group.az) or '')
+                labels['fault_domain'].append(attribute_key(host.fault_domain) or '')
+                labels['resource_group'].append(host_group.resource_group.lower())
+                labels['host_group'].append(host_group.name.lower())
+                labels['sku'].append(host.sku)
+                labels['subscription'].append(host_group.subscription_id.lower())
+                allocatable.append(host.allocatableVMs.counts)
+                vm_sizes.append([vm_size_ordinal(vm.size) if vm.size else -1 for vm in host.vm_list.values()])
+                host_sku = SKUS.host_skus.get(host.sku)
+                total_cores.append(host_sku["core_count"] if host_sku else host.total_cores)
+                total_mem.append(host_sku["mem_size"] if host_sku else host.total_mem)
+        # sizes first seen while building (hosted VMs of sizes no host offers) widen the table
+        self.vm_sizes = list(VM_SIZES)
+        width = len(self.vm_sizes)
+        size_cores, size_mem = _size_demand(self.vm_sizes)
+        rows = len(self.hosts)
+
+        if self.numpy:
+            self.labels = {}
+            self.codes = {}
+            for column, values in labels.items():
+                # label values, and per row the position of its value, for grouping
+                self.labels[column], self.codes[column] = numpy.unique(numpy.array(values, dtype=str),
+                                                                       return_inverse=True)
+            padding = [array('i', [-1] * pad).tobytes() for pad in range(width + 1)]
+            self.allocatable = numpy.frombuffer(
+                b''.join(counts.tobytes() + padding[width - len(counts)] for counts in allocatable),
+                dtype=numpy.int32).reshape(rows, width)
+            host_rows = numpy.repeat(numpy.arange(rows), [len(sizes) for sizes in vm_sizes])
+            ordinals = numpy.fromiter((ordinal for sizes in vm_sizes for ordinal in sizes), dtype=numpy.int64,
+                                      count=len(host_rows))
+            sized = ordinals >= 0
+            self.vm_counts = numpy.bincount(host_rows[sized] * width + ordinals[sized],
+                                            minlength=rows * width).reshape(rows, width).astype(numpy.int32)
+            self.vms = numpy.array([len(sizes) for sizes in vm_sizes], dtype=numpy.int64)
+            self.total_cores = numpy.array(total_cores, dtype=numpy.int64)
+            self.total_mem = numpy.array(total_mem, dtype=numpy.int64)
+            self.used_cores = self.vm_counts @ numpy.array(size_cores, dtype=numpy.int64)
+            self.used_mem = self.vm_counts @ numpy.array(size_mem, dtype=numpy.int64)
+        else:
+            self.labels = labels
+            self.allocatable = [list(counts) + [-1] * (width - len(counts)) for counts in allocatable]
+            self.vm_counts = []
+            for sizes in vm_sizes:
+                counts = [0] * width
+                for ordinal in sizes:
+                    if ordinal >= 0:
+                        counts[ordinal] += 1
+                self.vm_counts.append(counts)
+            self.vms = [len(sizes) for sizes in vm_sizes]
+            self.total_cores = total_cores
+            self.total_mem = total_mem
+            self.used_cores = [sum(count * cores for count, cores in zip(counts, size_cores) if count)
+                               for counts in self.vm_counts]
+            self.used_mem = [sum(count * mem for count, mem in zip(counts, size_mem) if count)
+                             for counts in self.vm_counts]
+        self.free_cores = self._subtract(self.total_cores, self.used_cores)
+        self.free_mem = self._subtract(self.total_mem, self.used_mem)
+        # Fragmentation inputs from the allocatable counts alone: the free cores as counted in the
+        # smallest size a host offers, and the part of them the largest offered size can use.
+        if self.numpy:
+            self.empty = (self.vms == 0).astype(numpy.int64)
+            cores = numpy.array(size_cores, dtype=numpy.int64)
+            offered = (self.allocatable >= 0) & (cores > 0)
+            slot_cores = numpy.maximum(self.allocatable, 0) * cores
+            smallest = numpy.where(offered, cores, numpy.iinfo(numpy.int64).max).argmin(axis=1)
+            largest = numpy.where(offered, cores, -1).argmax(axis=1)
+            any_offered = offered.any(axis=1)
+            self.slack_cores = numpy.where(any_offered, slot_cores[numpy.arange(rows), smallest], 0)
+            self.block_cores = numpy.where(any_offered, slot_cores[numpy.arange(rows), largest], 0)
+        else:
+            self.empty = [1 if vms == 0 else 0 for vms in self.vms]
+            self.slack_cores = []
+            self.block_cores = []
+            for counts in self.allocatable:
+                offered = [(size_cores[ordinal], max(count, 0) * size_cores[ordinal])
+                           for ordinal, count in enumerate(counts) if count >= 0 and size_cores[ordinal] > 0]
+                self.slack_cores.append(min(offered)[1] if offered else 0)
+                self.block_cores.append(max(offered)[1] if offered else 0)
+
+    def _subtract(self, left, right):
+        if self.numpy:
+            return left - right
+        return [a - b for a, b in zip(left, right)]
+
+    def mask(self, location=None, zone=None, fault_domain=None, resource_group=None, host_group=None):
+        '''Rows matching the filters (None = any): a boolean array, or a list of bools without NumPy.'''
+        wanted = {'location': location_key(location) if location else None,
+                  'zone': attribute_key(zone or None),
+                  'fault_domain': attribute_key(fault_domain if fault_domain != '' else None),
+                  'resource_group': resource_group.lower() if resource_group else None,
+                  'host_group': host_group.lower() if host_group else None}
+        if self.numpy:
+            selected = numpy.ones(len(self.hosts), dtype=bool)
+            for column, value in wanted.items():
+                if value is not None:
+                    position = numpy.searchsorted(self.labels[column], value)
+                    if position == len(self.labels[column]) or self.labels[column][position] != value:
+                        return numpy.zeros(len(self.hosts), dtype=bool)
+                    selected &= self.codes[column] == position
+            return selected
+        selected = [True] * len(self.hosts)
+        for column, value in wanted.items():
+            if value is not None:
+                selected = [keep and label == value for keep, label in zip(selected, self.labels[column])]
+        return selected
+
+    def slots(self, vm_size, mask=None):
+        '''Allocatable VMs of vm_size per host (0 where the size is not offered or masked out).'''
+        ordinal = find_vm_size_ordinal(vm_size)
+        if self.numpy:
+            if ordinal is None or ordinal >= len(self.vm_sizes):
+                return numpy.zeros(len(self.hosts), dtype=numpy.int32)
+            slots = numpy.maximum(self.allocatable[:, ordinal], 0)
+            return slots if mask is None else numpy.where(mask, slots, 0)
+        if ordinal is None or ordinal >= len(self.vm_sizes):
+            return [0] * len(self.hosts)
+        slots = [max(counts[ordinal], 0) for counts in self.allocatable]
+        return slots if mask is None else [count if keep else 0 for count, keep in zip(slots, mask)]
+
+    def offered_sizes(self, mask=None):
+        '''The VM sizes offered by at least one (matching) host, in VM_SIZES order.'''
+        if self.numpy:
+            offered = self.allocatable >= 0 if mask is None else self.allocatable[mask] >= 0
+            return [self.vm_sizes[ordinal] for ordinal in numpy.flatnonzero(offered.any(axis=0))]
+        offered = set()
+        for row, counts in enumerate(self.allocatable):
+            if mask is None or mask[row]:
+                offered.update(ordinal for ordinal, count in enumerate(counts) if count >= 0)
+        return [self.vm_sizes[ordinal] for ordinal in sorted(offered)]
+
+    def fit_count(self, vm_size, location=None, zone=None, fault_domain=None, resource_group=None,
+                  host_group=None):
+        '''How many VMs of vm_size fit on the hosts matching the filters.'''
+        slots = self.slots(vm_size, self.mask(location, zone, fault_domain, resource_group, host_group))
+        return int(slots.sum()) if self.numpy else sum(slots)
+
+    def fitting_hosts(self, vm_size, count=1, location=None, zone=None, fault_domain=None,
+                      resource_group=None, host_group=None):
+        '''(HostGroup, Host) of every matching host with room for count VMs of vm_size, in cache order.'''
+        slots = self.slots(vm_size, self.mask(location, zone, fault_domain, resource_group, host_group))
+        if self.numpy:
+            return [self.hosts[row] for row in numpy.flatnonzero(slots >= count)]
+        return [self.hosts[row] for row, slot in enumerate(slots) if slot >= count]
+
+    def summary(self, by=('location',), vm_sizes=(), location=None, zone=None, fault_domain=None,
+                resource_group=None, host_group=None):
+        '''Capacity totals of the matching hosts, grouped by label columns.
+
+        Args:
+            by (tuple): Columns to group by, from GROUP_COLUMNS (empty for one grand total)
+            vm_sizes (tuple): Also report how many VMs of each of these sizes fit (optional)
+
+        Returns:
+            A list of dictionaries, one per group sorted by its labels, with the label columns,
+            SUMMARY_COLUMNS, the 'fragmentation' (share of the free cores, counted in the smallest
+            size each host offers, that the largest size it offers can not use) and a 'fits'
+            dictionary with how many VMs of each size fit, each size counted on its own.
+        '''
+        for column in by:
+            if column not in GROUP_COLUMNS:
+                raise ValueError('can not group by {}'.format(column))
+        mask = self.mask(location, zone, fault_domain, resource_group, host_group)
+        if by and not any(mask):
+            return []
+        values = {'hosts': None, 'vms': self.vms, 'total_cores': self.total_cores, 'used_cores': self.used_cores,
+                  'free_cores': self.free_cores, 'total_mem': self.total_mem, 'used_mem': self.used_mem,
+                  'free_mem': self.free_mem, 'empty_hosts': self.empty, 'slack_cores': self.slack_cores,
+                  'block_cores': self.block_cores}
+        for vm_size in vm_sizes:
+            values[('fits', vm_size)] = self.slots(vm_size)
+
+        if self.numpy:
+            rows = numpy.flatnonzero(mask)
+            # one integer key per row, ordered like the label tuples
+            keys = numpy.zeros(len(rows), dtype=numpy.int64)
+            for column in by:
+                keys = keys * len(self.labels[column]) + self.codes[column][rows]
+            groups, inverse = numpy.unique(keys, return_inverse=True)
+            if not by:
+                groups = numpy.zeros(1, dtype=numpy.int64)
+            totals = {}
+            for name, column in values.items():
+                weights = None if column is None else column[rows]
+                totals[name] = numpy.bincount(inverse, weights=weights, minlength=len(groups)).astype(numpy.int64)
+            group_labels = []
+            for key in groups.tolist():
+                labels = []
+                for column in reversed(by):
+                    key, position = divmod(key, len(self.labels[column]))
+                    labels.append(str(self.labels[column][position]))
+                group_labels.append(tuple(reversed(labels)))
+        else:
+            index = {}
+            group_labels = []
+            totals = {name: [] for name in values}
+            for row, keep in enumerate(mask):
+                if not keep:
+                    continue
+                key = tuple(self.labels[column][row] for column in by)
+                position = index.get(key)
+                if position is None:
+                    position = index[key] = len(group_labels)
+                    group_labels.append(key)
+                    for name in values:
+                        totals[name].append(0)
+                for name, column in values.items():
+                    totals[name][position] += 1 if column is None else column[row]
+            order = sorted(range(len(group_labels)), key=lambda position: group_labels[position])
+            group_labels = [group_labels[position] for position in order]
+            totals = {name: [column[position] for position in order] for name, column in totals.items()}
+            if not by and not group_labels:
+                group_labels = [()]
+                totals = {name: [0] for name in values}
+
+        result = []
+        for position, labels in enumerate(group_labels):
+            entry = dict(zip(by, labels))
+            for name in SUMMARY_COLUMNS:
+                entry[name] = int(totals[name][position])
+            slack_cores = int(totals['slack_cores'][position])
+            entry['fragmentation'] = round(1 - int(totals['block_cores'][position]) / slack_cores, 3) \
+                if slack_cores > 0 else 0.0
+            entry['fits'] = {vm_size: int(totals[('fits', vm_size)][position]) for vm_size in vm_sizes}
+            result.append(entry)
+        return result
+
+    def apply_utilization(self):
+        '''Write the computed totals and used/free cores and memory back to the Host objects.'''
+        columns = (self.total_cores, self.total_mem, self.used_cores, self.used_mem, self.free_cores, self.free_mem)
+        if self.numpy:
+            columns = [column.tolist() for column in columns]
+        for (host_group, host), total_cores, total_mem, used_cores, used_mem, free_cores, free_mem in \
+                zip(self.hosts, *columns):
+            host.total_cores = total_cores
+            host.total_mem = total_mem
+            host.utilized_cores = used_cores
+            host.utilized_mem = used_mem
+            host.available_cores = free_cores
+            host.available_mem = free_mem
+
+
+def format_capacity(rows, by, vm_sizes, output_format='table'):
+    '''Render summary rows as a text table, JSON or CSV.
+
+    Args:
+        rows (list): Rows of CapacityView.summary.
+        by (tuple): The label columns of the rows.
+        vm_sizes (list): The sizes in the 'fits' of the rows.
+        output_format (str): table, json or csv
+    '''
+    if output_format == 'json':
+        return json.dumps(rows, indent=2)
+    columns = list(by) + list(SUMMARY_COLUMNS) + ['fragmentation']
+    if output_format == 'csv':
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(columns + ['fits_' + vm_size for vm_size in vm_sizes])
+        for row in rows:
+            writer.writerow([row[column] for column in columns] + [row['fits'][vm_size] for vm_size in vm_sizes])
+        return output.getvalue()
+    if output_format != 'table':
+        raise ValueError('unknown report format {}'.format(output_format))
+
+    headers = list(by) + ['hosts', 'empty', 'vms', 'cores used/total', 'mem GB used/total', 'frag', 'fits']
+    lines = []
+    for row in rows:
+        fits = ' '.join('{}={}'.format(vm_size.replace('Standard_', ''), row['fits'][vm_size])
+                        for vm_size in vm_sizes if row['fits'][vm_size] > 0)
+        lines.append([str(row[column]) for column in by] +
+                     [str(row['hosts']), str(row['empty_hosts']), str(row['vms']),
+                      '{}/{}'.format(row['used_cores'], row['total_cores']),
+                      '{}/{}'.format(row['used_mem'], row['total_mem']),
+                      '{:.2f}'.format(row['fragmentation']), fits or '-'])
+    widths = [max([len(header)] + [len(line[position]) for line in lines]) for position, header in enumerate(headers)]
+    text = []
+    for line in [headers] + lines:
+        text.append('  '.join(value.ljust(width) for value, width in zip(line[:-1], widths)) + '  ' + line[-1])
+    return '\n'.join(text) + '\n'
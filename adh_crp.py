@@ -1,10 +1,33 @@
 '''adh_crp CRP wrapper for REST calls'''
 
+import codecs
 import json
-import adal
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from datetime import timezone
 
-from restfns import do_delete, do_get, do_get_next, do_patch, do_post, do_put
-from settings import COMP_API, get_rm_endpoint, get_auth_endpoint, get_resource_endpoint
+from adh_token import get_token_provider
+from restfns import check_response, do_delete, do_get, do_get_next, do_patch, do_post, do_put, get_session, \
+    iter_get_next, response_json, wait_for_operation
+from settings import COMP_API, RESOURCE_GRAPH_API, get_rm_endpoint, get_host_create_workers
+
+# resource types of the change feed rows read by iter_resource_changes
+HOST_GROUP_TYPE = 'microsoft.compute/hostgroups'
+HOST_TYPE = 'microsoft.compute/hostgroups/hosts'
+VM_TYPE = 'microsoft.compute/virtualmachines'
+
+# VM ids per Resource Graph query of iter_vms_by_id
+RESOURCE_GRAPH_ID_BATCH = 200
+
+
+def create_dhg_endpoint(subscription_id, resource_group, dhg_name):
+    '''Endpoint URL used by create_dhg().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/hostgroups/', dhg_name,
+                    '?api-version=', COMP_API])
 
 
 def create_dhg(access_token, subscription_id, resource_group, dhg_name,
@@ -22,43 +45,106 @@ def create_dhg(access_token, subscription_id, resource_group, dhg_name,
     Returns:
         HTTP response. JSON body of the dedicated host group properties.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/hostgroups/', dhg_name,
-                        '?api-version=', COMP_API])
+    endpoint = create_dhg_endpoint(subscription_id, resource_group, dhg_name)
+    body = create_dhg_body(az_name, location)
+    return do_put(endpoint, body, access_token)
+
+
+def create_dhg_body(az_name, location):
+    '''JSON request body used by create_dhg().'''
     dhg_body = {'location': location}
     if az_name is not None:
         dhg_body['zones'] = [az_name]    
-    body = json.dumps(dhg_body)
-    return do_put(endpoint, body, access_token)
+    return json.dumps(dhg_body)
+
+
+def create_dh_endpoint(subscription_id, resource_group, dhg_name, dh_name):
+    '''Endpoint URL used by create_dh().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/hostgroups/', dhg_name,
+                    '/hosts/', dh_name,
+                    '?api-version=', COMP_API])
+
 
 def create_dh(access_token, subscription_id, resource_group, dhg_name,
-              dh_name, dh_sku, location):
-    '''Create dedicated host group.
+              dh_name, dh_sku, location, fault_domain=None):
+    '''Create dedicated host.
 
     Args:
         access_token (str): A valid Azure authentication token.
         subscription_id (str): Azure subscription id.
         resource_group (str): Azure resource group name.
-        dhg_name (str): Name of the new dedicated host group.
-        az_name (str): Availability zone name.
+        dhg_name (str): Name of the dedicated host group.
+        dh_name (str): Name of the new dedicated host.
+        dh_sku (str): Host SKU. E.g. DSv3-Type1.
         location (str): Azure data center location. E.g. westus.
+        fault_domain (int): Platform fault domain of the host (optional).
 
     Returns:
-        HTTP response. JSON body of the dedicated host group properties.
+        HTTP response. JSON body of the dedicated host properties. The host is provisioned
+        asynchronously, see wait_for_operation.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/hostgroups/', dhg_name,
-                        '/hosts/', dh_name,
-                        '?api-version=', COMP_API])
+    endpoint = create_dh_endpoint(subscription_id, resource_group, dhg_name, dh_name)
+    body = create_dh_body(dh_sku, location, fault_domain)
+    return do_put(endpoint, body, access_token)
+
+
+def create_dh_body(dh_sku, location, fault_domain=None):
+    '''JSON request body used by create_dh().'''
     dhg_body = {'location': location}
     host_sku = {'name': dh_sku}    
     dhg_body['sku'] = host_sku   
-    body = json.dumps(dhg_body)
-    return do_put(endpoint, body, access_token)
+    if fault_domain is not None:
+        dhg_body['properties'] = {'platformFaultDomain': int(fault_domain)}
+    return json.dumps(dhg_body)
+
+
+def create_dhs(access_token, subscription_id, resource_group, dhg_name,
+               dh_names, dh_sku, location, fault_domain=None, max_workers=None, timeout=None):
+    '''Create dedicated hosts in parallel and wait until they are provisioned.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        resource_group (str): Azure resource group name.
+        dhg_name (str): Name of the dedicated host group.
+        dh_names (list): Names of the new dedicated hosts.
+        dh_sku (str): Host SKU. E.g. DSv3-Type1.
+        location (str): Azure data center location. E.g. westus.
+        fault_domain (int): Platform fault domain of the hosts (optional).
+        max_workers (int): Number of hosts created at the same time (optional, see settings).
+        timeout (float): Seconds to wait for each host (optional, see settings).
+
+    Returns:
+        A list of (host name, status, JSON body) in the order of dh_names. status is Succeeded,
+        Failed, Canceled or TimedOut; the body is the dedicated host with its instance view if
+        it succeeded, else the error.
+    '''
+    def create_one(dh_name):
+        response = create_dh(access_token, subscription_id, resource_group, dhg_name,
+                             dh_name, dh_sku, location, fault_domain)
+        endpoint = get_dh_endpoint(subscription_id, resource_group, dhg_name, dh_name)
+        status, body = wait_for_operation(response, access_token, endpoint, timeout)
+        return dh_name, status, body
+
+    if max_workers is None:
+        max_workers = get_host_create_workers()
+    if not dh_names:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(dh_names)))) as executor:
+        return list(executor.map(create_one, dh_names))
+
+
+def deallocate_vm_endpoint(subscription_id, resource_group, vm_name):
+    '''Endpoint URL used by deallocate_vm().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines/', vm_name,
+                    '/deallocate',
+                    '?api-version=', COMP_API])
 
 
 def deallocate_vm(access_token, subscription_id, resource_group, vm_name):
@@ -73,15 +159,18 @@ def deallocate_vm(access_token, subscription_id, resource_group, vm_name):
     Returns:
         HTTP response.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines/', vm_name,
-                        '/deallocate',
-                        '?api-version=', COMP_API])
+    endpoint = deallocate_vm_endpoint(subscription_id, resource_group, vm_name)
     return do_post(endpoint, '', access_token)
 
 
+def get_compute_usage_endpoint(subscription_id, location):
+    '''Endpoint URL used by get_compute_usage().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/providers/Microsoft.compute/locations/', location,
+                    '/usages?api-version=', COMP_API])
+
+
 def get_compute_usage(access_token, subscription_id, location):
     '''List compute usage and limits for a location.
 
@@ -93,13 +182,19 @@ def get_compute_usage(access_token, subscription_id, location):
     Returns:
         HTTP response. JSON body of Compute usage and limits data.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/providers/Microsoft.compute/locations/', location,
-                        '/usages?api-version=', COMP_API])
+    endpoint = get_compute_usage_endpoint(subscription_id, location)
     return do_get(endpoint, access_token)
 
 
+def get_vm_endpoint(subscription_id, resource_group, vm_name):
+    '''Endpoint URL used by get_vm().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines/', vm_name,
+                    '?api-version=', COMP_API])
+
+
 def get_vm(access_token, subscription_id, resource_group, vm_name):
     '''Get virtual machine details.
 
@@ -112,14 +207,19 @@ def get_vm(access_token, subscription_id, resource_group, vm_name):
     Returns:
         HTTP response. JSON body of VM properties.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines/', vm_name,
-                        '?api-version=', COMP_API])
+    endpoint = get_vm_endpoint(subscription_id, resource_group, vm_name)
     return do_get(endpoint, access_token)
 
 
+def get_vm_instance_view_endpoint(subscription_id, resource_group, vm_name):
+    '''Endpoint URL used by get_vm_instance_view().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines/', vm_name,
+                    '/InstanceView?api-version=', COMP_API])
+
+
 def get_vm_instance_view(access_token, subscription_id, resource_group, vm_name):
     '''Get operational details about the state of a VM.
 
@@ -132,14 +232,19 @@ def get_vm_instance_view(access_token, subscription_id, resource_group, vm_name)
     Returns:
         HTTP response. JSON body of VM instance view details.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines/', vm_name,
-                        '/InstanceView?api-version=', COMP_API])
+    endpoint = get_vm_instance_view_endpoint(subscription_id, resource_group, vm_name)
     return do_get(endpoint, access_token)
 
 
+def list_dhg_endpoint(subscription_id, resource_group):
+    '''Endpoint URL used by list_dhg().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/hostgroups',
+                    '?api-version=', COMP_API])
+
+
 def list_dhg(access_token, subscription_id, resource_group):
     '''List availability sets in a resource_group.
 
@@ -151,14 +256,33 @@ def list_dhg(access_token, subscription_id, resource_group):
     Returns:
         HTTP response. JSON body of the list of availability set properties.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/hostgroups',
-                        '?api-version=', COMP_API])
+    endpoint = list_dhg_endpoint(subscription_id, resource_group)
     return do_get_next(endpoint, access_token)
 
 
+def iter_dhg(access_token, subscription_id, resource_group):
+    '''Stream the dedicated host groups in a resource_group.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        resource_group (str): Azure resource group name.
+
+    Returns:
+        A generator of dedicated host group JSON objects, fetched page by page.
+    '''
+    endpoint = list_dhg_endpoint(subscription_id, resource_group)
+    return iter_get_next(endpoint, access_token)
+
+
+def list_dhg_sub_endpoint(subscription_id):
+    '''Endpoint URL used by list_dhg_sub().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/providers/Microsoft.Compute/hostgroups',
+                    '?api-version=', COMP_API])
+
+
 def list_dhg_sub(access_token, subscription_id):
     '''List dedicated host groups in a subscription.
 
@@ -169,13 +293,59 @@ def list_dhg_sub(access_token, subscription_id):
     Returns:
         HTTP response. JSON body of the list of dedicated hostsproperties.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/providers/Microsoft.Compute/hostgroups',
-                        '?api-version=', COMP_API])
+    endpoint = list_dhg_sub_endpoint(subscription_id)
     return do_get_next(endpoint, access_token)
 
 
+def iter_dhg_sub(access_token, subscription_id):
+    '''Stream the dedicated host groups in a subscription.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+
+    Returns:
+        A generator of dedicated host group JSON objects, fetched page by page.
+    '''
+    endpoint = list_dhg_sub_endpoint(subscription_id)
+    return iter_get_next(endpoint, access_token)
+
+
+def get_dhg_endpoint(subscription_id, resource_group, dhg_name):
+    '''Endpoint URL used by get_dhg().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/hostgroups/', dhg_name,
+                    '?api-version=', COMP_API])
+
+
+def get_dhg(access_token, subscription_id, resource_group, dhg_name):
+    '''Get a dedicated host group.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        resource_group (str): Azure resource group name.
+        dhg_name (str): Dedicated host group name.
+
+    Returns:
+        HTTP response. JSON body of the dedicated host group properties.
+    '''
+    endpoint = get_dhg_endpoint(subscription_id, resource_group, dhg_name)
+    return do_get(endpoint, access_token)
+
+
+def list_dh_endpoint(subscription_id, resource_group, dhg_name):
+    '''Endpoint URL used by list_dh().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/hostgroups/', dhg_name,
+                    '/hosts'
+                    '?api-version=', COMP_API])
+
+
 def list_dh(access_token, subscription_id, resource_group,dhg_name):
     '''List dedicated hosts in a host group.
 
@@ -188,14 +358,35 @@ def list_dh(access_token, subscription_id, resource_group,dhg_name):
     Returns:
         HTTP response. JSON body of the list of dedicated hosts properties.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/hostgroups/', dhg_name,
-                        '/hosts'
-                        '?api-version=', COMP_API])
+    endpoint = list_dh_endpoint(subscription_id, resource_group, dhg_name)
     return do_get_next(endpoint, access_token)
 
+
+def iter_dh(access_token, subscription_id, resource_group, dhg_name):
+    '''Stream the dedicated hosts in a host group.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        resource_group (str): Azure resource group name.
+        dhg_name (str): Dedicated host group name.
+
+    Returns:
+        A generator of dedicated host JSON objects, fetched page by page.
+    '''
+    endpoint = list_dh_endpoint(subscription_id, resource_group, dhg_name)
+    return iter_get_next(endpoint, access_token)
+
+def get_dh_endpoint(subscription_id, resource_group, dhg_name, dh_name):
+    '''Endpoint URL used by get_dh().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/hostgroups/', dhg_name,
+                    '/hosts/',dh_name,
+                    '?$expand=instanceView&api-version=', COMP_API])
+
+
 def get_dh(access_token, subscription_id, resource_group,dhg_name, dh_name):
     '''Get a dedicated host and its instance view.
 
@@ -208,16 +399,20 @@ def get_dh(access_token, subscription_id, resource_group,dhg_name, dh_name):
     Returns:
         HTTP response. JSON body of the list of dedicated hosts properties.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/hostgroups/', dhg_name,
-                        '/hosts/',dh_name,
-                        '?$expand=instanceView&api-version=', COMP_API])
+    endpoint = get_dh_endpoint(subscription_id, resource_group, dhg_name, dh_name)
     return do_get_next(endpoint, access_token)
 
 
 
+def list_vms_endpoint(subscription_id, resource_group):
+    '''Endpoint URL used by list_vms().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines',
+                    '?api-version=', COMP_API])
+
+
 def list_vms(access_token, subscription_id, resource_group):
     '''List VMs in a resource group.
 
@@ -229,14 +424,33 @@ def list_vms(access_token, subscription_id, resource_group):
     Returns:
         HTTP response. JSON body of a list of VM model views.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines',
-                        '?api-version=', COMP_API])
+    endpoint = list_vms_endpoint(subscription_id, resource_group)
     return do_get(endpoint, access_token)
 
 
+def iter_vms(access_token, subscription_id, resource_group):
+    '''Stream the VMs in a resource group.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        resource_group (str): Azure resource group name.
+
+    Returns:
+        A generator of VM model view JSON objects, fetched page by page.
+    '''
+    endpoint = list_vms_endpoint(subscription_id, resource_group)
+    return iter_get_next(endpoint, access_token)
+
+
+def list_vms_sub_endpoint(subscription_id):
+    '''Endpoint URL used by list_vms_sub().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/providers/Microsoft.Compute/virtualMachines',
+                    '?api-version=', COMP_API])
+
+
 def list_vms_sub(access_token, subscription_id):
     '''List VMs in a subscription.
 
@@ -247,13 +461,119 @@ def list_vms_sub(access_token, subscription_id):
     Returns:
         HTTP response. JSON body of a list of VM model views.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/providers/Microsoft.Compute/virtualMachines',
-                        '?api-version=', COMP_API])
+    endpoint = list_vms_sub_endpoint(subscription_id)
     return do_get_next(endpoint, access_token)
 
 
+def iter_vms_sub(access_token, subscription_id):
+    '''Stream the VMs in a subscription.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+
+    Returns:
+        A generator of VM model view JSON objects, fetched page by page.
+    '''
+    endpoint = list_vms_sub_endpoint(subscription_id)
+    return iter_get_next(endpoint, access_token)
+
+
+def resource_graph_endpoint():
+    '''Endpoint URL used by iter_resource_graph().'''
+    return ''.join([get_rm_endpoint(),
+                    '/providers/Microsoft.ResourceGraph/resources',
+                    '?api-version=', RESOURCE_GRAPH_API])
+
+
+def iter_resource_graph(access_token, subscription_id, query):
+    '''Run an Azure Resource Graph query and stream the result rows.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id the query is scoped to.
+        query (str): Kusto (KQL) query.
+
+    Returns:
+        A generator of result row dictionaries, fetched page by page ($skipToken).
+        Raises RestError if a page is an error body.
+    '''
+    endpoint = resource_graph_endpoint()
+    options = {'resultFormat': 'objectArray'}
+    while True:
+        body = json.dumps({'subscriptions': [subscription_id], 'query': query, 'options': options})
+        page = check_response(endpoint, response_json(do_post(endpoint, body, access_token)))
+        for row in page.get('data', []):
+            yield row
+        skip_token = page.get('$skipToken')
+        if not skip_token:
+            return
+        options = dict(options, **{'$skipToken': skip_token})
+
+
+def format_kql_datetime(timestamp):
+    '''KQL datetime literal of a POSIX timestamp, e.g. datetime(2021-03-01T12:00:00.000000Z).'''
+    return 'datetime({})'.format(dt.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+
+
+def iter_resource_changes(access_token, subscription_id, since):
+    '''Stream the changes to host groups, hosts and VMs of a subscription since a point in time.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        since (float): POSIX timestamp; only changes after it are returned.
+
+    Returns:
+        A generator of rows with changeTime, targetResourceId and targetResourceType (lower case),
+        oldest first.
+    '''
+    query = ' | '.join([
+        'resourcechanges',
+        'extend changeTime = todatetime(properties.changeAttributes.timestamp), '
+        'targetResourceId = tostring(properties.targetResourceId), '
+        'targetResourceType = tolower(tostring(properties.targetResourceType))',
+        'where changeTime > ' + format_kql_datetime(since),
+        "where targetResourceType in ('{}', '{}', '{}')".format(HOST_GROUP_TYPE, HOST_TYPE, VM_TYPE),
+        'project changeTime, targetResourceId, targetResourceType',
+        'order by changeTime asc'])
+    return iter_resource_graph(access_token, subscription_id, query)
+
+
+def iter_vms_by_id(access_token, subscription_id, vm_ids):
+    '''Stream the current model of a set of VMs through Resource Graph, a batch of ids per query.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        vm_ids (list): VM resource ids. VMs that no longer exist are left out of the result.
+
+    Returns:
+        A generator of VM JSON objects with id, name and properties (hardwareProfile, host, hostGroup).
+    '''
+    vm_ids = list(vm_ids)
+    for start in range(0, len(vm_ids), RESOURCE_GRAPH_ID_BATCH):
+        batch = vm_ids[start:start + RESOURCE_GRAPH_ID_BATCH]
+        query = ' | '.join([
+            'resources',
+            "where type =~ '{}'".format(VM_TYPE),
+            'where id in~ ({})'.format(', '.join("'{}'".format(vm_id.replace("'", "")) for vm_id in batch)),
+            'project id, name, properties'])
+        for row in iter_resource_graph(access_token, subscription_id, query):
+            yield row
+
+
+def restart_vm_endpoint(subscription_id, resource_group, vm_name):
+    '''Endpoint URL used by restart_vm().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines/',
+                    vm_name,
+                    '/restart',
+                    '?api-version=', COMP_API])
+
+
 def restart_vm(access_token, subscription_id, resource_group, vm_name):
     '''Restart a virtual machine.
 
@@ -266,16 +586,21 @@ def restart_vm(access_token, subscription_id, resource_group, vm_name):
     Returns:
         HTTP response.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines/',
-                        vm_name,
-                        '/restart',
-                        '?api-version=', COMP_API])
+    endpoint = restart_vm_endpoint(subscription_id, resource_group, vm_name)
     return do_post(endpoint, '', access_token)
 
 
+def start_vm_endpoint(subscription_id, resource_group, vm_name):
+    '''Endpoint URL used by start_vm().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines/',
+                    vm_name,
+                    '/start',
+                    '?api-version=', COMP_API])
+
+
 def start_vm(access_token, subscription_id, resource_group, vm_name):
     '''Start a virtual machine.
 
@@ -288,16 +613,21 @@ def start_vm(access_token, subscription_id, resource_group, vm_name):
     Returns:
         HTTP response.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines/',
-                        vm_name,
-                        '/start',
-                        '?api-version=', COMP_API])
+    endpoint = start_vm_endpoint(subscription_id, resource_group, vm_name)
     return do_post(endpoint, '', access_token)
 
 
+def stop_vm_endpoint(subscription_id, resource_group, vm_name):
+    '''Endpoint URL used by stop_vm().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines/',
+                    vm_name,
+                    '/powerOff',
+                    '?api-version=', COMP_API])
+
+
 def stop_vm(access_token, subscription_id, resource_group, vm_name):
     '''Stop a virtual machine but don't deallocate resources (power off).
 
@@ -310,16 +640,19 @@ def stop_vm(access_token, subscription_id, resource_group, vm_name):
     Returns:
         HTTP response.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines/',
-                        vm_name,
-                        '/powerOff',
-                        '?api-version=', COMP_API])
+    endpoint = stop_vm_endpoint(subscription_id, resource_group, vm_name)
     return do_post(endpoint, '', access_token)
 
 
+def update_vm_endpoint(subscription_id, resource_group, vm_name):
+    '''Endpoint URL used by update_vm().'''
+    return ''.join([get_rm_endpoint(),
+                    '/subscriptions/', subscription_id,
+                    '/resourceGroups/', resource_group,
+                    '/providers/Microsoft.Compute/virtualMachines/', vm_name,
+                    '?api-version=', COMP_API])
+
+
 def update_vm(access_token, subscription_id, resource_group, vm_name, body):
     '''Update a virtual machine with a new JSON body. E.g. do a GET, change something, call this.
 
@@ -333,11 +666,7 @@ def update_vm(access_token, subscription_id, resource_group, vm_name, body):
     Returns:
         HTTP response.
     '''
-    endpoint = ''.join([get_rm_endpoint(),
-                        '/subscriptions/', subscription_id,
-                        '/resourceGroups/', resource_group,
-                        '/providers/Microsoft.Compute/virtualMachines/', vm_name,
-                        '?api-version=', COMP_API])
+    endpoint = update_vm_endpoint(subscription_id, resource_group, vm_name)
     return do_put(endpoint, body, access_token)
 
 
@@ -349,14 +678,13 @@ def get_access_token(tenant_id, application_id, application_secret):
         application_id (str): Application id of a Service Principal account.
         application_secret (str): Application secret (password) of the Service Principal account.
 
+    The token is cached in memory and on disk, see adh_token.get_token_provider; pass the
+    provider itself to ARM calls to have tokens refreshed during long runs.
+
     Returns:
         An Azure authentication token string.
     '''
-    context = adal.AuthenticationContext(
-        get_auth_endpoint() + tenant_id, api_version=None)
-    token_response = context.acquire_token_with_client_credentials(
-        get_resource_endpoint(), application_id, application_secret)
-    return token_response.get('accessToken')
+    return get_token_provider(tenant_id, application_id, application_secret).get_token()
 
 
 def get_access_token_from_cli():
@@ -374,7 +702,7 @@ def get_access_token_from_cli():
         endpoint = os.environ['MSI_ENDPOINT']
         headers = {'Metadata': 'true'}
         body = {"resource": "https://management.azure.com/"}
-        ret = requests.post(endpoint, headers=headers, data=body)
+        ret = get_session().post(endpoint, headers=headers, data=body)
         return ret.json()['access_token']
 
     else: # not running cloud shell
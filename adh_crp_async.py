@@ -0,0 +1,177 @@
+'''adh_crp_async asyncio CRP wrapper for REST calls
+
+Async counterparts of the functions in adh_crp. Endpoints and request bodies are built by the
+same helpers as the synchronous versions. Every call accepts an optional timeout in seconds.
+'''
+
+from restfns_async import do_delete, do_get, do_get_next, do_patch, do_post, do_put
+from adh_crp import create_dhg_endpoint, create_dhg_body, create_dh_endpoint, create_dh_body, \
+    deallocate_vm_endpoint, get_compute_usage_endpoint, get_vm_endpoint, \
+    get_vm_instance_view_endpoint, list_dhg_endpoint, list_dhg_sub_endpoint, list_dh_endpoint, \
+    get_dh_endpoint, list_vms_endpoint, list_vms_sub_endpoint, restart_vm_endpoint, \
+    start_vm_endpoint, stop_vm_endpoint, update_vm_endpoint
+
+
+async def create_dhg(access_token, subscription_id, resource_group, dhg_name,
+                     az_name, location, timeout=None):
+    '''Create dedicated host group. See adh_crp.create_dhg.
+
+    Returns:
+        HTTP response. JSON body of the dedicated host group properties.
+    '''
+    endpoint = create_dhg_endpoint(subscription_id, resource_group, dhg_name)
+    body = create_dhg_body(az_name, location)
+    return await do_put(endpoint, body, access_token, timeout)
+
+
+async def create_dh(access_token, subscription_id, resource_group, dhg_name,
+                    dh_name, dh_sku, location, fault_domain=None, timeout=None):
+    '''Create dedicated host. See adh_crp.create_dh.
+
+    Returns:
+        HTTP response. JSON body of the dedicated host properties.
+    '''
+    endpoint = create_dh_endpoint(subscription_id, resource_group, dhg_name, dh_name)
+    body = create_dh_body(dh_sku, location, fault_domain)
+    return await do_put(endpoint, body, access_token, timeout)
+
+
+async def deallocate_vm(access_token, subscription_id, resource_group, vm_name, timeout=None):
+    '''Stop-deallocate a virtual machine. See adh_crp.deallocate_vm.
+
+    Returns:
+        HTTP response.
+    '''
+    endpoint = deallocate_vm_endpoint(subscription_id, resource_group, vm_name)
+    return await do_post(endpoint, '', access_token, timeout)
+
+
+async def get_compute_usage(access_token, subscription_id, location, timeout=None):
+    '''List compute usage and limits for a location. See adh_crp.get_compute_usage.
+
+    Returns:
+        HTTP response. JSON body of Compute usage and limits data.
+    '''
+    endpoint = get_compute_usage_endpoint(subscription_id, location)
+    return await do_get(endpoint, access_token, timeout)
+
+
+async def get_vm(access_token, subscription_id, resource_group, vm_name, timeout=None):
+    '''Get virtual machine details. See adh_crp.get_vm.
+
+    Returns:
+        HTTP response. JSON body of VM properties.
+    '''
+    endpoint = get_vm_endpoint(subscription_id, resource_group, vm_name)
+    return await do_get(endpoint, access_token, timeout)
+
+
+async def get_vm_instance_view(access_token, subscription_id, resource_group, vm_name,
+                               timeout=None):
+    '''Get operational details about the state of a VM. See adh_crp.get_vm_instance_view.
+
+    Returns:
+        HTTP response. JSON body of VM instance view details.
+    '''
+    endpoint = get_vm_instance_view_endpoint(subscription_id, resource_group, vm_name)
+    return await do_get(endpoint, access_token, timeout)
+
+
+async def list_dhg(access_token, subscription_id, resource_group, timeout=None):
+    '''List dedicated host groups in a resource_group. See adh_crp.list_dhg.
+
+    Returns:
+        HTTP response. JSON body of the list of dedicated host group properties.
+    '''
+    endpoint = list_dhg_endpoint(subscription_id, resource_group)
+    return await do_get_next(endpoint, access_token, timeout)
+
+
+async def list_dhg_sub(access_token, subscription_id, timeout=None):
+    '''List dedicated host groups in a subscription. See adh_crp.list_dhg_sub.
+
+    Returns:
+        HTTP response. JSON body of the list of dedicated host group properties.
+    '''
+    endpoint = list_dhg_sub_endpoint(subscription_id)
+    return await do_get_next(endpoint, access_token, timeout)
+
+
+async def list_dh(access_token, subscription_id, resource_group, dhg_name, timeout=None):
+    '''List dedicated hosts in a host group. See adh_crp.list_dh.
+
+    Returns:
+        HTTP response. JSON body of the list of dedicated hosts properties.
+    '''
+    endpoint = list_dh_endpoint(subscription_id, resource_group, dhg_name)
+    return await do_get_next(endpoint, access_token, timeout)
+
+
+async def get_dh(access_token, subscription_id, resource_group, dhg_name, dh_name, timeout=None):
+    '''Get a dedicated host and its instance view. See adh_crp.get_dh.
+
+    Returns:
+        HTTP response. JSON body of the dedicated host properties.
+    '''
+    endpoint = get_dh_endpoint(subscription_id, resource_group, dhg_name, dh_name)
+    return await do_get_next(endpoint, access_token, timeout)
+
+
+async def list_vms(access_token, subscription_id, resource_group, timeout=None):
+    '''List VMs in a resource group. See adh_crp.list_vms.
+
+    Returns:
+        HTTP response. JSON body of a list of VM model views.
+    '''
+    endpoint = list_vms_endpoint(subscription_id, resource_group)
+    return await do_get(endpoint, access_token, timeout)
+
+
+async def list_vms_sub(access_token, subscription_id, timeout=None):
+    '''List VMs in a subscription. See adh_crp.list_vms_sub.
+
+    Returns:
+        HTTP response. JSON body of a list of VM model views.
+    '''
+    endpoint = list_vms_sub_endpoint(subscription_id)
+    return await do_get_next(endpoint, access_token, timeout)
+
+
+async def restart_vm(access_token, subscription_id, resource_group, vm_name, timeout=None):
+    '''Restart a virtual machine. See adh_crp.restart_vm.
+
+    Returns:
+        HTTP response.
+    '''
+    endpoint = restart_vm_endpoint(subscription_id, resource_group, vm_name)
+    return await do_post(endpoint, '', access_token, timeout)
+
+
+async def start_vm(access_token, subscription_id, resource_group, vm_name, timeout=None):
+    '''Start a virtual machine. See adh_crp.start_vm.
+
+    Returns:
+        HTTP response.
+    '''
+    endpoint = start_vm_endpoint(subscription_id, resource_group, vm_name)
+    return await do_post(endpoint, '', access_token, timeout)
+
+
+async def stop_vm(access_token, subscription_id, resource_group, vm_name, timeout=None):
+    '''Stop a virtual machine but don't deallocate resources (power off). See adh_crp.stop_vm.
+
+    Returns:
+        HTTP response.
+    '''
+    endpoint = stop_vm_endpoint(subscription_id, resource_group, vm_name)
+    return await do_post(endpoint, '', access_token, timeout)
+
+
+async def update_vm(access_token, subscription_id, resource_group, vm_name, body, timeout=None):
+    '''Update a virtual machine with a new JSON body. See adh_crp.update_vm.
+
+    Returns:
+        HTTP response.
+    '''
+    endpoint = update_vm_endpoint(subscription_id, resource_group, vm_name)
+    return await do_put(endpoint, body, access_token, timeout)
@@ -0,0 +1,92 @@
+'''adh_index.py - placement index over the dedicated host cache'''
+import bisect
+
+
+def location_key(location):
+    '''Index key of a location (case-insensitive).'''
+    return (location or '').lower()
+
+
+def attribute_key(value):
+    '''Index key of a zone or fault domain; None means any.'''
+    if value is None:
+        return None
+    return str(value)
+
+
+class PlacementIndex:
+    '''Hosts that can take a VM size, keyed by (location, zone, fault domain, VM size).
+
+    Every key maps to a list of hosts ordered by rank (best first), ties broken by the order in
+    which hosts were added, i.e. the cache order. Each host is also filed under "any zone" and
+    "any fault domain" keys, so a query without a zone or fault domain is a single lookup too.
+    Hosts with a rank of 0 for a size are not listed for that size.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.hosts = {}
+        self.sequence = 0
+
+    def _keys(self, host_group, host, vm_size):
+        location = location_key(host_group.location)
+        zone = attribute_key(host_group.az)
+        fault_domain = attribute_key(host.fault_domain)
+        return ((location, zone, fault_domain, vm_size),
+                (location, None, fault_domain, vm_size),
+                (location, zone, None, vm_size),
+                (location, None, None, vm_size))
+
+    def add(self, host_group, host):
+        '''Add a host, or re-rank it if it is already indexed.'''
+        if host.id in self.hosts:
+            self.remove(host)
+        self.sequence += 1
+        ranks = {}
+        for vm_size in host.allocatableVMs:
+            rank = host.rank_allocation(vm_size)
+            if rank > 0:
+                ranks[vm_size] = rank
+                for key in self._keys(host_group, host, vm_size):
+                    bisect.insort(self.entries.setdefault(key, []), (-rank, self.sequence, host.id))
+        self.hosts[host.id] = (host_group, host, self.sequence, ranks)
+
+    def remove(self, host):
+        '''Remove a host from every key it is listed under.'''
+        host_group, host, sequence, ranks = self.hosts.pop(host.id)
+        for vm_size, rank in ranks.items():
+            for key in self._keys(host_group, host, vm_size):
+                entries = self.entries[key]
+                del entries[bisect.bisect_left(entries, (-rank, sequence, host.id))]
+                if not entries:
+                    del self.entries[key]
+
+    def update(self, host):
+        '''Re-rank a host after its allocatable VM counts changed, keeping its position among equals.'''
+        host_group, host, sequence, ranks = self.hosts[host.id]
+        self.remove(host)
+        new_ranks = {}
+        for vm_size in host.allocatableVMs:
+            rank = host.rank_allocation(vm_size)
+            if rank > 0:
+                new_ranks[vm_size] = rank
+                for key in self._keys(host_group, host, vm_size):
+                    bisect.insort(self.entries.setdefault(key, []), (-rank, sequence, host.id))
+        self.hosts[host.id] = (host_group, host, sequence, new_ranks)
+
+    def candidates(self, location, zone, fault_domain, vm_size):
+        '''Yield (host group, host, rank) for hosts that can take vm_size, best rank first.
+
+        The walk is over the live index: stop iterating before adding, removing or updating hosts.
+
+        Args:
+            location (str): Azure region. E.g. westus.
+            zone (str): Availability zone (optional, any zone if None)
+            fault_domain (str): Platform fault domain (optional, any fault domain if None)
+            vm_size (str): The size of the VM we wish to place
+        '''
+        key = (location_key(location), attribute_key(zone or None),
+               attribute_key(fault_domain if fault_domain != '' else None), vm_size)
+        for negative_rank, sequence, host_id in self.entries.get(key, ()):
+            host_group, host = self.hosts[host_id][:2]
+            yield host_group, host, -negative_rank
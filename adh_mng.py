@@ -1,26 +1,36 @@
 '''create_vmss.py - simple program to do an imperative VMSS quick create from a platform image'''
 import argparse
+import atexit
 import json
 import sys
 import logging
-import pickle
 import uuid
 
 from adh_return import *
 from adh_crp import *
 from adh_cache import *
+from adh_store import load_snapshot, save_snapshot
+from adh_placement import STRATEGIES, check_vm_requests
+from adh_capacity import GROUP_COLUMNS, format_capacity
+from restfns import wait_for_operation
+from restmetrics import write_metrics
+from adh_server import PlacementService, serve
+from adh_reservation import FileLock, ReservationBook
+from adh_shards import crawl_subscriptions, keep_subscriptions, read_subscriptions, shard_token, update_subscriptions
+from settings import get_crawl_workers, get_host_create_workers, SERVE_PORT, SERVE_REFRESH_INTERVAL
 
 
 log_format = " %(asctime)s [%(levelname)s] %(message)s"
 logger = logging.getLogger('example')
-logging.basicConfig(format=log_format, level=logging.DEBUG)
 default_chache_filename = 'adhcache.txt'
+default_reservation_filename = default_chache_filename + '.reservations'
+default_lock_filename = default_chache_filename + '.lock'
 
 def main():
     '''Main routine.'''
     # validate command line arguments
     arg_parser = argparse.ArgumentParser(prog='dhg_mng')
-    arg_parser.add_argument('cmd', action='store',choices=['analyze', 'recommend', 'create-host'], help = "cmd command to perform")
+    arg_parser.add_argument('cmd', action='store',choices=['analyze', 'refresh', 'sync', 'recommend', 'recommend-batch', 'create-host', 'serve', 'confirm', 'release', 'report'], help = "cmd command to perform")
 
     arg_parser.add_argument('--host', '-hn', required=False, action='store', help='Name of the dedicated host')
     arg_parser.add_argument('--resourcegroup', '-r', action='store', required=False, help='resource-group limit to a specific resource group')
@@ -29,12 +39,47 @@ def main():
     arg_parser.add_argument('--faultdomain', '-fd', action='store', required=False, help='Platform fault domain 0,1, or 2')
     arg_parser.add_argument('--size', '-s', action='store', required=False, help='VM size like Standard_D2s_v3')
     arg_parser.add_argument('--hostgroup', '-hg', required=False,help='name of the host group')
-    arg_parser.add_argument('--hostcount', '-hc', required=False,help='number of hosts to create')
+    arg_parser.add_argument('--hostcount', '-hc', type=int, required=False, default=1, help='number of hosts to create')
     arg_parser.add_argument('--sku', '-sk', required=False, action='store', help='sku select a host sku e.g. DSv3_Type1')
+    arg_parser.add_argument('--input', '-i', required=False, default='-',
+                            help='recommend-batch: JSON list of {"size", "count", "zone", "faultdomain"} requests, - for stdin')
+    arg_parser.add_argument('--strategy', '-st', required=False, default=None, choices=sorted(STRATEGIES),
+                            help='placement strategy for recommend and recommend-batch (default most-allocatable)')
+    arg_parser.add_argument('--workers', '-w', type=int, required=False, default=None,
+                            help='number of parallel requests used to crawl hosts (1 = serial) or hosts created at once')
+    arg_parser.add_argument('--reserve', action='store_true', default=False,
+                            help='recommend: reserve the slot; confirm or release the returned reservation')
+    arg_parser.add_argument('--ttl', type=float, required=False, default=None,
+                            help='recommend --reserve: seconds before an unconfirmed reservation expires')
+    arg_parser.add_argument('--reservation', required=False, default=None,
+                            help='confirm/release: id of the reservation')
+    arg_parser.add_argument('--vm', required=False, default=None,
+                            help='confirm: resource id of the deployed VM; the slot stays taken until the cache shows the VM')
+    arg_parser.add_argument('--port', '-p', type=int, required=False, default=SERVE_PORT,
+                            help='serve: TCP port on 127.0.0.1 of the placement API')
+    arg_parser.add_argument('--socket', required=False, default=None,
+                            help='serve: listen on this Unix socket instead of a TCP port')
+    arg_parser.add_argument('--interval', type=float, required=False, default=SERVE_REFRESH_INTERVAL,
+                            help='serve: seconds between cache refreshes (0 = never)')
+    arg_parser.add_argument('--delta', action='store_true', default=False,
+                            help='serve: refresh the cache with delta syncs from the change feed (see sync)')
+    arg_parser.add_argument('--by', required=False, default='location,zone,fault_domain',
+                            help='report: comma separated grouping, from ' + ','.join(GROUP_COLUMNS))
+    arg_parser.add_argument('--format', required=False, default='table', choices=['table', 'json', 'csv'],
+                            help='report: output format')
+    arg_parser.add_argument('--subscription', required=False, default=None,
+                            help='comma separated subscription ids from azurermconfig.json (default: all of them)')
+    arg_parser.add_argument('--processes', type=int, required=False, default=None,
+                            help='analyze, serve: subscriptions crawled at the same time, each in a process of its own')
+    arg_parser.add_argument('--metrics', required=False, default=None,
+                            help='write the metrics of the ARM calls to this file on exit (.prom: Prometheus text, else JSON)')
     arg_parser.add_argument('--verbose', '-v', action='store_true', default=False,
-                            help='Print operational details')
+                            help='Print operational details (debug logging)')
     args = arg_parser.parse_args()
+    logging.basicConfig(format=log_format, level=logging.DEBUG if args.verbose else logging.INFO)
     logger.debug ("dhg_mng utility")
+    if args.metrics:
+        atexit.register(write_metrics, args.metrics)
 
     command = args.cmd
     location = args.location
@@ -46,32 +91,68 @@ def main():
     vm_size = args.size
     host_sku = args.sku
     host_count = args.hostcount
-
+    max_workers = args.workers
+    input_file = args.input
+    strategy = args.strategy
+    port = args.port
+    socket_path = args.socket
+    refresh_interval = args.interval
+    delta_sync = args.delta
+    reserve = args.reserve
+    ttl = args.ttl
+    reservation_id = args.reservation
+    vm_id = args.vm
+    processes = args.processes
+
+    if command == 'report':
+        # reads the cache file only, no configuration or network needed
+        return report_capacity (location, zone, faultDomain, resource_group, host_group,
+                                tuple(column for column in args.by.split(',') if column), args.format)
     
     # Load Azure app defaults
     try:
         with open('azurermconfig.json') as config_file:
             config_data = json.load(config_file)
     except FileNotFoundError:
-        returnObj.code = -1
-        returnObj.message = "Expecting azurermconfig.json in current folder"
-        return returnObj
+        return ADH_Return(-1,"Expecting azurermconfig.json in current folder")
 
         #logger.error ("Expecting azurermconfig.json in current folder")
         #sys.exit()
 
-    tenant_id = config_data['tenantId']
-    app_id = config_data['appId']
-    app_secret = config_data['appSecret']
-    subscription_id = config_data['subscriptionId']
+    selected = [subscription for subscription in args.subscription.split(',') if subscription] \
+        if args.subscription else None
+    shards = read_subscriptions(config_data, selected)
+    if not shards:
+        return ADH_Return(-1,"No such subscription in azurermconfig.json")
+
+    # commands on a single subscription (create-host, and recommend creating a host) use the first one
+    subscription_id = shards[0]['subscriptionId']
+
+    # authenticate: the provider reuses cached tokens and refreshes them as the run goes on
+    access_token = shard_token(shards[0])
 
-    # authenticate
-    access_token = get_access_token(tenant_id, app_id, app_secret)
+    if max_workers is None:
+        max_workers = get_host_create_workers() if command == 'create-host' else get_crawl_workers()
 
     if command =='analyze':
         logger.debug ("Analyze a DHG:Enter")
-        return analyze_dhg (access_token, subscription_id, location, resource_group, host_group)
+        if len(shards) > 1 or selected:
+            return analyze_subscriptions (shards, location, resource_group, host_group, max_workers, processes,
+                                          bool(selected))
+        return analyze_dhg (access_token, subscription_id, location, resource_group, host_group, max_workers)
         
+    elif command =='refresh':
+        logger.debug ("Refresh the cache:Enter")
+        if len(shards) > 1:
+            return update_dhg (shards, location, resource_group, host_group, max_workers, processes)
+        return refresh_dhg (access_token, subscription_id, location, resource_group, host_group, max_workers)
+
+    elif command =='sync':
+        logger.debug ("Delta sync the cache:Enter")
+        if len(shards) > 1:
+            return update_dhg (shards, location, resource_group, host_group, max_workers, processes, True)
+        return sync_dhg (access_token, subscription_id, location, resource_group, host_group, max_workers)
+
     elif command =='recommend':
         logger.debug ("Recommend VM placement:Enter")
         if not vm_size:
@@ -79,16 +160,34 @@ def main():
         if not location:
             return ADH_Return(-1,"A location is a required parameter for VM recomendation")
 
-        return recommend_vm_placement (access_token, subscription_id, location, zone, faultDomain, vm_size, resource_group, host_group)
+        return recommend_vm_placement (access_token, subscription_id, location, zone, faultDomain, vm_size, resource_group, host_group, strategy, reserve, ttl)
         
+    elif command =='recommend-batch':
+        logger.debug ("Recommend batch VM placement:Enter")
+        if not location:
+            return ADH_Return(-1,"A location is a required parameter for VM recomendation")
+        return recommend_batch_placement (location, resource_group, host_group, input_file, strategy)
+
     elif command == 'create-host':
         logger.debug ("create-host VM placement:Enter")
-        create_host (access_token, subscription_id, location, zone, host_sku, resource_group, host_group, host_name, host_count)
+        returnObj = create_host (access_token, subscription_id, location, zone, faultDomain, host_sku, resource_group, host_group, host_name, host_count, max_workers)
         logger.debug ("create-host VM placement:Exit")
+        return returnObj
+    elif command in ('confirm', 'release'):
+        if not reservation_id:
+            return ADH_Return(-1,"A reservation id is required")
+        return update_reservation (command, reservation_id, vm_id)
+
+    elif command == 'serve':
+        logger.debug ("serve:Enter")
+        service = PlacementService (access_token, subscription_id, location, resource_group, host_group,
+                                    max_workers, default_chache_filename, delta_sync,
+                                    shards if len(shards) > 1 else None, processes)
+        return serve (service, port, socket_path, refresh_interval)
     else:
         logger.warn ("Unsupported operation")
    
-def analyze_dhg (access_token, subscription_id,location, resource_group, host_group):
+def analyze_dhg (access_token, subscription_id,location, resource_group, host_group, max_workers=None):
     '''Analyze a Dedicated Host Group.
 
     Args:
@@ -97,6 +196,7 @@ def analyze_dhg (access_token, subscription_id,location, resource_group, host_gr
         resource_group (str): Azure resource group name.
         location (str): Azure region. E.g. westus.
         host_group (str): A specific dedicated host group to analyze (optional)
+        max_workers (int): Number of parallel requests for the crawl (optional, serial if not set)
 
     Returns:
         Object representation of the dedicated host group.
@@ -125,14 +225,181 @@ def analyze_dhg (access_token, subscription_id,location, resource_group, host_gr
     
     local_cache.update_vm_info(vm_dictionary)
     '''
-    returnObj= local_cache.build_cache (access_token, subscription_id,location, resource_group, host_group)
+    returnObj= local_cache.build_cache (access_token, subscription_id,location, resource_group, host_group, max_workers)
+    if returnObj.code ==0:
+        save_cache (local_cache)
+    return returnObj
+
+def analyze_subscriptions (shards, location, resource_group, host_group, max_workers=None, processes=None,
+                           keep_others=False):
+    '''Analyze the dedicated host groups of several subscriptions, see adh_shards.
+
+    Every subscription is crawled in a worker process of its own and the results are merged into
+    one cache. A subscription whose crawl fails keeps what the previous cache held for it.
+
+    Args:
+        shards (list): Subscriptions and their service principals, see adh_shards.read_subscriptions.
+        resource_group (str): Azure resource group name.
+        location (str): Azure region. E.g. westus.
+        host_group (str): A specific dedicated host group to analyze (optional)
+        max_workers (int): Number of parallel requests for the crawl of each subscription (optional, serial if not set)
+        processes (int): Subscriptions crawled at the same time (optional, see settings)
+        keep_others (bool): Keep the cached subscriptions that are not analyzed, e.g. with --subscription (optional)
+
+    Returns:
+        A return code; not 0 if the crawl of any subscription failed.
+    '''
+    logger.debug ("dhg_mng : analyze_subscriptions.")
+    local_cache, failures = crawl_subscriptions (shards, location, resource_group, host_group, max_workers, processes)
+    if len(failures) == len(shards):
+        return ADH_Return (-1,'analyze failed for every subscription')
+    kept = set(failures)
+    previous = load_cache () if failures or keep_others else None
+    if keep_others and previous is not None:
+        analyzed = set(shard['subscriptionId'].lower() for shard in shards)
+        kept.update(dhg.subscription_id for dhg in previous.host_group_list.values()
+                    if dhg.subscription_id.lower() not in analyzed)
+    keep_subscriptions (local_cache, previous, kept)
+    save_cache (local_cache)
+    if failures:
+        return ADH_Return (-1,'analyze failed for subscriptions: ' + ', '.join(sorted(failures)))
+    return ADH_Return (0,'success')
+
+def update_dhg (shards, location, resource_group, host_group, max_workers=None, processes=None, delta_sync=False):
+    '''Refresh or delta sync the persisted cache of several subscriptions, one after the other.
+
+    Falls back to analyze_subscriptions when there is no cache yet.
+
+    Args:
+        shards (list): Subscriptions and their service principals, see adh_shards.read_subscriptions.
+        resource_group (str): Azure resource group name.
+        location (str): Azure region. E.g. westus.
+        host_group (str): A specific dedicated host group to analyze (optional)
+        max_workers (int): Number of parallel requests (optional, serial if not set)
+        processes (int): Subscriptions crawled at the same time by the analyze fallback (optional)
+        delta_sync (bool): Delta sync instead of refresh, see sync_dhg (optional)
+
+    Returns:
+        A return code; the body summarizes the new, changed, unchanged and deleted hosts.
+    '''
+    logger.debug ("dhg_mng : update_dhg.")
+    local_cache = load_cache ()
+    if local_cache is None:
+        logger.debug ("dhg_mng : no cache to update, running a full analyze")
+        return analyze_subscriptions (shards, location, resource_group, host_group, max_workers, processes)
+    returnObj = update_subscriptions (local_cache, shards, location, resource_group, host_group, max_workers, delta_sync)
+    stats = returnObj.body
+    if len(stats['failed']) < len(shards):
+        save_cache (local_cache)
+    summary = "{} new, {} changed, {} unchanged, {} deleted hosts".format(
+        stats['new'], stats['changed'], stats['unchanged'], stats['deleted'])
+    if stats['mode'] == 'delta':
+        returnObj.body = "{} changes; {}".format(stats['changes'], summary)
+    else:
+        returnObj.body = ("refreshed; " if delta_sync else "") + summary
+    return returnObj
+
+def refresh_dhg (access_token, subscription_id,location, resource_group, host_group, max_workers=None):
+    '''Refresh the persisted cache, re-fetching only new or changed hosts.
+
+    Falls back to a full analyze when there is no cache yet.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        resource_group (str): Azure resource group name.
+        location (str): Azure region. E.g. westus.
+        host_group (str): A specific dedicated host group to analyze (optional)
+        max_workers (int): Number of parallel requests for the crawl (optional, serial if not set)
+
+    Returns:
+        A return code; the body summarizes the new, changed, unchanged and deleted hosts.
+    '''
+    logger.debug ("dhg_mng : refresh_dhg.")
+    local_cache = load_cache ()
+    if local_cache is None:
+        logger.debug ("dhg_mng : no cache to refresh, running a full analyze")
+        return analyze_dhg (access_token, subscription_id, location, resource_group, host_group, max_workers)
+    returnObj = local_cache.refresh_cache (access_token, subscription_id,location, resource_group, host_group, max_workers)
     if returnObj.code ==0:
-        filehandler = open (default_chache_filename,'wb')
-        pickle.dump (local_cache,filehandler)
-        filehandler.close()
+        save_cache (local_cache)
+        stats = returnObj.body
+        returnObj.body = "{} new, {} changed, {} unchanged, {} deleted hosts".format(
+            stats['new'], stats['changed'], stats['unchanged'], stats['deleted'])
     return returnObj
 
-def recommend_vm_placement (access_token, subscription_id, location, zone, faultDomain, vm_size, resource_group, host_group):
+def sync_dhg (access_token, subscription_id,location, resource_group, host_group, max_workers=None):
+    '''Apply the changes since the last analyze, refresh or sync to the persisted cache.
+
+    Reads the Resource Graph change feed and re-fetches only the changed host groups, hosts and
+    VMs. Falls back to a refresh when the cache is too old for the change feed, and to a full
+    analyze when there is no cache yet.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        subscription_id (str): Azure subscription id.
+        resource_group (str): Azure resource group name.
+        location (str): Azure region. E.g. westus.
+        host_group (str): A specific dedicated host group to analyze (optional)
+        max_workers (int): Number of parallel requests (optional, serial if not set)
+
+    Returns:
+        A return code; the body summarizes the changes and the new, changed, unchanged and deleted hosts.
+    '''
+    logger.debug ("dhg_mng : sync_dhg.")
+    local_cache = load_cache ()
+    if local_cache is None:
+        logger.debug ("dhg_mng : no cache to sync, running a full analyze")
+        return analyze_dhg (access_token, subscription_id, location, resource_group, host_group, max_workers)
+    returnObj = local_cache.sync_cache (access_token, subscription_id,location, resource_group, host_group, max_workers)
+    if returnObj.code ==0:
+        save_cache (local_cache)
+        stats = returnObj.body
+        summary = "{} new, {} changed, {} unchanged, {} deleted hosts".format(
+            stats['new'], stats['changed'], stats['unchanged'], stats['deleted'])
+        if stats['mode'] == 'delta':
+            returnObj.body = "{} changes; {}".format(stats['changes'], summary)
+        else:
+            returnObj.body = "refreshed; " + summary
+    return returnObj
+
+def load_cache (filename=default_chache_filename, locations=None, zones=None):
+    '''Load the persisted DedicateHostCache, or return None if there is none.
+
+    Args:
+        filename (str): Path of the snapshot file.
+        locations (list): Only load these locations (optional, all locations if not set).
+        zones (list): Only load these availability zones (optional, all zones if not set).
+    '''
+    try:
+        return load_snapshot (filename, locations, zones)
+    except FileNotFoundError:
+        return None
+
+def save_cache (local_cache, filename=default_chache_filename):
+    '''Persist a DedicateHostCache as a snapshot file (save_snapshot holds the cache lock while it is written).'''
+    save_snapshot (local_cache, filename)
+
+def load_reserved_cache (locations=None, zones=None):
+    '''Load the persisted cache and take the reserved slots off it; call with the cache lock held.
+
+        Args:
+        locations (list): Only load these locations (optional, all locations if not set).
+        zones (list): Only load these availability zones (optional, all zones if not set).
+
+        Returns:
+        The DedicateHostCache (None if there is none) and the ReservationBook.
+    '''
+    local_cache = load_cache (locations=locations, zones=zones)
+    book = ReservationBook.load (default_reservation_filename)
+    book.expire ()
+    if local_cache is not None:
+        # confirmed reservations are dropped by the crawl start times in the cache, not the file
+        # time: a refresh that read the host before the VM landed writes the file after it
+        book.apply (local_cache)
+    return local_cache, book
+
+def recommend_vm_placement (access_token, subscription_id, location, zone, faultDomain, vm_size, resource_group, host_group, strategy=None, reserve=False, ttl=None):
     '''Recommend a VM placement in a dedicated host.
 
         Args:
@@ -144,51 +411,36 @@ def recommend_vm_placement (access_token, subscription_id, location, zone, fault
         faultDomain: Platform fault domain
         vm_size (str): The size of the VM we wish to place 
         host_group (str): A specific dedicated host group to analyze (optional)
+        strategy (str): Placement strategy, see adh_placement (optional)
+        reserve (bool): Reserve the slot until it is confirmed, released or expires (optional)
+        ttl (float): Seconds before an unconfirmed reservation expires (optional, see settings)
 
         Returns:
-        The Id of the best host which can fit the desired VM size.
+        The Id of the best host which can fit the desired VM size; with reserve, a JSON body with
+        the host, reservation id and expiry time.
     '''
 
     logger.debug ("dhg_mng : recommend_vm_placement : Enter.")
-    local_cache = DedicateHostCache()
-    local_cache = pickle.load ( open (default_chache_filename,'rb'))
-
-    candidate_host_dictionary = {}
-
-    for host_grp_id, host_grp in local_cache.host_group_list.items():
-        if location and (host_grp.location != location):
-            logger.debug ("Host group %s does not match location setting", host_grp.name)
-            continue
-        if zone and (host_grp.az != zone):
-            logger.debug ("Host group %s does not match zone setting", host_grp.name)
-            continue
-        if host_group and (host_group.lower() != host_grp.name.lower()):
-            logger.debug ("Host group %s does not match host group ", host_grp.name)
-            continue 
-        if (resource_group and host_grp.resource_group.lower() != resource_group.lower()):
-            logger.debug ("Host group %s does not match resource group setting %s", host_grp.resource_group,resource_group)
-            continue
-        for host_id, host in host_grp.host_list.items():
-            if faultDomain and faultDomain != host.fault_domain:
-                logger.debug ("Host  %s does not fault domain parameter %s", host.id,faultDomain)
-                continue
-            host_ranking = host.rank_allocation (vm_size)
-            if host_ranking >0:
-                candidate_host_dictionary[host.id]=host_ranking
-    
-    best_host = Host()
-
-    if len(candidate_host_dictionary) > 0:
-        best_rank = 0.0
-        for host, ranking in candidate_host_dictionary.items():
-            if ranking > best_rank:
-                best_host = host
-                best_rank = ranking
-                logger.debug ("found new candidate. Rank %d, HostId %s", best_rank, best_host)
-
+    with FileLock (default_lock_filename):
+        # only the partitions of the location (and zone) are read from the cache file
+        local_cache, book = load_reserved_cache (locations=[location], zones=[zone] if zone else None)
+        if local_cache is None:
+            return ADH_Return(-1,"No cache found, run analyze first")
+        if reserve:
+            reserved = book.reserve (local_cache, location, zone, faultDomain, vm_size, resource_group, host_group, strategy, ttl)
+            found = reserved[1:] if reserved is not None else None
+        else:
+            found = local_cache.find_host (location, zone, faultDomain, vm_size, resource_group, host_group, strategy)
+        book.save (default_reservation_filename)
+
+    if found is not None:
+        best_host = found[1].id
         logger.debug ("\n\nBest Host is %s", best_host)
         returnObj = ADH_Return(0,"Success")        
         returnObj.body = best_host 
+        if reserve:
+            returnObj.body = json.dumps ({'host': best_host, 'reservation': reserved[0].id,
+                                         'expires': reserved[0].expires}, indent=2)
         return returnObj
     
     logger.debug ("No hosts are available for this VM size")
@@ -201,34 +453,131 @@ def recommend_vm_placement (access_token, subscription_id, location, zone, fault
         return ADH_Return(-1,"A Resource group is required to create a host.")          
 
     host_name = host_group+str(uuid.uuid4())[:6]    
-    hostReturnStr = create_dh(access_token, subscription_id, resource_group, host_group,host_name, host_sku, location)
+    hostReturnStr = create_dh(access_token, subscription_id, resource_group, host_group,host_name, host_sku, location, faultDomain)
+    status, new_host = wait_for_operation (hostReturnStr, access_token,
+                                           get_dh_endpoint(subscription_id, resource_group, host_group, host_name))
 
-    if hostReturnStr.status_code == 201:
-        new_host = get_dh (access_token,subscription_id,resource_group,host_group,host_name)
+    if status == 'Succeeded':
         returnObj= ADH_Return(0 ,"Success")  
         returnObj.body = new_host["id"]
         return returnObj
 
+    logger.warning ("recommend_vm_placement: host %s %s", host_name, status)
     return ADH_Return(-1,"Failed to create a host")        
 
     
 
-def create_host (access_token, subscription_id, location, zone, faultDomain, sku, resource_group, host_group, host_name, host_count):
+def recommend_batch_placement (location, resource_group, host_group, input_file, strategy=None):
+    '''Plan the placement of a batch of VMs of mixed sizes.
+
+        Every placed VM is taken off the allocatable VM counts of its host before the next one is
+        placed, so the plan never hands out the same slot twice. The cache file is not changed.
+
+        Args:
+        location (str): Azure region. E.g. westus.
+        resource_group (str): Azure resource group name (optional)
+        host_group (str): A specific dedicated host group (optional)
+        input_file (str): JSON file with a list of {"size", "count", "zone", "faultdomain"}, - for stdin
+        strategy (str): Placement strategy, see adh_placement (optional)
+
+        Returns:
+        A JSON plan with the placements and the overflow, including the SKU and number of new hosts needed.
+    '''
+    logger.debug ("dhg_mng : recommend_batch_placement : Enter.")
+    try:
+        if input_file == '-':
+            vm_requests = json.load (sys.stdin)
+        else:
+            with open (input_file) as request_file:
+                vm_requests = json.load (request_file)
+    except (OSError, ValueError) as error:
+        return ADH_Return(-1,"Cannot read the batch requests: " + str(error))
+    error = check_vm_requests (vm_requests)
+    if error is not None:
+        return ADH_Return(-1,"Invalid batch requests: " + error)
+
+    with FileLock (default_lock_filename):
+        local_cache, book = load_reserved_cache (locations=[location])
+    if local_cache is None:
+        return ADH_Return(-1,"No cache found, run analyze first")
+    plan = local_cache.plan_placement (vm_requests, location, resource_group, host_group, strategy)
+    returnObj = ADH_Return(0,"Success")
+    returnObj.body = json.dumps (plan, indent=2)
+    return returnObj
+
+def report_capacity (location, zone, faultDomain, resource_group, host_group, by, output_format='table'):
+    '''Summarize the capacity of the persisted cache, without any call to Azure.
+
+        Args:
+        location, zone, faultDomain, resource_group, host_group: Limit the report to matching hosts (optional)
+        by (tuple): Group by these columns, see adh_capacity.GROUP_COLUMNS
+        output_format (str): table, json or csv
+
+        Returns:
+        Per group: hosts, empty hosts, used and total cores and memory, fragmentation and the
+        number of VMs of every offered size that still fit (each size on its own).
+    '''
+    with FileLock (default_lock_filename):
+        local_cache, book = load_reserved_cache (locations=[location] if location else None,
+                                                 zones=[zone] if zone else None)
+    if local_cache is None:
+        return ADH_Return(-1,"No cache found, run analyze first")
+    view = local_cache.capacity_view ()
+    try:
+        vm_sizes = view.offered_sizes (view.mask (location, zone, faultDomain, resource_group, host_group))
+        rows = view.summary (by, vm_sizes, location, zone, faultDomain, resource_group, host_group)
+    except ValueError as error:
+        return ADH_Return(-1,str(error))
+    returnObj = ADH_Return(0,"Success")
+    returnObj.body = format_capacity (rows, by, vm_sizes, output_format)
+    return returnObj
+
+def update_reservation (command, reservation_id, vm_id=None):
+    '''Confirm or release a reservation made by recommend --reserve.
+
+        Args:
+        command (str): confirm (the VM was deployed) or release (give the slot back)
+        reservation_id (str): Id of the reservation
+        vm_id (str): confirm: resource id of the deployed VM (optional, see ReservationBook.confirm)
+
+        Returns:
+        A return code; the body is the reservation.
+    '''
+    with FileLock (default_lock_filename):
+        book = ReservationBook.load (default_reservation_filename)
+        book.expire ()
+        if command == 'confirm':
+            reservation = book.confirm (reservation_id, vm_id)
+        else:
+            reservation = book.release (None, reservation_id)
+        book.save (default_reservation_filename)
+    if reservation is None:
+        return ADH_Return(-1,"Unknown or expired reservation " + reservation_id)
+    returnObj = ADH_Return(0,"Success")
+    returnObj.body = json.dumps (reservation.to_json(), indent=2)
+    return returnObj
+
+def create_host (access_token, subscription_id, location, zone, faultDomain, sku, resource_group, host_group, host_name, host_count=1, max_workers=None):
     '''Grow the host group by adding hosts.
 
+        The hosts are created in parallel and the call returns once every host has been
+        provisioned or has failed.
+
         Args:
         access_token (str): A valid Azure authentication token.
         subscription_id (str): Azure subscription id.
         resource_group (str): Azure resource group name.
         location (str): Azure region. E.g. westus.
         zone (int): Potential Availability Zone (optional)
+        faultDomain: Platform fault domain of the new hosts (optional)
         hostgroup (str): The name of the group to grow
-        host_name (str): A name for a host to create
+        host_name (str): A name for a host to create, numbered when more than one host is created (optional)
         sku (str): A host SKU to create
-        count (int): How many hosts to create
+        host_count (int): How many hosts to create
+        max_workers (int): How many hosts to create at the same time (optional, see settings)
 
         Returns:
-        A return code 
+        A return code; the body lists the name, status and id of every host.
     '''
     if  location is None or sku is None or resource_group is None or host_group is None:
         logger.warn ("create_host: Mandatory parameters are location, zone, resource_group, host_group")
@@ -237,10 +586,35 @@ def create_host (access_token, subscription_id, location, zone, faultDomain, sku
     if sku not in SKUS.host_skus:
         logger.warn ("create_host: unsupported host sku %s", sku)
         return ADH_Return(-1,"create_host: unsupported host sku") 
+    if host_count is None or host_count < 1:
+        return ADH_Return(-1,"create_host: the host count must be at least 1")
     if host_name is None:
-        host_name = host_group + uuid.uuid1().urn[-6:]
-
-    return create_dh(access_token, subscription_id, resource_group, host_group,host_name, sku, location)
+        host_names = [host_group + uuid.uuid4().hex[:6] for i in range(host_count)]
+    elif host_count == 1:
+        host_names = [host_name]
+    else:
+        host_names = [host_name + str(i) for i in range(host_count)]
+
+    results = create_dhs(access_token, subscription_id, resource_group, host_group, host_names, sku, location,
+                         faultDomain, max_workers)
+    hosts = []
+    failed = 0
+    for name, status, body in results:
+        host = {'name': name, 'status': status}
+        if status == 'Succeeded':
+            host['id'] = body.get('id')
+        else:
+            failed += 1
+            host['error'] = body.get('error', body)
+            logger.warning ("create_host: host %s %s", name, status)
+        hosts.append(host)
+
+    if failed:
+        returnObj = ADH_Return(-1,"create_host: {} of {} hosts were not created".format(failed, len(hosts)))
+    else:
+        returnObj = ADH_Return(0,"Success")
+    returnObj.body = json.dumps (hosts, indent=2)
+    return returnObj
 
 if __name__ == "__main__":
     returnObj = main()
@@ -0,0 +1,525 @@
+'''adh_mockarm.py - local stand-in for the ARM compute endpoints used by adh-mng
+
+Serves a synthetic estate of dedicated host groups, hosts (with instance views) and VMs, so
+analyze, refresh, recommend and create-host can be run and measured without a subscription.
+Point adh-mng at it with the AZURE_RM_ENDPOINT environment variable:
+
+    python adh_mockarm.py --hosts 1000 --port 8800 --latency 0.02 --throttle 0.01
+    export AZURE_RM_ENDPOINT=http://127.0.0.1:8800
+
+Any bearer token is accepted. List calls are paged with nextLink (--page-size); every response
+waits --latency seconds, and a --throttle fraction of calls is answered 429 with Retry-After.
+GETs of ARM resources carry an ETag and are answered 304 when If-None-Match matches it.
+Host creation (PUT) completes through an Azure-AsyncOperation after --create-delay seconds;
+DELETE removes a host or a VM.
+
+Changes made after the estate is built (created and deleted hosts, VMs placed with
+MockEstate.add_vm or removed) are recorded and served by a Resource Graph stand-in,
+POST /providers/Microsoft.ResourceGraph/resources, which answers the two queries adh_crp sends:
+the resourcechanges feed since a datetime, and VMs by id. Results are paged with $skipToken.
+
+One server can serve several estates, each in a subscription of its own (--subscriptions), to
+exercise analyze across subscriptions (see adh_shards).
+
+GET /mockarm/stats returns the request counters (including 304s and body bytes sent),
+DELETE /mockarm/stats resets them.
+'''
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from adh_skus import SKUS
+
+MOCK_SUBSCRIPTION = '00000000-0000-0000-0000-000000000000'
+MOCK_LOCATIONS = ('eastus', 'westus2', 'westeurope')
+MOCK_HOST_SKUS = ('DSv3-Type1', 'ESv3-Type1')
+HOSTS_PER_GROUP = 16
+FAULT_DOMAIN_COUNT = 2
+
+
+def allocatable_vms(host_sku, used_cores, used_mem):
+    '''allocatableVMs of a host with the given cores and memory in use.'''
+    free_cores = SKUS.host_skus[host_sku]['core_count'] - used_cores
+    free_mem = SKUS.host_skus[host_sku]['mem_size'] - used_mem
+    counts = []
+    for vm_size in sorted(SKUS.host_sku_to_vm_skus[host_sku]):
+        vm_sku = SKUS.vm_skus.get(vm_size)
+        if vm_sku is not None:
+            counts.append({'vmSize': vm_size, 'count': max(0, min(free_cores // vm_sku['cpu_count'],
+                                                                  free_mem // vm_sku['mem_size']))})
+    return counts
+
+
+class MockEstate:
+    '''A synthetic set of host groups, hosts and VMs in one subscription.
+
+    Args:
+        hosts (int): Number of dedicated hosts.
+        hosts_per_group (int): Hosts per host group.
+        seed (int): Random seed; the same arguments always produce the same estate.
+        subscription_id (str): Subscription the estate lives in.
+    '''
+
+    def __init__(self, hosts, hosts_per_group=HOSTS_PER_GROUP, seed=0, subscription_id=MOCK_SUBSCRIPTION):
+        self.subscription_id = subscription_id
+        self.groups = []
+        self.hosts = {}
+        self.vms = []
+        # (time, resource id, lower-cased resource type) of every change once the estate is built
+        self.changes = []
+        self.recording = False
+        self.lock = threading.Lock()
+        rand = random.Random(seed)
+        group_count = -(-hosts // hosts_per_group) if hosts else 0
+        for group_number in range(group_count):
+            resource_group = 'adh-rg{}'.format(group_number % 4)
+            group = {'name': 'adh-hg{}'.format(group_number),
+                     'id': self.group_id(resource_group, 'adh-hg{}'.format(group_number)),
+                     'location': MOCK_LOCATIONS[group_number % len(MOCK_LOCATIONS)],
+                     'zones': [str(group_number % 3 + 1)],
+                     'properties': {'platformFaultDomainCount': FAULT_DOMAIN_COUNT, 'hosts': []}}
+            self.groups.append(group)
+            self.hosts[group['name'].lower()] = {}
+            host_sku = MOCK_HOST_SKUS[group_number % len(MOCK_HOST_SKUS)]
+            for host_number in range(min(hosts_per_group, hosts - group_number * hosts_per_group)):
+                self.add_host(group, resource_group, 'adh-h{}-{}'.format(group_number, host_number), host_sku,
+                              host_number % FAULT_DOMAIN_COUNT, rand)
+        self.recording = True
+
+    def group_id(self, resource_group, group_name):
+        return '/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/hostGroups/{}'.format(
+            self.subscription_id, resource_group, group_name)
+
+    def add_host(self, group, resource_group, host_name, host_sku, fault_domain, rand=None):
+        '''Add a host to a group, filled with random VMs if rand is given.'''
+        host_id = group['id'] + '/hosts/' + host_name
+        sizes = sorted(size for size in SKUS.host_sku_to_vm_skus[host_sku] if size in SKUS.vm_skus)
+        used_cores = 0
+        used_mem = 0
+        vm_refs = []
+        target = rand.uniform(0, 0.9) * SKUS.host_skus[host_sku]['core_count'] if rand else 0
+        while rand is not None and used_cores < target:
+            vm_size = rand.choice(sizes[:4])
+            vm_sku = SKUS.vm_skus[vm_size]
+            if used_cores + vm_sku['cpu_count'] > SKUS.host_skus[host_sku]['core_count'] or \
+                    used_mem + vm_sku['mem_size'] > SKUS.host_skus[host_sku]['mem_size']:
+                break
+            used_cores += vm_sku['cpu_count']
+            used_mem += vm_sku['mem_size']
+            vm_name = 'vm-{}-{}'.format(host_name, len(vm_refs))
+            vm_id = '/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines/{}'.format(
+                self.subscription_id, resource_group, vm_name)
+            vm_refs.append({'id': vm_id})
+            self.vms.append({'name': vm_name, 'id': vm_id, 'location': group['location'],
+                             'properties': {'hardwareProfile': {'vmSize': vm_size}, 'host': {'id': host_id}}})
+        # adh_cache reads faultDomain; ARM itself returns platformFaultDomain
+        host = {'name': host_name, 'id': host_id, 'location': group['location'], 'sku': {'name': host_sku},
+                'properties': {'platformFaultDomain': fault_domain, 'faultDomain': fault_domain,
+                               'provisioningState': 'Succeeded', 'virtualMachines': vm_refs},
+                'instanceView': {'availableCapacity': {'allocatableVMs': allocatable_vms(host_sku, used_cores, used_mem)},
+                                 'statuses': [{'code': 'ProvisioningState/succeeded'}, {'code': 'HealthState/available'}]}}
+        with self.lock:
+            self.hosts[group['name'].lower()][host_name.lower()] = host
+            group['properties']['hosts'].append({'id': host_id})
+            self.record(host_id, 'microsoft.compute/hostgroups/hosts')
+        return host
+
+    def record(self, resource_id, resource_type):
+        # called with the lock held
+        if self.recording:
+            self.changes.append((time.time(), resource_id, resource_type))
+
+    def find_host(self, host_id):
+        '''The host JSON object of a host id, or None.'''
+        parts = host_id.lower().split('/')
+        return self.hosts.get(parts[8], {}).get(parts[10]) if len(parts) == 11 else None
+
+    def update_capacity(self, host):
+        '''Recompute the allocatableVMs of a host from the VMs on it; called with the lock held.'''
+        on_host = set(vm_ref['id'].lower() for vm_ref in host['properties']['virtualMachines'])
+        used_cores = 0
+        used_mem = 0
+        for vm in self.vms:
+            if vm['id'].lower() in on_host:
+                vm_sku = SKUS.vm_skus[vm['properties']['hardwareProfile']['vmSize']]
+                used_cores += vm_sku['cpu_count']
+                used_mem += vm_sku['mem_size']
+        host['instanceView']['availableCapacity']['allocatableVMs'] = allocatable_vms(host['sku']['name'],
+                                                                                      used_cores, used_mem)
+
+    def add_vm(self, host_id, vm_size, vm_name=None):
+        '''Place a new VM on a host, as a deployment would; returns the VM JSON object.'''
+        with self.lock:
+            host = self.find_host(host_id)
+            resource_group = _resource_group(host['id'])
+            vm_name = vm_name or 'vm-{}-{}'.format(host['name'], uuid.uuid4().hex[:8])
+            vm_id = '/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/virtualMachines/{}'.format(
+                self.subscription_id, resource_group, vm_name)
+            vm = {'name': vm_name, 'id': vm_id, 'location': host['location'],
+                  'properties': {'hardwareProfile': {'vmSize': vm_size}, 'host': {'id': host['id']}}}
+            self.vms.append(vm)
+            host['properties']['virtualMachines'].append({'id': vm_id})
+            self.update_capacity(host)
+            self.record(vm_id, 'microsoft.compute/virtualmachines')
+        return vm
+
+    def delete_vm(self, vm_id):
+        '''Delete a VM and free its capacity on the host; False if there is no such VM.'''
+        with self.lock:
+            for vm in self.vms:
+                if vm['id'].lower() == vm_id.lower():
+                    break
+            else:
+                return False
+            self.vms.remove(vm)
+            host = self.find_host(vm['properties'].get('host', {}).get('id', ''))
+            if host is not None:
+                host['properties']['virtualMachines'] = [vm_ref for vm_ref in host['properties']['virtualMachines']
+                                                         if vm_ref['id'].lower() != vm_id.lower()]
+                self.update_capacity(host)
+            self.record(vm['id'], 'microsoft.compute/virtualmachines')
+        return True
+
+    def delete_host(self, host_id):
+        '''Delete a host (and the VMs on it); False if there is no such host.'''
+        host = self.find_host(host_id)
+        if host is None:
+            return False
+        for vm_ref in list(host['properties']['virtualMachines']):
+            self.delete_vm(vm_ref['id'])
+        with self.lock:
+            parts = host_id.lower().split('/')
+            del self.hosts[parts[8]][parts[10]]
+            group = self.find_group(parts[8])
+            group['properties']['hosts'] = [host_ref for host_ref in group['properties']['hosts']
+                                            if host_ref['id'].lower() != host['id'].lower()]
+            self.record(host['id'], 'microsoft.compute/hostgroups/hosts')
+        return True
+
+    def query(self, query):
+        '''Rows of a Resource Graph query, or None if it is not one adh_crp sends.'''
+        table = query.split('|', 1)[0].strip().lower()
+        if table == 'resourcechanges':
+            match = re.search(r'\bdatetime\(([^)]+)\)', query)
+            if match is None:
+                return None
+            since = datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S.%fZ').replace(
+                tzinfo=timezone.utc).timestamp()
+            with self.lock:
+                return [{'changeTime': datetime.fromtimestamp(changed, timezone.utc).isoformat(),
+                         'targetResourceId': resource_id, 'targetResourceType': resource_type}
+                        for changed, resource_id, resource_type in self.changes if changed > since]
+        if table == 'resources' and 'id in~' in query:
+            vm_ids = set(vm_id.lower() for vm_id in re.findall(r"'([^']+)'", query.split('id in~', 1)[1]))
+            with self.lock:
+                return [{'id': vm['id'], 'name': vm['name'], 'properties': vm['properties']}
+                        for vm in self.vms if vm['id'].lower() in vm_ids]
+        return None
+
+    def find_group(self, group_name):
+        for group in self.groups:
+            if group['name'].lower() == group_name.lower():
+                return group
+        return None
+
+    def host_count(self):
+        return sum(len(hosts) for hosts in self.hosts.values())
+
+
+def mock_subscription(number):
+    '''Subscription id of the estate with this number; estate 0 is in MOCK_SUBSCRIPTION.'''
+    return '00000000-0000-0000-0000-{:012d}'.format(number)
+
+
+def _resource_group(resource_id):
+    return resource_id.split('/')[4].lower()
+
+
+class MockARMServer(ThreadingHTTPServer):
+    '''The mock ARM HTTP server; see the module docstring for the options.'''
+
+    daemon_threads = True
+
+    def __init__(self, estate, port=0, page_size=100, latency=0.0, throttle=0.0, retry_after=1,
+                 create_delay=1.0, seed=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), MockARMHandler)
+        # a MockEstate, or a list of them in different subscriptions
+        self.estates = list(estate) if isinstance(estate, (list, tuple)) else [estate]
+        self.estate = self.estates[0]
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.create_delay = create_delay
+        self.random = random.Random(seed)
+        self.operations = {}
+        self.counters_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def reset_stats(self):
+        with self.counters_lock:
+            self.counters = {'requests': 0, 'throttled': 0, 'reads': 0, 'writes': 0, 'not_modified': 0,
+                             'bytes': 0}
+
+    def count(self, name, amount=1):
+        with self.counters_lock:
+            self.counters[name] += amount
+
+    def find_estate(self, path):
+        '''The estate of the subscription in a /subscriptions/{id}/... path, or None.'''
+        match = re.match(r'^/subscriptions/([^/]+)', path.lower())
+        if match is None:
+            return None
+        for estate in self.estates:
+            if estate.subscription_id.lower() == match.group(1):
+                return estate
+        return None
+
+    def should_throttle(self):
+        with self.counters_lock:
+            return self.throttle > 0 and self.random.random() < self.throttle
+
+
+class MockARMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes: without TCP_NODELAY every keep-alive call waits on
+    # Nagle and the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode('utf-8')
+        if status == 200 and self.command == 'GET' and self.path.lower().startswith('/subscriptions/'):
+            etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                self.server.count('not_modified')
+                status = 304
+                content = b''
+        self.server.count('bytes', len(content))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('x-ms-ratelimit-remaining-subscription-reads', '11999')
+        self.send_header('x-ms-ratelimit-remaining-subscription-writes', '1199')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if content:
+            self.wfile.write(content)
+
+    def not_found(self, path):
+        self.send_json(404, {'error': {'code': 'ResourceNotFound', 'message': path + ' was not found.'}})
+
+    def send_page(self, url, values):
+        query = parse_qs(url.query)
+        start = int(query.get('$skiptoken', ['0'])[0])
+        page_size = self.server.page_size
+        body = {'value': values[start:start + page_size]}
+        if start + page_size < len(values):
+            query['$skiptoken'] = [str(start + page_size)]
+            body['nextLink'] = '{}{}?{}'.format(self.server.endpoint, url.path, urlencode(query, doseq=True))
+        self.send_json(200, body)
+
+    def begin(self, write):
+        '''Count the call, wait the configured latency, and throttle it; True if it may proceed.'''
+        server = self.server
+        server.count('requests')
+        server.count('writes' if write else 'reads')
+        if server.latency:
+            time.sleep(server.latency)
+        if server.should_throttle():
+            server.count('throttled')
+            self.send_json(429, {'error': {'code': 'TooManyRequests', 'message': 'throttled by adh_mockarm'}},
+                           {'Retry-After': str(server.retry_after)})
+            return False
+        return True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.lower().rstrip('/')
+        server = self.server
+        if path == '/mockarm/stats':
+            return self.send_json(200, dict(server.counters,
+                                            hosts=sum(estate.host_count() for estate in server.estates)))
+        if not self.begin(False):
+            return
+        match = re.match(r'^/mockarm/operations/([\w-]+)$', path)
+        if match:
+            operation = server.operations.get(match.group(1))
+            if operation is None:
+                return self.not_found(url.path)
+            if time.time() < operation:
+                return self.send_json(200, {'status': 'InProgress'}, {'Retry-After': '1'})
+            return self.send_json(200, {'status': 'Succeeded'})
+        estate = server.find_estate(path)
+        if estate is None:
+            return self.not_found(url.path)
+        prefix = '/subscriptions/' + estate.subscription_id.lower()
+        path = path[len(prefix):]
+        if path == '/providers/microsoft.compute/hostgroups':
+            return self.send_page(url, estate.groups)
+        if path == '/providers/microsoft.compute/virtualmachines':
+            return self.send_page(url, estate.vms)
+        match = re.match(r'^/resourcegroups/([^/]+)/providers/microsoft\.compute/(hostgroups|virtualmachines)$', path)
+        if match:
+            values = estate.groups if match.group(2) == 'hostgroups' else estate.vms
+            return self.send_page(url, [value for value in values if _resource_group(value['id']) == match.group(1)])
+        match = re.match(r'^/resourcegroups/([^/]+)/providers/microsoft\.compute/hostgroups/([^/]+)(/hosts(/[^/]+)?)?$', path)
+        if match:
+            group = estate.find_group(match.group(2))
+            if group is None or _resource_group(group['id']) != match.group(1):
+                return self.not_found(url.path)
+            hosts = estate.hosts[group['name'].lower()]
+            if match.group(3) is None:
+                return self.send_json(200, group)
+            if match.group(4) is None:
+                return self.send_page(url, [{name: value for name, value in host.items() if name != 'instanceView'}
+                                            for host in list(hosts.values())])
+            host = hosts.get(match.group(4)[1:])
+            if host is None:
+                return self.not_found(url.path)
+            body = {name: value for name, value in host.items() if name != 'instanceView'}
+            if 'instanceview' in url.query.lower():
+                body['properties'] = dict(body['properties'], instanceView=host['instanceView'])
+            return self.send_json(200, body)
+        self.not_found(url.path)
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        if not self.begin(True):
+            return
+        estate = self.server.find_estate(url.path)
+        match = re.match(r'^/subscriptions/[^/]+/resourcegroups/([^/]+)/providers/microsoft\.compute/hostgroups/([^/]+)/hosts/([^/]+)$',
+                         url.path.lower())
+        group = estate.find_group(match.group(2)) if match and estate else None
+        if group is None:
+            return self.not_found(url.path)
+        host_name = urlparse(self.path).path.split('/')[-1]
+        sku = request.get('sku', {}).get('name')
+        if sku not in SKUS.host_skus:
+            return self.send_json(400, {'error': {'code': 'InvalidParameter', 'message': 'unknown host sku'}})
+        fault_domain = request.get('properties', {}).get('platformFaultDomain', 0)
+        host = estate.add_host(group, match.group(1), host_name, sku, fault_domain)
+        operation_id = str(uuid.uuid4())
+        self.server.operations[operation_id] = time.time() + self.server.create_delay
+        body = {name: value for name, value in host.items() if name != 'instanceView'}
+        body['properties'] = dict(body['properties'], provisioningState='Creating')
+        self.send_json(201, body, {'Azure-AsyncOperation': '{}/mockarm/operations/{}'.format(
+            self.server.endpoint, operation_id)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        if not self.begin(False):
+            return
+        if url.path.lower().rstrip('/') != '/providers/microsoft.resourcegraph/resources':
+            return self.not_found(url.path)
+        subscriptions = set(subscription_id.lower() for subscription_id in request.get('subscriptions', []))
+        rows = []
+        for estate in self.server.estates:
+            if estate.subscription_id.lower() not in subscriptions:
+                continue
+            estate_rows = estate.query(request.get('query', ''))
+            if estate_rows is None:
+                return self.send_json(400, {'error': {'code': 'BadRequest',
+                                                      'message': 'query not supported by adh_mockarm'}})
+            rows.extend(estate_rows)
+        start = int(request.get('options', {}).get('$skipToken') or 0)
+        page_size = self.server.page_size
+        body = {'totalRecords': len(rows), 'count': len(rows[start:start + page_size]),
+                'data': rows[start:start + page_size]}
+        if start + page_size < len(rows):
+            body['$skipToken'] = str(start + page_size)
+        self.send_json(200, body)
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        if path.lower().rstrip('/') == '/mockarm/stats':
+            self.server.reset_stats()
+            return self.send_json(200, {})
+        if not self.begin(True):
+            return
+        estate = self.server.find_estate(path)
+        if estate is None:
+            deleted = False
+        elif re.match(r'^/subscriptions/[^/]+/resourcegroups/[^/]+/providers/microsoft\.compute/hostgroups/[^/]+/hosts/[^/]+$',
+                      path.lower()):
+            deleted = estate.delete_host(path)
+        elif re.match(r'^/subscriptions/[^/]+/resourcegroups/[^/]+/providers/microsoft\.compute/virtualmachines/[^/]+$',
+                      path.lower()):
+            deleted = estate.delete_vm(path)
+        else:
+            deleted = False
+        if not deleted:
+            return self.not_found(path)
+        self.send_json(200, {})
+
+
+def start_mock_arm(estate, port=0, **options):
+    '''Start a MockARMServer on a background thread.
+
+    Args:
+        estate (MockEstate): The estate to serve, or a list of estates in different subscriptions.
+        port (int): TCP port on 127.0.0.1 (optional, any free port if 0).
+        options: page_size, latency, throttle, retry_after, create_delay, seed (see MockARMServer).
+
+    Returns:
+        The running server; its endpoint property is the value for AZURE_RM_ENDPOINT.
+    '''
+    server = MockARMServer(estate, port, **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    '''Run the mock ARM server until interrupted.'''
+    arg_parser = argparse.ArgumentParser(prog='adh_mockarm')
+    arg_parser.add_argument('--hosts', type=int, default=100, help='number of dedicated hosts')
+    arg_parser.add_argument('--hosts-per-group', type=int, default=HOSTS_PER_GROUP, help='hosts per host group')
+    arg_parser.add_argument('--port', type=int, default=8800, help='TCP port on 127.0.0.1')
+    arg_parser.add_argument('--page-size', type=int, default=100, help='items per page of list calls')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    arg_parser.add_argument('--throttle', type=float, default=0.0, help='fraction of calls answered 429')
+    arg_parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of throttled calls')
+    arg_parser.add_argument('--create-delay', type=float, default=1.0, help='seconds until a created host succeeds')
+    arg_parser.add_argument('--seed', type=int, default=0, help='random seed of the estate')
+    arg_parser.add_argument('--subscriptions', type=int, default=1,
+                            help='number of subscriptions, each with an estate of --hosts hosts')
+    args = arg_parser.parse_args()
+
+    estates = [MockEstate(args.hosts, args.hosts_per_group, args.seed + number, mock_subscription(number))
+               for number in range(args.subscriptions)]
+    server = MockARMServer(estates, args.port, page_size=args.page_size, latency=args.latency,
+                           throttle=args.throttle, retry_after=args.retry_after,
+                           create_delay=args.create_delay, seed=args.seed)
+    for estate in estates:
+        print('adh_mockarm: {} hosts in {} groups, subscription {}'.format(
+            estate.host_count(), len(estate.groups), estate.subscription_id))
+    print('export AZURE_RM_ENDPOINT={}'.format(server.endpoint))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
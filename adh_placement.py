@@ -0,0 +1,306 @@
+'''adh_placement.py - placement strategies and bin-packing engine
+
+A strategy ranks hosts for a single VM (Host.rank_allocation) and places batches of VMs
+(DedicateHostCache.plan_placement). Available strategies:
+
+    most-allocatable  the host with the most free slots for the size (the original ranking)
+    best-fit          best-fit-decreasing: the host left with the least free capacity, to
+                      minimize the number of hosts in use
+    worst-fit         the host left with the most free capacity, to spread the load
+    fd-balanced       spread the VMs of a request evenly across fault domains, best-fit within a fault domain
+
+Free capacity is derived from the allocatable VM counts of the host instance view and the
+core/memory data in SKUS.vm_skus / SKUS.host_skus.
+'''
+import heapq
+
+from adh_skus import SKUS
+
+DEFAULT_STRATEGY = 'most-allocatable'
+
+
+def vm_demand(vm_size):
+    '''(cores, memory) of a VM size, or None if the size is not in the SKU catalog.'''
+    vm_sku = SKUS.vm_skus.get(vm_size)
+    if vm_sku is None:
+        return None
+    return vm_sku["cpu_count"], vm_sku["mem_size"]
+
+
+class HostState:
+    '''Free capacity of one host while a batch is being placed.'''
+
+    __slots__ = ('host', 'host_group', 'sequence', 'total_cores', 'total_mem', 'free_cores', 'free_mem')
+
+    def __init__(self, host, host_group=None, sequence=0):
+        self.host = host
+        self.host_group = host_group
+        self.sequence = sequence
+        self.refresh()
+
+    def refresh(self):
+        '''Re-derive the free cores and memory from the allocatable VM counts.
+
+        Every size that still fits claims count x (cores, memory); the largest claim is the free
+        capacity, capped by the host SKU totals.
+        '''
+        free_cores = 0
+        free_mem = 0
+        for vm_size, count in self.host.allocatableVMs.items():
+            demand = vm_demand(vm_size)
+            if demand is not None and count > 0:
+                free_cores = max(free_cores, demand[0] * count)
+                free_mem = max(free_mem, demand[1] * count)
+        host_sku = SKUS.host_skus.get(self.host.sku)
+        if host_sku is not None:
+            self.total_cores = host_sku["core_count"]
+            self.total_mem = host_sku["mem_size"]
+            free_cores = min(free_cores, self.total_cores)
+            free_mem = min(free_mem, self.total_mem)
+        else:
+            self.total_cores = max(free_cores, 1)
+            self.total_mem = max(free_mem, 1)
+        self.free_cores = free_cores
+        self.free_mem = free_mem
+
+    def slots(self, vm_size):
+        return self.host.allocatableVMs.get(vm_size, 0)
+
+    def leftover(self, vm_size):
+        '''Fraction of the host still free after placing one VM of vm_size (dominant resource).'''
+        demand = vm_demand(vm_size)
+        if demand is None:
+            slots = self.slots(vm_size)
+            return float(slots - 1) / slots if slots > 0 else 0.0
+        return max(float(self.free_cores - demand[0]) / self.total_cores,
+                   float(self.free_mem - demand[1]) / self.total_mem)
+
+    def consume(self, vm_size, count):
+        self.host.consume(vm_size, count)
+        self.refresh()
+
+
+class PlacementStrategy:
+    '''Base class of the placement strategies.'''
+
+    name = None
+
+    def rank(self, host, vm_size):
+        '''Rank a host for one VM of vm_size: 0 if it does not fit, higher is better.'''
+        raise NotImplementedError
+
+    def place(self, states, vm_size, count, fd_load):
+        '''Place count VMs of vm_size on the candidate hosts.
+
+        Args:
+            states (list): HostState of the candidate hosts, in cache order
+            vm_size (str): The size of the VMs to place
+            count (int): Number of VMs to place
+            fd_load (dict): VMs of the request placed per (host group id, fault domain) so far;
+                updated as VMs are placed
+
+        Returns:
+            A generator of (HostState, number of VMs placed on it).
+        '''
+        raise NotImplementedError
+
+
+class MostAllocatable(PlacementStrategy):
+    '''Place on the host with the most free slots for the size.'''
+
+    name = 'most-allocatable'
+
+    def rank(self, host, vm_size):
+        return host.allocatableVMs.get(vm_size, 0)
+
+    def place(self, states, vm_size, count, fd_load):
+        heap = [(-state.slots(vm_size), state.sequence, state) for state in states if state.slots(vm_size) > 0]
+        heapq.heapify(heap)
+        while count > 0 and heap:
+            negative_slots, sequence, state = heapq.heappop(heap)
+            state.consume(vm_size, 1)
+            _add_load(fd_load, state, 1)
+            count -= 1
+            yield state, 1
+            if state.slots(vm_size) > 0:
+                heapq.heappush(heap, (-state.slots(vm_size), sequence, state))
+
+
+class BestFit(PlacementStrategy):
+    '''Best-fit-decreasing: fill the host that is left with the least free capacity.
+
+    Identical VMs keep going to the same host until it is full, because it stays the tightest fit.
+    '''
+
+    name = 'best-fit'
+
+    def rank(self, host, vm_size):
+        if host.allocatableVMs.get(vm_size, 0) <= 0:
+            return 0
+        return 2.0 - HostState(host).leftover(vm_size)
+
+    def place(self, states, vm_size, count, fd_load):
+        candidates = [state for state in states if state.slots(vm_size) > 0]
+        while count > 0 and candidates:
+            best = min(candidates, key=lambda state: (state.leftover(vm_size), state.sequence))
+            placed = min(count, best.slots(vm_size))
+            best.consume(vm_size, placed)
+            _add_load(fd_load, best, placed)
+            count -= placed
+            yield best, placed
+            candidates = [state for state in candidates if state.slots(vm_size) > 0]
+
+
+class WorstFit(PlacementStrategy):
+    '''Spread: place on the host that is left with the most free capacity.'''
+
+    name = 'worst-fit'
+
+    def rank(self, host, vm_size):
+        if host.allocatableVMs.get(vm_size, 0) <= 0:
+            return 0
+        return 1.0 + HostState(host).leftover(vm_size)
+
+    def place(self, states, vm_size, count, fd_load):
+        heap = [(-state.leftover(vm_size), state.sequence, state) for state in states if state.slots(vm_size) > 0]
+        heapq.heapify(heap)
+        while count > 0 and heap:
+            negative_leftover, sequence, state = heapq.heappop(heap)
+            state.consume(vm_size, 1)
+            _add_load(fd_load, state, 1)
+            count -= 1
+            yield state, 1
+            if state.slots(vm_size) > 0:
+                heapq.heappush(heap, (-state.leftover(vm_size), sequence, state))
+
+
+class FDBalanced(BestFit):
+    '''Spread the VMs evenly across fault domains, best-fit within the chosen fault domain.
+
+    A single VM can not be balanced on its own, so rank() is the best-fit rank.
+    '''
+
+    name = 'fd-balanced'
+
+    def place(self, states, vm_size, count, fd_load):
+        by_fd = {}
+        for state in states:
+            if state.slots(vm_size) > 0:
+                by_fd.setdefault(_fd_key(state), []).append(state)
+        while count > 0 and by_fd:
+            fault_domain = min(by_fd, key=lambda fd: (fd_load.get(fd, 0), fd))
+            candidates = by_fd[fault_domain]
+            best = min(candidates, key=lambda state: (state.leftover(vm_size), state.sequence))
+            best.consume(vm_size, 1)
+            _add_load(fd_load, best, 1)
+            count -= 1
+            yield best, 1
+            if best.slots(vm_size) <= 0:
+                candidates.remove(best)
+                if not candidates:
+                    del by_fd[fault_domain]
+
+
+def _fd_key(state):
+    # fault domain numbers are per host group: FD 0 of two groups are different fault domains
+    return (state.host_group.id if state.host_group is not None else '', str(state.host.fault_domain))
+
+
+def _add_load(fd_load, state, count):
+    key = _fd_key(state)
+    fd_load[key] = fd_load.get(key, 0) + count
+
+
+STRATEGIES = {strategy.name: strategy for strategy in (MostAllocatable(), BestFit(), WorstFit(), FDBalanced())}
+
+
+def get_strategy(name=None):
+    '''Return the placement strategy registered under name (default: most-allocatable).'''
+    if name is None:
+        name = DEFAULT_STRATEGY
+    if name not in STRATEGIES:
+        raise ValueError('unknown placement strategy {}, expected one of {}'.format(
+            name, ', '.join(sorted(STRATEGIES))))
+    return STRATEGIES[name]
+
+
+def _matches(state, zone, fault_domain):
+    if zone and str(state.host_group.az) != str(zone):
+        return False
+    if fault_domain not in (None, '') and str(state.host.fault_domain) != str(fault_domain):
+        return False
+    return True
+
+
+def check_vm_requests(vm_requests):
+    '''Check a batch of VM requests before it is planned.
+
+    Args:
+        vm_requests: Decoded JSON of the batch, see plan_batch
+
+    Returns:
+        None if the batch is a list of dictionaries, each with a string 'size' and a positive
+        integer 'count' (optional), else a message naming the first bad request.
+    '''
+    if not isinstance(vm_requests, list):
+        return 'expected a list of requests, got {}'.format(type(vm_requests).__name__)
+    for index, request in enumerate(vm_requests):
+        if not isinstance(request, dict):
+            return 'request {}: expected an object, got {}'.format(index, type(request).__name__)
+        if not isinstance(request.get('size'), str):
+            return 'request {}: "size" must be a VM size name'.format(index)
+        count = request.get('count', 1)
+        if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+            return 'request {}: "count" must be a positive integer'.format(index)
+    return None
+
+
+def plan_batch(host_states, vm_requests, strategy=None):
+    '''Assign a batch of VMs to hosts with a placement strategy.
+
+    Requests are placed largest VM size first (decreasing cores, then memory). The allocatable
+    VM counts of the hosts are updated as VMs are placed.
+
+    Args:
+        host_states (list): HostState of the candidate hosts, in cache order
+        vm_requests (list): Dictionaries with 'size', 'count' (default 1) and optional 'zone'
+            and 'faultdomain'
+        strategy (str): Name of the placement strategy (optional, default most-allocatable)
+
+    Returns:
+        A dictionary with the 'placements' (host id, size, count) and the 'overflow' that did not
+        fit, with the host SKU and number of new hosts it would need.
+    '''
+    placement_strategy = get_strategy(strategy)
+
+    def size_order(request):
+        demand = vm_demand(request['size'])
+        return (0, -demand[0], -demand[1]) if demand is not None else (1, 0, 0)
+
+    placements = {}
+    overflow = []
+    sku_catalog = SKUS()
+    for request in sorted(vm_requests, key=size_order):
+        vm_size = request['size']
+        count = int(request.get('count', 1))
+        zone = request.get('zone')
+        fault_domain = request.get('faultdomain')
+        candidates = [state for state in host_states if _matches(state, zone, fault_domain)]
+        placed = 0
+        # fd-balanced spreads the VMs of each request, not the VMs already running
+        fd_load = {}
+        for state, state_count in placement_strategy.place(candidates, vm_size, count, fd_load):
+            key = (state.host.id, vm_size)
+            if key not in placements:
+                placements[key] = {'host': state.host.id, 'host_group': state.host_group.name,
+                                   'zone': state.host_group.az, 'faultdomain': state.host.fault_domain,
+                                   'size': vm_size, 'count': 0}
+            placements[key]['count'] += state_count
+            placed += state_count
+        if placed < count:
+            host_sku = sku_catalog.host_sku_for_vm_size(vm_size)
+            per_host = sku_catalog.vms_per_host(host_sku, vm_size) if host_sku else None
+            overflow.append({'size': vm_size, 'zone': zone, 'faultdomain': fault_domain,
+                             'count': count - placed, 'host_sku': host_sku,
+                             'hosts_needed': -(-(count - placed) // per_host) if per_host else None})
+    return {'placements': list(placements.values()), 'overflow': overflow}
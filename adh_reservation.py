@@ -0,0 +1,252 @@
+'''adh_reservation.py - reservations of host slots handed out by recommend
+
+A reservation takes a slot off a host's allocatable VM counts for a limited time (TTL), so two
+callers that ask for a placement at the same moment get different slots. The caller confirms
+the reservation once the VM is deployed, or releases it to give the slot back. Unconfirmed
+reservations expire after their TTL. A confirmed reservation is kept until the VM shows up in
+the host's own counts: when it was confirmed with the VM id, until the cache lists that VM on
+the host; otherwise until the cache comes from a crawl that started more than the delta sync
+overlap (the change feed lag, see settings) after the confirmation.
+
+The CLI keeps the reservations in a JSON file next to the cache file and serializes access with
+a FileLock; adh_server keeps them in memory under the service lock.
+'''
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from settings import RESERVATION_TTL, get_delta_sync_overlap, get_delta_sync_window
+
+# lock file path -> [thread lock, depth, open lock file] of the FileLocks held in this process
+_held_locks = {}
+_held_locks_guard = threading.Lock()
+
+
+class FileLock:
+    '''An exclusive lock on a file, held between processes (fcntl on POSIX, msvcrt on Windows).
+
+    Re-entrant within a thread: a function that takes the lock, e.g. adh_store.save_snapshot,
+    can be called with it already held.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.filehandler = None
+
+    def __enter__(self):
+        with _held_locks_guard:
+            held = _held_locks.setdefault(os.path.abspath(self.filename), [threading.RLock(), 0, None])
+        held[0].acquire()
+        if held[1] == 0:
+            try:
+                held[2] = open(self.filename, 'a+')
+                if fcntl is not None:
+                    fcntl.flock(held[2].fileno(), fcntl.LOCK_EX)
+                else:
+                    held[2].seek(0)
+                    msvcrt.locking(held[2].fileno(), msvcrt.LK_LOCK, 1)
+            except BaseException:
+                if held[2] is not None:
+                    held[2].close()
+                    held[2] = None
+                held[0].release()
+                raise
+        held[1] += 1
+        self.filehandler = held[2]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _held_locks_guard:
+            held = _held_locks[os.path.abspath(self.filename)]
+        held[1] -= 1
+        if held[1] == 0:
+            if fcntl is not None:
+                fcntl.flock(held[2].fileno(), fcntl.LOCK_UN)
+            else:
+                held[2].seek(0)
+                msvcrt.locking(held[2].fileno(), msvcrt.LK_UNLCK, 1)
+            held[2].close()
+            held[2] = None
+        self.filehandler = None
+        held[0].release()
+
+
+class Reservation:
+    '''count slots of vm_size on a host, held until expires (epoch seconds) unless confirmed.'''
+
+    def __init__(self, reservation_id, host_id, vm_size, count, expires, created=None, confirmed=None,
+                 vm_id=None):
+        self.id = reservation_id
+        self.host_id = host_id
+        self.vm_size = vm_size
+        self.count = count
+        self.expires = expires
+        self.created = time.time() if created is None else created
+        self.confirmed = confirmed
+        self.vm_id = vm_id
+
+    def counted(self, host, crawl_started):
+        '''True if a confirmed reservation is already part of the host's counts in the cache.
+
+        Args:
+            host (Host): The reserved host, as loaded from the cache.
+            crawl_started (float): When the crawl the host was read by started (None if unknown).
+        '''
+        if self.confirmed is None:
+            return False
+        if self.vm_id:
+            if self.vm_id.upper() in host.vm_list:
+                return True
+            # the VM never showed up (e.g. deleted again): give up once the change feed is past it
+            return crawl_started is not None and self.confirmed < crawl_started - get_delta_sync_window()
+        return crawl_started is not None and self.confirmed < crawl_started - get_delta_sync_overlap()
+
+    def to_json(self):
+        return {'id': self.id, 'host': self.host_id, 'size': self.vm_size, 'count': self.count,
+                'expires': self.expires, 'created': self.created, 'confirmed': self.confirmed,
+                'vm': self.vm_id}
+
+    @classmethod
+    def from_json(cls, reservation_json):
+        return cls(reservation_json['id'], reservation_json['host'], reservation_json['size'],
+                   reservation_json['count'], reservation_json['expires'], reservation_json['created'],
+                   reservation_json.get('confirmed'), reservation_json.get('vm'))
+
+
+def _find(local_cache, host_id):
+    entry = local_cache.get_placement_index().hosts.get(host_id)
+    return entry[1] if entry is not None else None
+
+
+class ReservationBook:
+    '''The active reservations, keyed by reservation id.
+
+    The book does not lock; callers hold a FileLock or the lock of the cache it is used with.
+    '''
+
+    def __init__(self):
+        self.reservations = {}
+
+    def reserve(self, local_cache, location, zone, fault_domain, vm_size, resource_group=None,
+                host_group=None, strategy=None, ttl=None):
+        '''Find the best host for a VM and reserve the slot.
+
+        Returns:
+            (Reservation, HostGroup, Host), or None if no host has room.
+        '''
+        found = local_cache.place_vm(location, zone, fault_domain, vm_size, resource_group, host_group, strategy)
+        if found is None:
+            return None
+        return self.add(found[1].id, vm_size, 1, ttl), found[0], found[1]
+
+    def add(self, host_id, vm_size, count=1, ttl=None):
+        '''Reserve slots the caller already took off the host.
+
+        Returns:
+            The new Reservation.
+        '''
+        if ttl is None:
+            ttl = RESERVATION_TTL
+        reservation = Reservation(uuid.uuid4().hex, host_id, vm_size, count, time.time() + ttl)
+        self.reservations[reservation.id] = reservation
+        return reservation
+
+    def confirm(self, reservation_id, vm_id=None):
+        '''Mark a reservation as deployed; the slot stays taken.
+
+        Args:
+            reservation_id (str): Id of the reservation.
+            vm_id (str): Resource id of the deployed VM (optional); the reservation is then kept
+                until the cache lists the VM on the host.
+
+        Returns:
+            The Reservation, or None if it does not exist (expired or released).
+        '''
+        reservation = self.reservations.get(reservation_id)
+        if reservation is not None and reservation.confirmed is None:
+            reservation.confirmed = time.time()
+        if reservation is not None and vm_id:
+            reservation.vm_id = vm_id
+        return reservation
+
+    def release(self, local_cache, reservation_id):
+        '''Drop a reservation and give its slot back to the host.
+
+        Returns:
+            The Reservation, or None if it does not exist.
+        '''
+        reservation = self.reservations.pop(reservation_id, None)
+        if reservation is not None and local_cache is not None:
+            host = _find(local_cache, reservation.host_id)
+            if host is not None:
+                host.consume(reservation.vm_size, -reservation.count)
+                local_cache.placement_index.update(host)
+        return reservation
+
+    def expire(self, local_cache=None, now=None):
+        '''Release the unconfirmed reservations whose TTL has passed.
+
+        Args:
+            local_cache (DedicateHostCache): The cache the reservations were applied to (optional).
+
+        Returns:
+            The list of expired reservations.
+        '''
+        if now is None:
+            now = time.time()
+        expired = [reservation for reservation in self.reservations.values()
+                   if reservation.confirmed is None and reservation.expires <= now]
+        for reservation in expired:
+            self.release(local_cache, reservation.id)
+        return expired
+
+    def apply(self, local_cache, crawl_started=None):
+        '''Take the reserved slots off a cache that was just loaded.
+
+        Confirmed reservations the cache already counts (see Reservation.counted) are dropped.
+        Reservations of hosts that are not in the cache (e.g. not loaded) are kept as they are.
+
+        Args:
+            local_cache (DedicateHostCache): The cache.
+            crawl_started (float): When the crawl of the cache started (optional, the sync time of
+                the host's subscription, local_cache.synced, if not set).
+        '''
+        synced = getattr(local_cache, 'synced', None) or {}
+        for reservation in list(self.reservations.values()):
+            host = _find(local_cache, reservation.host_id)
+            if host is None:
+                continue
+            started = crawl_started if crawl_started is not None else synced.get(host.subscription_id)
+            if reservation.counted(host, started):
+                del self.reservations[reservation.id]
+                continue
+            host.consume(reservation.vm_size, reservation.count)
+            local_cache.placement_index.update(host)
+
+    def save(self, filename):
+        '''Write the reservations to a JSON file.'''
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as reservation_file:
+            json.dump([reservation.to_json() for reservation in self.reservations.values()], reservation_file)
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''Read the reservations from a JSON file; an empty book if there is none.'''
+        book = cls()
+        try:
+            with open(filename) as reservation_file:
+                for reservation_json in json.load(reservation_file):
+                    reservation = Reservation.from_json(reservation_json)
+                    book.reservations[reservation.id] = reservation
+        except FileNotFoundError:
+            pass
+        return book
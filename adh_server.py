@@ -0,0 +1,588 @@
+'''adh_server.py - long running placement service with a warm in-memory cache
+
+adh_mng.py serve keeps a DedicateHostCache in memory, refreshes it on a schedule and answers
+requests over a local HTTP API (TCP on 127.0.0.1, or a Unix socket):
+
+    GET  /health                                  cache statistics
+    GET  /capacity?[by=location,zone&size=a,b&location=&zone=&faultdomain=&resourcegroup=&hostgroup=]
+                                                  capacity totals per group (see adh_capacity)
+    GET  /metrics                                 ARM call metrics, Prometheus text (see restmetrics)
+    GET  /recommend?location=&size=[&zone=&faultdomain=&resourcegroup=&hostgroup=&strategy=&reserve=&ttl=]
+    POST /confirm?reservation=[&vm=]              the reserved VM was deployed
+    POST /release?reservation=                    give a reserved slot back
+    POST /recommend-batch?location=[&resourcegroup=&hostgroup=&strategy=]   body: list of requests
+    POST /analyze                                 rebuild the cache from ARM
+    POST /refresh                                 incremental refresh (a delta sync with serve --delta)
+    POST /create-host                             body: {"location", "sku", "resourcegroup",
+                                                  "hostgroup", "hostcount", "faultdomain", "host"}
+
+Responses are JSON; errors use the ARM error shape {"error": {"code", "message"}}.
+
+Every recommendation takes the slot off the host's allocatable VM counts under the cache lock, so
+concurrent callers never get the same slot; with reserve=1 the slot is held as a reservation
+(see adh_reservation) that returns to the host unless it is confirmed within its TTL. A slot
+recommended without a reservation is held for the placement hold (see settings), long enough for
+the VM to show up in the host's instance view. Refreshes crawl a copy of the cache outside the
+lock; the reservations and holds are applied again to the hosts the refresh re-read.
+
+When no host has room, recommend creates one host per host group and SKU at a time: concurrent
+callers wait for it, and the new host is added to the cache with the caller's slot taken.
+'''
+import copy
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from adh_cache import DedicateHostCache
+from adh_crp import create_dhs
+from adh_placement import check_vm_requests
+from adh_reservation import ReservationBook
+from adh_shards import crawl_subscriptions, keep_subscriptions, update_subscriptions
+from adh_return import ADH_Return
+from adh_skus import SKUS
+from adh_store import load_snapshot, save_snapshot
+from restfns import RestError
+from restmetrics import get_metrics
+from settings import get_placement_hold
+
+logger = logging.getLogger('example')
+
+
+class PlacementService:
+    '''The warm cache and the operations of the placement API.
+
+    Args:
+        access_token: A token provider (see adh_token) or token string.
+        subscription_id (str): Azure subscription id.
+        location (str): Limit the cache to a location (optional).
+        resource_group (str): Limit the cache to a resource group (optional).
+        host_group (str): Limit the cache to a host group (optional).
+        max_workers (int): Number of parallel requests for crawls (optional).
+        cache_file (str): Snapshot file loaded at start and written after each refresh (optional).
+        delta_sync (bool): Refresh with DedicateHostCache.sync_cache instead of refresh_cache (optional).
+        shards (list): Crawl these subscriptions instead of subscription_id, see adh_shards (optional).
+        processes (int): Subscriptions crawled at the same time (optional, see settings).
+    '''
+
+    def __init__(self, access_token, subscription_id, location=None, resource_group=None,
+                 host_group=None, max_workers=None, cache_file=None, delta_sync=False, shards=None,
+                 processes=None):
+        self.access_token = access_token
+        self.subscription_id = subscription_id
+        self.location = location
+        self.resource_group = resource_group
+        self.host_group = host_group
+        self.max_workers = max_workers
+        self.cache_file = cache_file
+        self.delta_sync = delta_sync
+        self.shards = shards
+        self.processes = processes
+        self.cache = None
+        self.refreshed = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.book = ReservationBook()
+        # slots recommended without a reservation, see _hold
+        self.holds = ReservationBook()
+        # ids of the holds whose host a crawl re-read after the slot was taken
+        self.reread = set()
+        # (resource group, host group, host SKU) -> Event set once the host being created is in the cache
+        self.creating = {}
+        self.pending = None
+        self.created = None
+        self.crawl_memo = None
+        self.crawl_started = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        '''Load the snapshot file, or crawl ARM if there is none.'''
+        if self.cache_file and os.path.exists(self.cache_file):
+            local_cache = load_snapshot(self.cache_file)
+            local_cache.build_index()
+            self.cache = local_cache
+            self.refreshed = os.path.getmtime(self.cache_file)
+            return ADH_Return(0, 'success')
+        return self.analyze()
+
+    def _crawl(self, full):
+        with self.refresh_lock:
+            with self.lock:
+                self.crawl_memo = {}
+                self.crawl_started = time.time()
+                if full or self.cache is None:
+                    # a subscription whose crawl fails keeps its part of the current cache
+                    working = copy.deepcopy(self.cache, self.crawl_memo) \
+                        if self.shards and self.cache is not None else DedicateHostCache()
+                else:
+                    working = copy.deepcopy(self.cache, self.crawl_memo)
+                self.pending = []
+                self.created = []
+            try:
+                if (full or self.cache is None) and self.shards:
+                    previous = working
+                    working, failures = crawl_subscriptions(self.shards, self.location, self.resource_group,
+                                                            self.host_group, self.max_workers, self.processes)
+                    keep_subscriptions(working, previous, failures)
+                    if len(failures) == len(self.shards):
+                        returnObj = ADH_Return(-1, 'analyze failed for every subscription')
+                    else:
+                        returnObj = ADH_Return(0, 'success')
+                        returnObj.body = {'failed': sorted(failures)}
+                elif full or self.cache is None:
+                    returnObj = working.build_cache(self.access_token, self.subscription_id, self.location,
+                                                    self.resource_group, self.host_group, self.max_workers)
+                elif self.shards:
+                    returnObj = update_subscriptions(working, self.shards, self.location, self.resource_group,
+                                                     self.host_group, self.max_workers, self.delta_sync)
+                    if len(returnObj.body['failed']) < len(self.shards):
+                        returnObj.code = 0
+                else:
+                    update = working.sync_cache if self.delta_sync else working.refresh_cache
+                    returnObj = update(self.access_token, self.subscription_id, self.location,
+                                       self.resource_group, self.host_group, self.max_workers)
+            except Exception:
+                with self.lock:
+                    self.pending = None
+                    self.created = None
+                raise
+            with self.lock:
+                pending, self.pending = self.pending, None
+                created, self.created = self.created, None
+                if returnObj.code != 0:
+                    return returnObj
+                self._rebase(working, pending, created)
+                self.cache = working
+                self.refreshed = time.time()
+            if self.cache_file:
+                save_snapshot(working, self.cache_file)
+            return returnObj
+
+    def _rebase(self, working, pending, created):
+        # Called with the lock held. A host the refresh did not re-read is a copy of the current
+        # host and already carries the slots taken before the crawl started.
+        index = working.get_placement_index()
+
+        def copied(host_id, new_host):
+            old = self.cache.get_placement_index().hosts.get(host_id) if self.cache is not None else None
+            return old is not None and self.crawl_memo.get(id(old[1])) is new_host
+
+        # hosts created while the crawl ran, if it listed their group before they existed
+        for host_json in created:
+            if host_json['id'] not in index.hosts:
+                working.add_host(host_json)
+        # slots taken before the crawl started and given back while it ran
+        for host_id, vm_size, count in pending:
+            entry = index.hosts.get(host_id)
+            if entry is not None and copied(host_id, entry[1]):
+                entry[1].consume(vm_size, -count)
+                index.update(entry[1])
+        for reservation in list(self.book.reservations.values()):
+            entry = index.hosts.get(reservation.host_id)
+            if entry is None or reservation.counted(entry[1], self.crawl_started):
+                del self.book.reservations[reservation.id]
+                continue
+            if reservation.created < self.crawl_started and copied(reservation.host_id, entry[1]):
+                continue
+            entry[1].consume(reservation.vm_size, reservation.count)
+            index.update(entry[1])
+        for hold in list(self.holds.reservations.values()):
+            entry = index.hosts.get(hold.host_id)
+            if entry is None:
+                del self.holds.reservations[hold.id]
+                self.reread.discard(hold.id)
+                continue
+            if copied(hold.host_id, entry[1]):
+                if hold.created < self.crawl_started:
+                    continue
+            else:
+                self.reread.add(hold.id)
+            entry[1].consume(hold.vm_size, hold.count)
+            index.update(entry[1])
+
+    def analyze(self):
+        '''Rebuild the cache from ARM.'''
+        return self._crawl(True)
+
+    def refresh(self):
+        '''Refresh the cache, re-fetching only new or changed hosts (delta sync if enabled).'''
+        return self._crawl(False)
+
+    def _hold(self, host_id, vm_size, count=1):
+        # Called with the lock held, after the slots were taken off the host. Without a
+        # reservation the caller never confirms, so the slots are held until the VMs can be in
+        # the host's instance view; _rebase takes them off every host a refresh re-reads.
+        self.holds.add(host_id, vm_size, count, get_placement_hold())
+
+    def _give_back(self, reservation):
+        # called with the lock held
+        entry = self.cache.get_placement_index().hosts.get(reservation.host_id)
+        if entry is not None:
+            entry[1].consume(reservation.vm_size, -reservation.count)
+            self.cache.placement_index.update(entry[1])
+        if self.pending is not None and reservation.created < self.crawl_started:
+            # the copy a running refresh started from took the slot too
+            self.pending.append((reservation.host_id, reservation.vm_size, reservation.count))
+
+    def _expire(self):
+        # called with the lock held
+        for reservation in self.book.expire():
+            logger.debug ("adh_server: reservation %s expired", reservation.id)
+            self._give_back(reservation)
+        for hold in self.holds.expire():
+            # Only the count of a host re-read since the slot was taken is known to be off by the
+            # hold. A host nobody re-read keeps the slot: the VM may be on it, and the refresh
+            # that re-reads the host once the VM shows up (or not) has the real count.
+            if hold.id in self.reread:
+                self.reread.discard(hold.id)
+                self._give_back(hold)
+
+    def recommend(self, location, zone, fault_domain, vm_size, resource_group=None, host_group=None,
+                  strategy=None, reserve=False, ttl=None):
+        '''Recommend a host for a VM and take the slot, creating a host when none has room.
+
+        Only one host is created per host group and SKU at a time; callers that find no room
+        while it is being created wait for it and place on it.
+
+        Returns:
+            ADH_Return; body is {"host": host id, "created": True if a new host was created}, plus
+            "reservation" and "expires" if reserve is set.
+        '''
+        while True:
+            with self.lock:
+                self._expire()
+                found, reservation = self._take(location, zone, fault_domain, vm_size, resource_group,
+                                                host_group, strategy, reserve, ttl)
+                if found is None:
+                    host_sku = SKUS().host_sku_for_vm_size(vm_size)
+                    if host_sku is None:
+                        return ADH_Return(-1, "Required VM size is not supported.")
+                    if host_group is None:
+                        return ADH_Return(-1, "A Host group is required to create a host.")
+                    if resource_group is None:
+                        return ADH_Return(-1, "A Resource group is required to create a host.")
+                    key = (resource_group.lower(), host_group.lower(), host_sku)
+                    creation = self.creating.get(key)
+                    creator = creation is None
+                    if creator:
+                        creation = self.creating[key] = threading.Event()
+            if found is not None:
+                return self._recommended(found[1].id, False, reservation)
+            if creator:
+                break
+            creation.wait()
+
+        try:
+            return self._create_and_take(location, fault_domain, vm_size, resource_group, host_group, host_sku,
+                                         reserve, ttl)
+        finally:
+            with self.lock:
+                del self.creating[key]
+            creation.set()
+
+    def _take(self, location, zone, fault_domain, vm_size, resource_group, host_group, strategy, reserve, ttl):
+        # called with the lock held: ((HostGroup, Host), Reservation or None), or (None, None)
+        if reserve:
+            reserved = self.book.reserve(self.cache, location, zone, fault_domain, vm_size,
+                                         resource_group, host_group, strategy, ttl)
+            if reserved is None:
+                return None, None
+            return reserved[1:], reserved[0]
+        found = self.cache.place_vm(location, zone, fault_domain, vm_size, resource_group, host_group, strategy)
+        if found is not None:
+            self._hold(found[1].id, vm_size)
+        return found, None
+
+    def _recommended(self, host_id, created, reservation):
+        returnObj = ADH_Return(0, 'Success')
+        returnObj.body = {'host': host_id, 'created': created}
+        if reservation is not None:
+            returnObj.body['reservation'] = reservation.id
+            returnObj.body['expires'] = reservation.expires
+        return returnObj
+
+    def _create_and_take(self, location, fault_domain, vm_size, resource_group, host_group, host_sku, reserve, ttl):
+        # create a host outside the lock, then add it to the cache and take the caller's slot
+        host_name = host_group + str(uuid.uuid4())[:6]
+        name, status, new_host = create_dhs(self.access_token, self.subscription_id, resource_group, host_group,
+                                            [host_name], host_sku, location, fault_domain)[0]
+        if status != 'Succeeded':
+            logger.warning ("adh_server: host %s %s", host_name, status)
+            return ADH_Return(-1, "Failed to create a host")
+        reservation = None
+        with self.lock:
+            if self.created is not None:
+                self.created.append(new_host)
+            added = self.cache.add_host(new_host)
+            if added is None:
+                logger.warning ("adh_server: host group of the new host %s is not in the cache", new_host['id'])
+            elif added[1].allocatableVMs.get(vm_size, 0) > 0:
+                added[1].consume(vm_size)
+                self.cache.placement_index.update(added[1])
+                if reserve:
+                    reservation = self.book.add(added[1].id, vm_size, 1, ttl)
+                else:
+                    self._hold(added[1].id, vm_size)
+            else:
+                logger.warning ("adh_server: the new host %s has no room for %s", new_host['id'], vm_size)
+        return self._recommended(new_host['id'], True, reservation)
+
+    def confirm(self, reservation_id, vm_id=None):
+        '''Confirm a reservation: the VM was deployed and keeps its slot (see ReservationBook.confirm).'''
+        with self.lock:
+            reservation = self.book.confirm(reservation_id, vm_id)
+        if reservation is None:
+            return ADH_Return(-1, "Unknown or expired reservation " + str(reservation_id))
+        returnObj = ADH_Return(0, 'Success')
+        returnObj.body = reservation.to_json()
+        return returnObj
+
+    def release(self, reservation_id):
+        '''Release a reservation and give its slot back.'''
+        with self.lock:
+            reservation = self.book.release(None, reservation_id)
+            if reservation is not None:
+                self._give_back(reservation)
+        if reservation is None:
+            return ADH_Return(-1, "Unknown or expired reservation " + str(reservation_id))
+        returnObj = ADH_Return(0, 'Success')
+        returnObj.body = reservation.to_json()
+        return returnObj
+
+    def recommend_batch(self, vm_requests, location, resource_group=None, host_group=None, strategy=None):
+        '''Plan a batch of VMs and take the planned slots (held as for recommend without reserve).
+
+        Returns:
+            ADH_Return; body is the plan, see DedicateHostCache.plan_placement.
+        '''
+        # reject a malformed batch up front instead of failing inside plan_placement
+        error = check_vm_requests(vm_requests)
+        if error is not None:
+            return ADH_Return(-1, 'Invalid batch requests: ' + error)
+        with self.lock:
+            self._expire()
+            plan = self.cache.plan_placement(vm_requests, location, resource_group, host_group, strategy)
+            for placement in plan['placements']:
+                self._hold(placement['host'], placement['size'], placement['count'])
+        returnObj = ADH_Return(0, 'Success')
+        returnObj.body = plan
+        return returnObj
+
+    def create_host(self, location, sku, resource_group, host_group, host_count=1, fault_domain=None,
+                    host_name=None):
+        '''Create hosts in parallel and wait for them; the next refresh adds them to the cache.
+
+        Returns:
+            ADH_Return; body lists the name, status and id of every host.
+        '''
+        if location is None or sku is None or resource_group is None or host_group is None:
+            return ADH_Return(-1, "create_host: Mandatory parameters are location, sku, resourcegroup, hostgroup")
+        if sku not in SKUS.host_skus:
+            return ADH_Return(-1, "create_host: unsupported host sku")
+        if host_name is None:
+            host_names = [host_group + uuid.uuid4().hex[:6] for i in range(host_count)]
+        elif host_count == 1:
+            host_names = [host_name]
+        else:
+            host_names = [host_name + str(i) for i in range(host_count)]
+        results = create_dhs(self.access_token, self.subscription_id, resource_group, host_group, host_names,
+                             sku, location, fault_domain)
+        hosts = [{'name': name, 'status': status, 'id': body.get('id')} if status == 'Succeeded'
+                 else {'name': name, 'status': status, 'error': body.get('error', body)}
+                 for name, status, body in results]
+        failed = sum(1 for host in hosts if host['status'] != 'Succeeded')
+        if failed:
+            returnObj = ADH_Return(-1, "create_host: {} of {} hosts were not created".format(failed, len(hosts)))
+        else:
+            returnObj = ADH_Return(0, 'Success')
+        returnObj.body = hosts
+        return returnObj
+
+    def health(self):
+        '''Cache statistics.'''
+        with self.lock:
+            if self.cache is not None:
+                self._expire()
+            groups = list(self.cache.host_group_list.values()) if self.cache is not None else []
+            returnObj = ADH_Return(0, 'Success')
+            returnObj.body = {'host_groups': len(groups),
+                              'hosts': sum(len(dhg.host_list) for dhg in groups),
+                              'reservations': len(self.book.reservations),
+                              'holds': len(self.holds.reservations),
+                              'refreshed': self.refreshed}
+        return returnObj
+
+    def capacity(self, by=('location',), vm_sizes=(), location=None, zone=None, fault_domain=None,
+                 resource_group=None, host_group=None):
+        '''Capacity summary of the cached hosts, see adh_capacity.CapacityView.summary.'''
+        with self.lock:
+            if self.cache is None:
+                return ADH_Return(-1, "No cache found, run analyze first")
+            self._expire()
+            summary = self.cache.capacity_view().summary(by, vm_sizes, location, zone, fault_domain,
+                                                         resource_group, host_group)
+        returnObj = ADH_Return(0, 'Success')
+        returnObj.body = summary
+        return returnObj
+
+    def run_refresh(self, interval):
+        '''Refresh the cache every interval seconds until stop() is called.'''
+        while not self.stopping.wait(interval):
+            try:
+                returnObj = self.refresh()
+                if returnObj.code != 0:
+                    logger.warning ("adh_server: scheduled refresh failed: %s", returnObj.message)
+            except Exception:
+                # keep serving from the current cache; the next refresh tries again
+                logger.exception ("adh_server: scheduled refresh failed")
+
+    def stop(self):
+        self.stopping.set()
+
+
+class PlacementRequestHandler(BaseHTTPRequestHandler):
+    '''Maps the HTTP API onto the PlacementService of the server.'''
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logger.debug ("adh_server: %s " + format, self.address_string(), *args)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_text(self, status, text):
+        content = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_result(self, returnObj):
+        if returnObj.code == 0:
+            self.send_json(200, returnObj.body)
+        else:
+            self.send_json(400, {'error': {'code': 'BadRequest', 'message': returnObj.message}})
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        service = self.server.service
+        try:
+            if method == 'GET' and url.path == '/health':
+                return self.send_result(service.health())
+            if method == 'GET' and url.path == '/capacity':
+                return self.send_result(service.capacity(
+                    tuple(column for column in params.get('by', 'location').split(',') if column),
+                    tuple(size for size in params.get('size', '').split(',') if size),
+                    params.get('location'), params.get('zone'), params.get('faultdomain'),
+                    params.get('resourcegroup'), params.get('hostgroup')))
+            if method == 'GET' and url.path == '/metrics':
+                return self.send_text(200, get_metrics().to_prometheus())
+            if method == 'GET' and url.path == '/recommend':
+                if not params.get('size') or not params.get('location'):
+                    return self.send_result(ADH_Return(-1, "size and location are required parameters"))
+                return self.send_result(service.recommend(
+                    params['location'], params.get('zone'), params.get('faultdomain'), params['size'],
+                    params.get('resourcegroup'), params.get('hostgroup'), params.get('strategy'),
+                    params.get('reserve', '').lower() in ('1', 'true', 'yes'),
+                    float(params['ttl']) if params.get('ttl') else None))
+            if method == 'POST' and url.path == '/confirm':
+                return self.send_result(service.confirm(params.get('reservation'), params.get('vm')))
+            if method == 'POST' and url.path == '/release':
+                return self.send_result(service.release(params.get('reservation')))
+            if method == 'POST' and url.path == '/recommend-batch':
+                if not params.get('location'):
+                    return self.send_result(ADH_Return(-1, "location is a required parameter"))
+                return self.send_result(service.recommend_batch(
+                    self.read_json(), params['location'], params.get('resourcegroup'),
+                    params.get('hostgroup'), params.get('strategy')))
+            if method == 'POST' and url.path == '/analyze':
+                return self.send_result(service.analyze())
+            if method == 'POST' and url.path == '/refresh':
+                return self.send_result(service.refresh())
+            if method == 'POST' and url.path == '/create-host':
+                body = self.read_json()
+                return self.send_result(service.create_host(
+                    body.get('location'), body.get('sku'), body.get('resourcegroup'), body.get('hostgroup'),
+                    int(body.get('hostcount', 1)), body.get('faultdomain'), body.get('host')))
+            self.send_json(404, {'error': {'code': 'NotFound', 'message': url.path}})
+        except (ValueError, KeyError, TypeError) as error:
+            self.send_json(400, {'error': {'code': 'BadRequest', 'message': str(error)}})
+        except RestError as error:
+            self.send_json(502, {'error': {'code': error.code, 'message': str(error)}})
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(service, port=None, socket_path=None):
+    '''Create the HTTP server of the placement API on 127.0.0.1:port, or on a Unix socket.'''
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, PlacementRequestHandler)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', port), PlacementRequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(service, port=None, socket_path=None, refresh_interval=None):
+    '''Run the placement API until interrupted.
+
+    Args:
+        service (PlacementService): The service to expose.
+        port (int): TCP port on 127.0.0.1 (used if socket_path is not set).
+        socket_path (str): Path of a Unix socket to listen on (optional).
+        refresh_interval (float): Seconds between scheduled refreshes (optional, no refresh if not set).
+
+    Returns:
+        ADH_Return.
+    '''
+    returnObj = service.start()
+    if returnObj.code != 0:
+        return returnObj
+    server = create_server(service, port, socket_path)
+    if refresh_interval:
+        threading.Thread(target=service.run_refresh, args=(refresh_interval,), daemon=True).start()
+    logger.info ("adh_server: listening on %s", socket_path or '127.0.0.1:{}'.format(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+    returnObj = ADH_Return(0, 'Success')
+    returnObj.body = 'stopped'
+    return returnObj
@@ -0,0 +1,215 @@
+'''adh_shards.py - crawl several subscriptions in parallel worker processes
+
+Every subscription is a shard, crawled by DedicateHostCache.build_cache in a worker process of
+its own, so each shard has its own token provider, HTTP connection pool and rate governor
+(ARM throttles per subscription and principal). The crawled caches are merged into one
+DedicateHostCache. Hosts and host groups keep the subscription they came from
+(subscription_id), and the merged cache keeps the sync time of every subscription.
+
+The subscriptions are read from azurermconfig.json: either the single subscriptionId, or a
+"subscriptions" list whose entries are a subscription id, or an object with subscriptionId and,
+for a service principal of another tenant, tenantId, appId and appSecret:
+
+    {"tenantId": "...", "appId": "...", "appSecret": "...",
+     "subscriptions": ["<id>", "<id>", {"subscriptionId": "<id>", "tenantId": "...", "appId": "...",
+                                        "appSecret": "..."}]}
+'''
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from adh_cache import DedicateHostCache
+from adh_return import ADH_Return
+from adh_token import get_token_provider
+from restmetrics import add_tracer, record_call, remove_tracer
+from settings import get_crawl_processes
+
+logger = logging.getLogger('example')
+
+SHARD_FIELDS = ('tenantId', 'appId', 'appSecret')
+
+
+def read_subscriptions(config_data, selected=None):
+    '''The subscriptions of a configuration, with the service principal of each.
+
+    Args:
+        config_data (dict): Contents of azurermconfig.json.
+        selected (list): Only these subscription ids (optional, all if not set).
+
+    Returns:
+        A list of shard dictionaries with subscriptionId, tenantId, appId and appSecret.
+    '''
+    entries = config_data.get('subscriptions') or [config_data['subscriptionId']]
+    shards = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {'subscriptionId': entry}
+        shard = {field: entry.get(field, config_data.get(field)) for field in SHARD_FIELDS}
+        shard['subscriptionId'] = entry['subscriptionId']
+        shards.append(shard)
+    if selected:
+        wanted = set(subscription_id.lower() for subscription_id in selected)
+        shards = [shard for shard in shards if shard['subscriptionId'].lower() in wanted]
+    return shards
+
+
+def shard_token(shard):
+    '''The token provider of a shard's service principal.'''
+    return get_token_provider(shard['tenantId'], shard['appId'], shard['appSecret'])
+
+
+def _init_worker(log_format, log_level):
+    logging.basicConfig(format=log_format, level=log_level)
+
+
+def crawl_shard(shard, location, resource_group, host_group, max_workers=None):
+    '''Process target: crawl one subscription.
+
+    Returns:
+        The subscription id, the ADH_Return code and message, the crawled DedicateHostCache
+        (None on error) and the restmetrics records of the calls made, for the parent to record.
+    '''
+    calls = []
+    add_tracer(calls.append)
+    local_cache = DedicateHostCache()
+    try:
+        returnObj = local_cache.build_cache(shard_token(shard), shard['subscriptionId'], location, resource_group,
+                                            host_group, max_workers)
+    except Exception as error:
+        logger.exception ("adh_shards: crawl of subscription %s failed", shard['subscriptionId'])
+        returnObj = ADH_Return(-1, 'crawl failed: {}'.format(error))
+    finally:
+        # the worker process may crawl another shard next
+        remove_tracer(calls.append)
+    if returnObj.code != 0:
+        return shard['subscriptionId'], returnObj.code, returnObj.message, None, calls
+    # the index is rebuilt once on the merged cache
+    local_cache.placement_index = None
+    return shard['subscriptionId'], returnObj.code, returnObj.message, local_cache, calls
+
+
+def crawl_subscriptions(shards, location, resource_group, host_group, max_workers=None, processes=None):
+    '''Crawl the subscriptions of several shards and merge them into one cache.
+
+    Args:
+        shards (list): Shard dictionaries, see read_subscriptions.
+        location (str): Azure region. E.g. westus.
+        resource_group (str): Azure resource group name (optional).
+        host_group (str): A specific dedicated host group to analyze (optional)
+        max_workers (int): Parallel requests of the crawl within each shard (optional, serial if not set)
+        processes (int): Shards crawled at the same time (optional, see settings.get_crawl_processes)
+
+    Returns:
+        The merged DedicateHostCache, and a dictionary of the error message of every subscription
+        whose crawl failed.
+    '''
+    merged = DedicateHostCache()
+    failures = {}
+    if processes is None:
+        processes = get_crawl_processes()
+    processes = max(1, min(processes, len(shards)))
+    if processes == 1:
+        # nothing to run in parallel, crawl here (the calls are recorded as they are made)
+        for shard in shards:
+            local_cache = DedicateHostCache()
+            returnObj = local_cache.build_cache(shard_token(shard), shard['subscriptionId'], location, resource_group,
+                                                host_group, max_workers)
+            if returnObj.code != 0:
+                logger.warning ("adh_shards: subscription %s: %s", shard['subscriptionId'], returnObj.message)
+                failures[shard['subscriptionId']] = returnObj.message
+                continue
+            merged.merge(local_cache)
+        merged.build_index()
+        return merged, failures
+
+    root = logging.getLogger()
+    log_format = root.handlers[0].formatter._fmt if root.handlers and root.handlers[0].formatter else None
+    # spawned workers start clean: no session, governor or prefetch threads inherited from this process
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(log_format, logger.getEffectiveLevel())) as pool:
+        futures = [pool.submit(crawl_shard, shard, location, resource_group, host_group, max_workers)
+                   for shard in shards]
+        for shard, future in zip(shards, futures):
+            try:
+                subscription_id, code, message, local_cache, calls = future.result()
+            except Exception as error:
+                logger.warning ("adh_shards: subscription %s: %s", shard['subscriptionId'], error)
+                failures[shard['subscriptionId']] = str(error)
+                continue
+            for call in calls:
+                record_call(call)
+            if local_cache is None:
+                logger.warning ("adh_shards: subscription %s: %s", subscription_id, message)
+                failures[subscription_id] = message
+                continue
+            merged.merge(local_cache)
+    merged.build_index()
+    return merged, failures
+
+
+def keep_subscriptions(merged, previous, subscriptions):
+    '''Carry the host groups and sync times of some subscriptions over from the previous cache,
+    e.g. so a failed shard leaves its part of the cache as it was.
+
+    Args:
+        merged (DedicateHostCache): The merged cache of the crawl.
+        previous (DedicateHostCache): The cache before the crawl (optional).
+        subscriptions: Ids of the subscriptions to keep, e.g. the failures of crawl_subscriptions.
+    '''
+    kept = set(subscription_id.lower() for subscription_id in subscriptions)
+    if previous is None or not kept:
+        return
+    for dhg_id, dhg in previous.host_group_list.items():
+        if dhg.subscription_id.lower() in kept:
+            merged.host_group_list[dhg_id] = dhg
+    for subscription_id, synced in (getattr(previous, 'synced', None) or {}).items():
+        if subscription_id.lower() in kept:
+            merged.synced[subscription_id] = synced
+    merged.placement_index = None
+    merged.build_index()
+
+
+def update_subscriptions(local_cache, shards, location, resource_group, host_group, max_workers=None,
+                         delta_sync=False):
+    '''Refresh (or delta sync) a cache one subscription after the other.
+
+    Unlike a full crawl, an update is mostly a listing or a change feed query per subscription
+    and runs in this process.
+
+    Args:
+        local_cache (DedicateHostCache): The cache to update in place.
+        shards (list): Shard dictionaries, see read_subscriptions.
+        location (str): Azure region. E.g. westus.
+        resource_group (str): Azure resource group name (optional).
+        host_group (str): A specific dedicated host group to analyze (optional)
+        max_workers (int): Number of parallel requests (optional, serial if not set)
+        delta_sync (bool): Use DedicateHostCache.sync_cache instead of refresh_cache (optional)
+
+    Returns:
+        ADH_Return; body holds the summed refresh_cache / sync_cache statistics and the failed
+        subscriptions. The code is not 0 if any subscription failed; the others are updated all the same.
+    '''
+    update = local_cache.sync_cache if delta_sync else local_cache.refresh_cache
+    totals = {'new': 0, 'changed': 0, 'deleted': 0, 'changes': 0, 'mode': 'delta' if delta_sync else 'refresh'}
+    failures = {}
+    for shard in shards:
+        returnObj = update(shard_token(shard), shard['subscriptionId'], location, resource_group, host_group,
+                           max_workers)
+        if returnObj.code != 0:
+            logger.warning ("adh_shards: subscription %s: %s", shard['subscriptionId'], returnObj.message)
+            failures[shard['subscriptionId']] = returnObj.message
+            continue
+        stats = returnObj.body
+        for name in ('new', 'changed', 'deleted', 'changes'):
+            totals[name] += stats.get(name) or 0
+        if stats.get('mode') != 'delta':
+            totals['mode'] = 'refresh'
+    totals['unchanged'] = sum(len(dhg.host_list) for dhg in local_cache.host_group_list.values()) - \
+        totals['new'] - totals['changed']
+    totals['failed'] = sorted(failures)
+    if failures:
+        returnObj = ADH_Return (-1, 'failed subscriptions: ' + ', '.join(sorted(failures)))
+    else:
+        returnObj = ADH_Return (0, 'success')
+    returnObj.body = totals
+    return returnObj
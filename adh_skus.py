@@ -0,0 +1,77 @@
+'''adh_skus.py - VM and dedicated host SKU catalog'''
+import sys
+import threading
+
+# Process-wide table of VM size names; allocatable VM counts are stored in arrays indexed by
+# the ordinal of the size in this table (see adh_cache.AllocatableVMs).
+VM_SIZES = []
+_vm_size_ordinals = {}
+_vm_size_lock = threading.Lock()
+
+
+def vm_size_ordinal(vm_size):
+    '''Ordinal of a VM size in VM_SIZES; sizes seen for the first time are appended.'''
+    ordinal = _vm_size_ordinals.get(vm_size)
+    if ordinal is None:
+        with _vm_size_lock:
+            ordinal = _vm_size_ordinals.get(vm_size)
+            if ordinal is None:
+                ordinal = len(VM_SIZES)
+                VM_SIZES.append(sys.intern(vm_size))
+                _vm_size_ordinals[VM_SIZES[ordinal]] = ordinal
+    return ordinal
+
+
+def find_vm_size_ordinal(vm_size):
+    '''Ordinal of a VM size in VM_SIZES, or None if it has not been seen.'''
+    return _vm_size_ordinals.get(vm_size)
+
+
+class SKUS:
+    vm_skus = {"Standard_D2s_v3":{"cpu_count":2,"hyper_threading":2,"mem_size":8}, \
+        "Standard_D4s_v3":{"cpu_count":4,"hyper_threading":2,"mem_size":16}, \
+        "Standard_D8s_v3":{"cpu_count":8,"hyper_threading":2,"mem_size":32}, \
+        "Standard_D16s_v3":{"cpu_count":16,"hyper_threading":2,"mem_size":64}, \
+        "Standard_D32s_v3":{"cpu_count":32,"hyper_threading":2,"mem_size":128}, \
+        "Standard_D48s_v3":{"cpu_count":48,"hyper_threading":2,"mem_size":192}, \
+        "Standard_D64s_v3":{"cpu_count":64,"hyper_threading":2,"mem_size":256}, \
+        "Standard_E2s_v3":{"cpu_count":2,"hyper_threading":2,"mem_size":16}, \
+        "Standard_E4s_v3":{"cpu_count":4,"hyper_threading":2,"mem_size":32}, \
+        "Standard_E8s_v3":{"cpu_count":8,"hyper_threading":2,"mem_size":64}, \
+        "Standard_E16s_v3":{"cpu_count":16,"hyper_threading":2,"mem_size":128}, \
+        "Standard_E32s_v3":{"cpu_count":32,"hyper_threading":2,"mem_size":256}, \
+        "Standard_E48s_v3":{"cpu_count":48,"hyper_threading":2,"mem_size":384}, \
+        "Standard_E64s_v3":{"cpu_count":64,"hyper_threading":2,"mem_size":432} \
+             }
+    host_skus = {"DSv3-Type1":{"core_count":64,"mem_size":440}, \
+                 "DSv3-Type2":{"core_count":64,"mem_size":640},
+                 "ESv3-Type1":{"core_count":64,"mem_size":440},
+                 "FSv2-Type2":{"core_count":72,"mem_size":440}, }
+
+    host_sku_to_vm_skus = {"DSv3-Type1":{"Standard_D2s_v3","Standard_D4s_v3","Standard_D8s_v3", \
+        "Standard_D16s_v3","Standard_D32s_v3","Standard_D64s_v3"}, \
+        "DSv3-Type2":{"Standard_D2s_v3","Standard_D4s_v3","Standard_D8s_v3", \
+        "Standard_D16s_v3","Standard_D32s_v3","Standard_D48s_v3","Standard_D64s_v3"} , \
+        "ESv3-Type1":{"Standard_E2s_v3","Standard_E4s_v3","Standard_E8s_v3", \
+        "Standard_E16s_v3","Standard_E32s_v3","Standard_E48s_v3","Standard_E64s_v3"} , \
+        "ESv3-Type2":{"Standard_E2s_v3","Standard_E4s_v3","Standard_E8s_v3", \
+        "Standard_E16s_v3","Standard_E32s_v3","Standard_E64s_v3"},
+        "FSv2-Type2":{"Standard_F2s_v2","Standard_F4s_v2","Standard_F8s_v2", \
+        "Standard_F16s_v2","Standard_F32s_v2","Standard_F64s_v2"} } 
+    
+    def host_sku_for_vm_size (self,vm_size):
+        for host_sku,vm_sizes in self.host_sku_to_vm_skus.items():
+           if vm_size in vm_sizes:
+               return host_sku
+        return None
+
+    def vms_per_host (self, host_sku, vm_size):
+        '''How many VMs of vm_size fit on an empty host of host_sku, or None if the sizes are unknown.'''
+        if host_sku not in self.host_skus or vm_size not in self.vm_skus:
+            return None
+        return min(self.host_skus[host_sku]["core_count"] // self.vm_skus[vm_size]["cpu_count"],
+                   self.host_skus[host_sku]["mem_size"] // self.vm_skus[vm_size]["mem_size"])
+
+
+for _vm_size in sorted(SKUS.vm_skus):
+    vm_size_ordinal(_vm_size)
@@ -0,0 +1,221 @@
+'''adh_store.py - versioned snapshot file for the dedicated host cache
+
+Layout of a snapshot file:
+
+    b'ADHC' | header length (uint32, little endian) | header (JSON) | partition 0 | partition 1 | ...
+
+The header holds the schema version, the time of the last sync of every subscription (see
+DedicateHostCache.sync_cache), the VM size table and the location, zone and offset of every
+partition. A partition holds the host groups of one location and availability zone (zone null
+for groups without one) and their hosts as zlib compressed, column oriented JSON, one row per
+host. Allocatable VM counts are stored as one fixed-width row per host, indexed by the position
+of the size in the header's VM size table (-1 = size not offered). Loading a single location,
+or a single zone of it, only reads the header and the partitions it needs, so the load time of
+one region does not depend on the size of the others. Files written before zones were
+partitioned hold one partition per location, which a zone filter reads whole.
+
+Files written by older versions (a pickled DedicateHostCache) are migrated on first load.
+'''
+import json
+import logging
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+from adh_cache import DedicateHostCache, HostGroup, Host, VM
+from adh_index import attribute_key, location_key
+from adh_reservation import FileLock
+
+logger = logging.getLogger('example')
+
+SNAPSHOT_MAGIC = b'ADHC'
+SCHEMA_VERSION = 1
+_LENGTH = struct.Struct('<I')
+
+GROUP_COLUMNS = ('id', 'name', 'resource_group', 'location', 'az', 'subscription_id')
+HOST_COLUMNS = ('name', 'id', 'sku', 'location', 'fault_domain', 'resource_group', 'subscription_id',
+                'total_cores', 'total_mem', 'utilized_cores', 'utilized_mem')
+
+
+def _encode_partition(groups, vm_sizes, size_index):
+    group_columns = {column: [] for column in GROUP_COLUMNS}
+    host_columns = {column: [] for column in HOST_COLUMNS}
+    host_columns['group'] = []
+    host_columns['allocatable'] = []
+    host_columns['vms'] = []
+    for group_row, dhg in enumerate(groups):
+        for column in GROUP_COLUMNS:
+            group_columns[column].append(getattr(dhg, column))
+        for host in dhg.host_list.values():
+            host_columns['group'].append(group_row)
+            for column in HOST_COLUMNS:
+                host_columns[column].append(getattr(host, column))
+            counts = [-1] * len(vm_sizes)
+            for vm_size, count in host.allocatableVMs.items():
+                counts[size_index[vm_size]] = count
+            host_columns['allocatable'].append(counts)
+            host_columns['vms'].append([[vm_id, vm.size] for vm_id, vm in host.vm_list.items()])
+    partition = {'groups': group_columns, 'hosts': host_columns}
+    return zlib.compress(json.dumps(partition, separators=(',', ':')).encode('utf-8'))
+
+
+def _decode_partition(data, vm_sizes, local_cache):
+    partition = json.loads(zlib.decompress(data).decode('utf-8'))
+    group_columns = partition['groups']
+    groups = []
+    for row in range(len(group_columns['id'])):
+        dhg = HostGroup()
+        for column in GROUP_COLUMNS:
+            setattr(dhg, column, group_columns[column][row])
+        groups.append(dhg)
+        local_cache.host_group_list[dhg.id] = dhg
+
+    host_columns = partition['hosts']
+    for column in ('sku', 'location', 'resource_group', 'subscription_id'):
+        host_columns[column] = [sys.intern(value) for value in host_columns[column]]
+    for row, group_row in enumerate(host_columns['group']):
+        host = Host()
+        for column in HOST_COLUMNS:
+            setattr(host, column, host_columns[column][row])
+        dhg = groups[group_row]
+        host.group_name = dhg.name
+        host.available_cores = host.total_cores - host.utilized_cores
+        host.available_mem = host.total_mem - host.utilized_mem
+        for size_ordinal, count in enumerate(host_columns['allocatable'][row]):
+            if count >= 0:
+                host.allocatableVMs[vm_sizes[size_ordinal]] = count
+        for vm_id, vm_size in host_columns['vms'][row]:
+            vm = VM()
+            vm.id = sys.intern(vm_id)
+            vm.size = sys.intern(vm_size)
+            host.vm_list[vm.id] = vm
+        dhg.host_list[host.name] = host
+
+
+def save_snapshot(local_cache, filename):
+    '''Write a DedicateHostCache as a snapshot file.
+
+    The file is written to a temporary file next to the target and renamed into place, holding
+    the cache lock (filename + '.lock'), so readers never see a partially written snapshot and
+    writers of other processes do not interleave.
+
+    Args:
+        local_cache (DedicateHostCache): The cache to persist.
+        filename (str): Path of the snapshot file.
+    '''
+    partitions = {}
+    vm_sizes = []
+    size_index = {}
+    for dhg in local_cache.host_group_list.values():
+        partitions.setdefault((location_key(dhg.location), attribute_key(dhg.az)), []).append(dhg)
+        for host in dhg.host_list.values():
+            for vm_size in host.allocatableVMs:
+                if vm_size not in size_index:
+                    size_index[vm_size] = len(vm_sizes)
+                    vm_sizes.append(vm_size)
+
+    blobs = []
+    entries = []
+    offset = 0
+    for (location, zone), groups in partitions.items():
+        blob = _encode_partition(groups, vm_sizes, size_index)
+        entries.append({'location': location, 'zone': zone, 'offset': offset, 'length': len(blob),
+                        'groups': len(groups),
+                        'hosts': sum(len(dhg.host_list) for dhg in groups)})
+        blobs.append(blob)
+        offset += len(blob)
+
+    header = json.dumps({'schema': SCHEMA_VERSION, 'created': time.time(),
+                         'synced': getattr(local_cache, 'synced', None) or {}, 'vm_sizes': vm_sizes,
+                         'partitions': entries}).encode('utf-8')
+    with FileLock(filename + '.lock'):
+        temp_fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                                  prefix=os.path.basename(filename) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(temp_fd, 'wb') as filehandler:
+                filehandler.write(SNAPSHOT_MAGIC)
+                filehandler.write(_LENGTH.pack(len(header)))
+                filehandler.write(header)
+                for blob in blobs:
+                    filehandler.write(blob)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            os.unlink(temp_filename)
+            raise
+
+
+def read_header(filehandler):
+    '''Read and validate the snapshot header from an open file.
+
+    Returns:
+        The header dictionary; the file is left positioned at the first partition.
+    '''
+    magic = filehandler.read(len(SNAPSHOT_MAGIC))
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError('not an adh-mng snapshot file')
+    header_length = _LENGTH.unpack(filehandler.read(_LENGTH.size))[0]
+    header = json.loads(filehandler.read(header_length).decode('utf-8'))
+    if header['schema'] > SCHEMA_VERSION:
+        raise ValueError('snapshot schema {} is newer than supported schema {}'.format(
+            header['schema'], SCHEMA_VERSION))
+    header['data_offset'] = len(SNAPSHOT_MAGIC) + _LENGTH.size + header_length
+    return header
+
+
+def load_snapshot(filename, locations=None, zones=None):
+    '''Load a snapshot file into a DedicateHostCache.
+
+    Args:
+        filename (str): Path of the snapshot file.
+        locations (list): Only load these locations (optional, all locations if not set).
+        zones (list): Only load host groups in these availability zones (optional, all zones if not set).
+
+    Returns:
+        The DedicateHostCache. Raises FileNotFoundError if there is no file, ValueError if it is not a snapshot.
+    '''
+    with open(filename, 'rb') as filehandler:
+        legacy = filehandler.read(1) == b'\x80'
+        filehandler.seek(0)
+        if not legacy:
+            header = read_header(filehandler)
+            wanted = None if locations is None else set(location_key(location) for location in locations)
+            wanted_zones = None if zones is None else set(attribute_key(zone) for zone in zones)
+            local_cache = DedicateHostCache()
+            for entry in header['partitions']:
+                if wanted is not None and entry['location'] not in wanted:
+                    continue
+                if wanted_zones is not None and 'zone' in entry and entry['zone'] not in wanted_zones:
+                    continue
+                filehandler.seek(header['data_offset'] + entry['offset'])
+                _decode_partition(filehandler.read(entry['length']), header['vm_sizes'], local_cache)
+            synced = header.get('synced') or {}
+            if not isinstance(synced, dict):
+                # a single sync time, written before caches held several subscriptions
+                subscriptions = set(dhg.subscription_id for dhg in local_cache.host_group_list.values())
+                synced = {subscriptions.pop(): synced} if len(subscriptions) == 1 else {}
+            local_cache.synced = synced
+            return local_cache
+    return migrate_pickle(filename, locations, zones)
+
+
+def migrate_pickle(filename, locations=None, zones=None):
+    '''Convert a cache file pickled by an older version into a snapshot, in place.
+
+    Only load pickles you wrote yourself: unpickling runs code from the file.
+
+    Returns:
+        The DedicateHostCache, limited to locations and zones if given.
+    '''
+    logger.warning ("adh_store: migrating pickled cache %s to snapshot schema %d", filename, SCHEMA_VERSION)
+    with open(filename, 'rb') as filehandler:
+        local_cache = pickle.load(filehandler)
+    if not hasattr(local_cache, 'synced'):
+        local_cache.synced = {}
+    save_snapshot(local_cache, filename)
+    if locations is None and zones is None:
+        return local_cache
+    return load_snapshot(filename, locations, zones)
@@ -0,0 +1,183 @@
+'''adh_token.py - cached ARM access tokens with proactive refresh
+
+A TokenProvider can be passed wherever restfns expects an access token. It hands out a cached
+token, refreshes it in the background shortly before it expires, and is asked by restfns for a
+new token when ARM answers 401, so a long crawl outlives the token it started with.
+
+Tokens are also kept in a JSON file readable only by the user (see settings.get_token_cache_file),
+keyed by tenant, application and resource, so consecutive CLI runs reuse the same token.
+Application secrets are never written to the file.
+'''
+import json
+import logging
+import os
+import threading
+import time
+
+import adal
+
+from restmetrics import record_call
+from settings import get_auth_endpoint, get_resource_endpoint, get_token_cache_file, \
+    TOKEN_REFRESH_MARGIN, TOKEN_MIN_VALIDITY
+
+logger = logging.getLogger('example')
+
+_providers = {}
+_providers_lock = threading.Lock()
+_file_lock = threading.Lock()
+
+
+def read_token_cache(cache_file):
+    '''Return the cached tokens, {key: {'accessToken', 'expiresOn'}}, or {} if there are none.'''
+    if not cache_file:
+        return {}
+    try:
+        with open(cache_file) as token_file:
+            return json.load(token_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_token_cache(cache_file, key, access_token, expires_on):
+    '''Store a token in the cache file, creating it with owner-only (0600) permissions.'''
+    if not cache_file:
+        return
+    with _file_lock:
+        tokens = read_token_cache(cache_file)
+        now = time.time()
+        tokens = {cached_key: entry for cached_key, entry in tokens.items() if entry.get('expiresOn', 0) > now}
+        tokens[key] = {'accessToken': access_token, 'expiresOn': expires_on}
+        temp_filename = '{}.{}.tmp'.format(cache_file, os.getpid())
+        try:
+            file_descriptor = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(file_descriptor, 'w') as token_file:
+                json.dump(tokens, token_file)
+            os.replace(temp_filename, cache_file)
+        except OSError as error:
+            logger.warning ("adh_token: cannot write token cache %s: %s", cache_file, error)
+
+
+class TokenProvider:
+    '''An access token that refreshes itself.
+
+    Args:
+        acquire (callable): Returns a new (access token, expiry as epoch seconds).
+        key (str): Key of the token in the cache file.
+        cache_file (str): Path of the token cache file (optional, no file cache if not set).
+        refresh_margin (float): Seconds before expiry at which a background refresh starts.
+    '''
+
+    def __init__(self, acquire, key, cache_file=None, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.acquire = acquire
+        self.key = key
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_on = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+        entry = read_token_cache(cache_file).get(key)
+        if entry is not None:
+            self.access_token = entry['accessToken']
+            self.expires_on = entry['expiresOn']
+
+    def get_token(self):
+        '''Return a valid access token, refreshing it first if it is (about to be) expired.'''
+        remaining = self.expires_on - time.time()
+        if self.access_token is None or remaining < TOKEN_MIN_VALIDITY:
+            return self.refresh(self.access_token)
+        if remaining < self.refresh_margin and not self.refreshing:
+            with self.lock:
+                if not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self._background_refresh, daemon=True).start()
+        return self.access_token
+
+    def cached_token(self):
+        '''Return the access token if it is still valid, else None; never acquires a token itself.'''
+        if self.access_token is None or self.expires_on - time.time() < TOKEN_MIN_VALIDITY:
+            return None
+        return self.get_token()
+
+    def refresh(self, stale_token=None):
+        '''Acquire a new token, unless another thread already replaced stale_token.
+
+        Args:
+            stale_token (str): The token that was rejected or expired (optional, always refresh if not set).
+
+        Returns:
+            The current access token.
+        '''
+        with self.lock:
+            if stale_token is not None and self.access_token != stale_token \
+                    and self.expires_on - time.time() >= TOKEN_MIN_VALIDITY:
+                return self.access_token
+            access_token, expires_on = self.acquire()
+            self.access_token = access_token
+            self.expires_on = expires_on
+            self.refreshing = False
+        logger.debug ("adh_token: refreshed token %s, valid for %d seconds", self.key, expires_on - time.time())
+        write_token_cache(self.cache_file, self.key, access_token, expires_on)
+        return access_token
+
+    def _background_refresh(self):
+        try:
+            self.refresh(self.access_token)
+        except Exception as error:
+            # the current token is still valid; get_token refreshes in the foreground once it is not
+            logger.warning ("adh_token: background token refresh failed: %s", error)
+            with self.lock:
+                self.refreshing = False
+
+
+def acquire_client_credentials(tenant_id, application_id, application_secret, resource=None):
+    '''Get an access token with the client credentials of a Service Principal.
+
+    Returns:
+        (access token, expiry as epoch seconds).
+    '''
+    if resource is None:
+        resource = get_resource_endpoint()
+    call = {'method': 'AUTH', 'template': '/{}/oauth2/token', 'status': None,
+            'bytes': 0, 'retries': 0, 'throttled': 0, 'wait_seconds': 0.0}
+    started = time.perf_counter()
+    try:
+        context = adal.AuthenticationContext(get_auth_endpoint() + tenant_id, api_version=None)
+        token_response = context.acquire_token_with_client_credentials(resource, application_id, application_secret)
+        call['status'] = 200
+    except Exception as error:
+        call['error'] = type(error).__name__
+        raise
+    finally:
+        call['seconds'] = time.perf_counter() - started
+        record_call(call)
+    return token_response.get('accessToken'), time.time() + int(token_response.get('expiresIn', 3600))
+
+
+def get_token_provider(tenant_id, application_id, application_secret, resource=None, cache_file=None):
+    '''Return the shared TokenProvider for a tenant, application and resource.
+
+    Args:
+        tenant_id (str): Tenant id of the user's account.
+        application_id (str): Application id of a Service Principal account.
+        application_secret (str): Application secret (password) of the Service Principal account.
+        resource (str): Resource the token is for (optional, see settings).
+        cache_file (str): Path of the token cache file (optional, see settings).
+
+    Returns:
+        A TokenProvider, to be passed as the access token of ARM calls.
+    '''
+    if resource is None:
+        resource = get_resource_endpoint()
+    if cache_file is None:
+        cache_file = get_token_cache_file()
+    key = '|'.join([get_auth_endpoint() + tenant_id, application_id, resource])
+    acquire = lambda: acquire_client_credentials(tenant_id, application_id, application_secret, resource)
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = TokenProvider(acquire, key, cache_file)
+            _providers[key] = provider
+        else:
+            provider.acquire = acquire
+        return provider
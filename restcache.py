@@ -0,0 +1,194 @@
+'''restcache - on-disk response cache for conditional ARM GETs
+
+A GET response that carries an ETag or Last-Modified header is stored on disk, keyed by
+endpoint. The next GET of that endpoint is sent with If-None-Match / If-Modified-Since, and a
+304 answer is served from the stored body. An unchanged resource then still costs a request,
+but almost nothing is transferred.
+
+Each entry is one file in the cache directory, named by the SHA-256 of the endpoint. The file
+holds a JSON line with the endpoint, validators and store time, followed by the body. Entries
+older than max_age are neither revalidated nor served; the next GET fetches them in full.
+Once the directory grows past max_bytes, the least recently used entries are removed. Files
+are written to a temp file and renamed, and are readable by the user only. The status URLs of
+long running operations (see restfns.wait_for_operation) are polled until they change and are
+never cached.
+'''
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from settings import get_response_cache_dir, get_response_cache_max_age, get_response_cache_max_bytes
+
+logger = logging.getLogger('example')
+
+ETAG_HEADER = 'ETag'
+LAST_MODIFIED_HEADER = 'Last-Modified'
+CONTENT_TYPE_HEADER = 'Content-Type'
+
+# path segments of the Azure-AsyncOperation / Location URLs of long running operations
+OPERATION_SEGMENTS = frozenset(('operations', 'operationstatuses', 'operationresults', 'asyncoperations'))
+
+_response_cache = None
+_configured = False
+_cache_lock = threading.Lock()
+
+
+class ResponseCache:
+    '''Stored GET bodies and their validators, see the module docstring.
+
+    Args:
+        directory (str): Cache directory, created on first use.
+        max_bytes (int): Size of the directory above which entries are evicted (optional, see settings).
+        max_age (float): Seconds an entry is served for after it was stored (optional, see settings).
+    '''
+
+    def __init__(self, directory, max_bytes=None, max_age=None):
+        self.directory = directory
+        self.max_bytes = get_response_cache_max_bytes() if max_bytes is None else max_bytes
+        self.max_age = get_response_cache_max_age() if max_age is None else max_age
+        self.lock = threading.Lock()
+        # {file name: [size, last use]}, read from the directory on first use
+        self.index = None
+        self.total = 0
+
+    def _filename(self, endpoint):
+        return hashlib.sha256(endpoint.encode('utf-8')).hexdigest()
+
+    def _load_index(self):
+        # called with the lock held; on first use, read the directory and trim it to max_bytes
+        if self.index is not None:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self.index = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                self.index[entry.name] = [stat.st_size, stat.st_mtime]
+        self.total = sum(size for size, used in self.index.values())
+        self._evict()
+
+    def lookup(self, endpoint):
+        '''Return the stored entry of an endpoint, or None if there is none or it is too old.
+
+        Returns:
+            A dictionary with endpoint, etag, last_modified, content_type, stored and body.
+        '''
+        filename = self._filename(endpoint)
+        try:
+            with open(os.path.join(self.directory, filename), 'rb') as entry_file:
+                entry = json.loads(entry_file.readline().decode('utf-8'))
+                if entry.get('endpoint') != endpoint or time.time() - entry['stored'] > self.max_age:
+                    return None
+                entry['body'] = entry_file.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry
+
+    def conditional_headers(self, entry):
+        '''The If-None-Match / If-Modified-Since headers that revalidate an entry.'''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, endpoint, headers, content):
+        '''Store the body of a 200 GET response if it has a validator.
+
+        Args:
+            endpoint (str): The endpoint that was called.
+            headers: Response headers (case-insensitive mapping).
+            content (bytes): Response body.
+        '''
+        etag = headers.get(ETAG_HEADER)
+        last_modified = headers.get(LAST_MODIFIED_HEADER)
+        if not etag and not last_modified:
+            return
+        entry = {'endpoint': endpoint, 'etag': etag, 'last_modified': last_modified,
+                 'content_type': headers.get(CONTENT_TYPE_HEADER), 'stored': time.time()}
+        data = json.dumps(entry).encode('utf-8') + b'\n' + content
+        filename = self._filename(endpoint)
+        path = os.path.join(self.directory, filename)
+        with self.lock:
+            self._load_index()
+            temp_filename = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            try:
+                file_descriptor = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(file_descriptor, 'wb') as entry_file:
+                    entry_file.write(data)
+                os.replace(temp_filename, path)
+            except OSError as error:
+                logger.warning ("restcache: cannot write %s: %s", path, error)
+                return
+            previous = self.index.get(filename)
+            self.total += len(data) - (previous[0] if previous else 0)
+            self.index[filename] = [len(data), time.time()]
+            if self.total > self.max_bytes:
+                self._evict()
+
+    def touch(self, endpoint):
+        '''Mark an entry as used, e.g. after a 304; keeps it from being evicted first.'''
+        filename = self._filename(endpoint)
+        with self.lock:
+            self._load_index()
+            if filename not in self.index:
+                return
+            self.index[filename][1] = time.time()
+        try:
+            os.utime(os.path.join(self.directory, filename))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # called with the lock held: remove least recently used entries down to max_bytes
+        for filename, (size, used) in sorted(self.index.items(), key=lambda item: item[1][1]):
+            if self.total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+            del self.index[filename]
+            self.total -= size
+
+    def clear(self):
+        '''Remove every entry.'''
+        with self.lock:
+            self._load_index()
+            for filename in list(self.index):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+            self.index = {}
+            self.total = 0
+
+
+def cacheable(endpoint):
+    '''Whether GETs of an endpoint go through the response cache (not for operation status URLs).'''
+    return not OPERATION_SEGMENTS.intersection(urlsplit(endpoint).path.lower().split('/'))
+
+
+def get_response_cache():
+    '''Return the shared ResponseCache, or None if it is disabled (see settings.get_response_cache_dir).'''
+    global _response_cache, _configured
+    if not _configured:
+        with _cache_lock:
+            if not _configured:
+                directory = get_response_cache_dir()
+                _response_cache = ResponseCache(directory) if directory else None
+                _configured = True
+    return _response_cache
+
+
+def set_response_cache(cache):
+    '''Replace the shared ResponseCache; None disables it.'''
+    global _response_cache, _configured
+    with _cache_lock:
+        _response_cache = cache
+        _configured = True
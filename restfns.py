@@ -1,23 +1,423 @@
 '''azurerm restfns - REST functions for adh-mng (reused from azurerm)'''
 
+import email.utils
 import platform
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pkg_resources  # to get version
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
+from restcache import cacheable, get_response_cache
+from restmetrics import endpoint_template, record_call
 from settings import json_acceptformat, json_only_acceptformat, xml_acceptformat, \
-charset, dsversion_min, dsversion_max, xmsversion, ams_rest_endpoint
+charset, dsversion_min, dsversion_max, xmsversion, ams_rest_endpoint, \
+get_http_pool_connections, get_http_pool_maxsize, get_http_keep_alive, get_arm_max_retries, \
+ARM_BACKOFF_BASE, ARM_BACKOFF_MAX, ARM_READ_RATE, ARM_READ_BURST, ARM_READ_LOW_WATER, \
+ARM_WRITE_RATE, ARM_WRITE_BURST, ARM_WRITE_LOW_WATER, LRO_POLL_MIN, LRO_POLL_MAX, LRO_TIMEOUT
+
+_user_agent = None
+_session = None
+_session_lock = threading.Lock()
+_retry_policy = None
+_rate_governor = None
+_prefetch_pool = None
+
+RETRY_AFTER_HEADER = 'Retry-After'
+REMAINING_READS_HEADER = 'x-ms-ratelimit-remaining-subscription-reads'
+REMAINING_WRITES_HEADER = 'x-ms-ratelimit-remaining-subscription-writes'
+READ_METHODS = ('GET', 'HEAD')
+PREFETCH_WORKERS = 4
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+ASYNC_OPERATION_HEADER = 'Azure-AsyncOperation'
+LOCATION_HEADER = 'Location'
+TERMINAL_STATES = ('Succeeded', 'Failed', 'Canceled')
+
+
+class RestError(Exception):
+    '''An ARM call returned an error body (after all retries).'''
+
+    def __init__(self, endpoint, response_json):
+        self.endpoint = endpoint
+        self.error = response_json.get('error', {}) if isinstance(response_json, dict) else {}
+        self.code = self.error.get('code', 'Unknown')
+        Exception.__init__(self, '{}: {}'.format(self.code, self.error.get('message', endpoint)))
+
+
+def check_response(endpoint, response_json):
+    '''Raise RestError if an ARM JSON response carries an error body.
+
+    Args:
+        endpoint (str): The endpoint that was called, for the error message.
+        response_json (dict): JSON body as returned by do_get/do_get_next.
+
+    Returns:
+        The response_json, unchanged.
+    '''
+    if 'error' in response_json:
+        raise RestError(endpoint, response_json)
+    return response_json
+
+
+class RetryPolicy:
+    '''Decide whether, and how long to wait before, an ARM call is retried.
+
+    Throttled (429) calls are retried for every method. Server errors (5xx) and connection
+    errors are only retried for idempotent methods. Retry-After is honoured; otherwise the
+    wait is exponential backoff with full jitter.
+    '''
+
+    def __init__(self, max_retries=None, backoff_base=ARM_BACKOFF_BASE, backoff_max=ARM_BACKOFF_MAX,
+                 retry_statuses=(429, 500, 502, 503, 504)):
+        self.max_retries = get_arm_max_retries() if max_retries is None else max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = retry_statuses
+
+    def should_retry(self, method, status_code, attempt):
+        '''Return True if a call that ended with status_code (None for a connection error) should be retried.'''
+        if attempt >= self.max_retries:
+            return False
+        if status_code == 429:
+            return True
+        if status_code is None or status_code in self.retry_statuses:
+            return method.upper() in IDEMPOTENT_METHODS
+        return False
+
+    def get_delay(self, attempt, headers=None):
+        '''Seconds to wait before retry number attempt+1.'''
+        retry_after = parse_retry_after(headers.get(RETRY_AFTER_HEADER)) if headers else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+def parse_retry_after(value):
+    '''Parse a Retry-After header (delta seconds or HTTP date) into seconds, or None.'''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    '''A token bucket whose refill rate can be lowered while the ARM quota runs low.'''
+
+    def __init__(self, rate, burst, low_water):
+        self.base_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.low_water = low_water
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def reserve(self, now):
+        '''Take one token and return the seconds the caller has to wait for it.'''
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def update(self, remaining):
+        '''Scale the refill rate by how close the subscription is to its quota.'''
+        if remaining >= self.low_water:
+            self.rate = self.base_rate
+        else:
+            self.rate = self.base_rate * max(0.05, float(remaining) / self.low_water)
+
+
+class RateGovernor:
+    '''Client-side throttle shared by all threads (and event loops) issuing ARM calls.
+
+    Reads and writes have separate token buckets. Every response feeds the
+    x-ms-ratelimit-remaining-subscription-* headers back in, so the refill rate drops as the
+    subscription quota runs low and parallel crawls slow down before ARM starts answering 429.
+    A 429 pauses all callers for the Retry-After period.
+    '''
+
+    def __init__(self, read_rate=ARM_READ_RATE, read_burst=ARM_READ_BURST, read_low_water=ARM_READ_LOW_WATER,
+                 write_rate=ARM_WRITE_RATE, write_burst=ARM_WRITE_BURST, write_low_water=ARM_WRITE_LOW_WATER):
+        self.reads = TokenBucket(read_rate, read_burst, read_low_water)
+        self.writes = TokenBucket(write_rate, write_burst, write_low_water)
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _bucket(self, method):
+        return self.reads if method.upper() in READ_METHODS else self.writes
+
+    def reserve(self, method):
+        '''Reserve a slot for one call and return the seconds to wait before sending it.'''
+        with self.lock:
+            now = time.monotonic()
+            return max(self.paused_until - now, 0.0) + self._bucket(method).reserve(now)
+
+    def wait(self, method):
+        '''Block the calling thread until a call may be sent.'''
+        delay = self.reserve(method)
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, headers):
+        '''Feed the remaining-quota headers of a response back into the buckets.'''
+        with self.lock:
+            for header, bucket in ((REMAINING_READS_HEADER, self.reads), (REMAINING_WRITES_HEADER, self.writes)):
+                remaining = headers.get(header)
+                if remaining is not None:
+                    try:
+                        bucket.update(int(remaining))
+                    except ValueError:
+                        pass
+
+    def pause(self, delay):
+        '''Hold back every caller for delay seconds, e.g. after a 429.'''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
 
 def get_user_agent():
     '''User-Agent Header. Sends library identification to Azure endpoint.
+
+    The value is computed once per process; platform.platform() is too slow to call per request.
+    '''
+    global _user_agent
+    if _user_agent is None:
+        #version = pkg_resources.require("adh_mng")[0].version
+        version="1.0"
+        _user_agent = "python/{} ({}) requests/{} adh-mng/{}".format(
+            platform.python_version(),
+            platform.platform(),
+            requests.__version__,
+            version)
+    return _user_agent
+
+
+def create_session(pool_connections=None, pool_maxsize=None, keep_alive=None):
+    '''Create a connection-pooled HTTP session for ARM calls.
+
+    Args:
+        pool_connections (int): Number of host pools to keep (optional, see settings).
+        pool_maxsize (int): Max open connections per host pool (optional, see settings).
+        keep_alive (bool): Reuse TCP/TLS connections between calls (optional, see settings).
+
+    Returns:
+        A requests.Session with the adh-mng default headers and pool sizes.
+    '''
+    if pool_connections is None:
+        pool_connections = get_http_pool_connections()
+    if pool_maxsize is None:
+        pool_maxsize = get_http_pool_maxsize()
+    if keep_alive is None:
+        keep_alive = get_http_keep_alive()
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = get_user_agent()
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session():
+    '''Return the shared HTTP session, creating it on first use.
+    '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def set_session(session):
+    '''Replace the shared HTTP session, e.g. with a pre-configured or fake session in tests.
+
+    Args:
+        session: A requests.Session compatible object, or None to recreate the default on next use.
+
+    Returns:
+        The previous session (may be None).
+    '''
+    global _session
+    with _session_lock:
+        previous = _session
+        _session = session
+    return previous
+
+
+def configure_session(pool_connections=None, pool_maxsize=None, keep_alive=None):
+    '''Build a new shared session with the given pool settings and install it.
+
+    Args:
+        pool_connections (int): Number of host pools to keep.
+        pool_maxsize (int): Max open connections per host pool.
+        keep_alive (bool): Reuse TCP/TLS connections between calls.
+
+    Returns:
+        The newly installed session.
     '''
-    #version = pkg_resources.require("adh_mng")[0].version
-    version="1.0"
-    user_agent = "python/{} ({}) requests/{} adh-mng/{}".format(
-        platform.python_version(),
-        platform.platform(),
-        requests.__version__,
-        version)
-    return user_agent
+    session = create_session(pool_connections, pool_maxsize, keep_alive)
+    previous = set_session(session)
+    if previous is not None:
+        previous.close()
+    return session
+
+
+def get_retry_policy():
+    '''Return the RetryPolicy used by all REST helpers, creating the default on first use.'''
+    global _retry_policy
+    if _retry_policy is None:
+        _retry_policy = RetryPolicy()
+    return _retry_policy
+
+
+def set_retry_policy(policy):
+    '''Replace the RetryPolicy; RetryPolicy(max_retries=0) disables retries.'''
+    global _retry_policy
+    _retry_policy = policy
+
+
+def get_rate_governor():
+    '''Return the shared RateGovernor, creating the default on first use.'''
+    global _rate_governor
+    if _rate_governor is None:
+        with _session_lock:
+            if _rate_governor is None:
+                _rate_governor = RateGovernor()
+    return _rate_governor
+
+
+def set_rate_governor(governor):
+    '''Replace the shared RateGovernor (e.g. with different rates), or None to reset to the default.'''
+    global _rate_governor
+    _rate_governor = governor
+
+
+def get_bearer_token(access_token):
+    '''Return the token string of an access token: a str, or a provider with get_token() (see adh_token).'''
+    if hasattr(access_token, 'get_token'):
+        return access_token.get_token()
+    return access_token
+
+
+def cached_response(entry, not_modified):
+    '''The 200 response a 304 stands for: the headers of the 304 with the body of the cache entry.'''
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers = CaseInsensitiveDict(not_modified.headers)
+    if entry.get('content_type'):
+        response.headers['Content-Type'] = entry['content_type']
+    response.headers['Content-Length'] = str(len(entry['body']))
+    response._content = entry['body']
+    response.url = not_modified.url
+    response.request = not_modified.request
+    return response
+
+
+def send_request(method, endpoint, access_token, body=None):
+    '''Send an ARM request through the shared session, governor and retry policy.
+
+    If access_token is a token provider, a 401 response refreshes the token once and the call
+    is replayed. GETs are revalidated against the response cache (see restcache), and a 304 is
+    returned as the cached 200 response. Every call is recorded in restmetrics, a revalidated
+    GET with status 304.
+
+    Args:
+        method (str): HTTP method.
+        endpoint (str): Azure Resource Manager management endpoint.
+        access_token (str): A valid Azure authentication token, or a token provider.
+        body (str): JSON body (optional).
+
+    Returns:
+        HTTP response of the last attempt.
+    '''
+    bearer_token = get_bearer_token(access_token)
+    headers = {"Authorization": 'Bearer ' + bearer_token}
+    if body is not None:
+        headers["content-type"] = "application/json"
+    cache = get_response_cache() if method == 'GET' and cacheable(endpoint) else None
+    cached = cache.lookup(endpoint) if cache is not None else None
+    if cached is not None:
+        headers.update(cache.conditional_headers(cached))
+    policy = get_retry_policy()
+    governor = get_rate_governor()
+    attempt = 0
+    replayed = False
+    call = {'method': method, 'template': endpoint_template(endpoint), 'status': None, 'bytes': 0,
+            'retries': 0, 'throttled': 0, 'wait_seconds': 0.0}
+    started = time.perf_counter()
+    try:
+        while True:
+            delay = governor.reserve(method)
+            if delay > 0:
+                call['wait_seconds'] += delay
+                time.sleep(delay)
+            try:
+                response = get_session().request(method, endpoint, data=body, headers=headers)
+            except (requests.ConnectionError, requests.Timeout):
+                if not policy.should_retry(method, None, attempt):
+                    raise
+                delay = policy.get_delay(attempt)
+                call['wait_seconds'] += delay
+                time.sleep(delay)
+                attempt += 1
+                continue
+            governor.update(response.headers)
+            if response.status_code == 401 and not replayed and hasattr(access_token, 'refresh'):
+                bearer_token = access_token.refresh(bearer_token)
+                headers["Authorization"] = 'Bearer ' + bearer_token
+                replayed = True
+                continue
+            if response.status_code == 429:
+                call['throttled'] += 1
+            if not policy.should_retry(method, response.status_code, attempt):
+                call['status'] = response.status_code
+                call['bytes'] = len(response.content)
+                call['remaining_reads'] = response.headers.get(REMAINING_READS_HEADER)
+                call['remaining_writes'] = response.headers.get(REMAINING_WRITES_HEADER)
+                if cache is not None:
+                    if response.status_code == 304 and cached is not None:
+                        cache.touch(endpoint)
+                        return cached_response(cached, response)
+                    if response.status_code == 200:
+                        cache.store(endpoint, response.headers, response.content)
+                return response
+            delay = policy.get_delay(attempt, response.headers)
+            if response.status_code == 429:
+                # the pause is waited out, and counted, in the next governor reserve
+                governor.pause(delay)
+            else:
+                call['wait_seconds'] += delay
+                time.sleep(delay)
+            attempt += 1
+    except Exception as error:
+        call['error'] = type(error).__name__
+        raise
+    finally:
+        call['retries'] = attempt
+        call['seconds'] = time.perf_counter() - started
+        record_call(call)
+
+
+def response_json(response):
+    '''Decode a JSON response body; a non-JSON body becomes an ARM style error body.'''
+    try:
+        return response.json()
+    except ValueError:
+        return {'error': {'code': str(response.status_code), 'message': response.text[:200]}}
+
 
 def do_get(endpoint, access_token):
     '''Do an HTTP GET request and return JSON.
@@ -29,9 +429,7 @@ def do_get(endpoint, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"Authorization": 'Bearer ' + access_token}
-    headers['User-Agent'] = get_user_agent()
-    return requests.get(endpoint, headers=headers).json()
+    return response_json(send_request('GET', endpoint, access_token))
 
 
 def do_get_next(endpoint, access_token):
@@ -44,13 +442,11 @@ def do_get_next(endpoint, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"Authorization": 'Bearer ' + access_token}
-    headers['User-Agent'] = get_user_agent()
     looping = True
     value_list = []
     vm_dict = {}
     while looping:
-        get_return = requests.get(endpoint, headers=headers).json()
+        get_return = response_json(send_request('GET', endpoint, access_token))
         if not 'value' in get_return:
             return get_return
         if not 'nextLink' in get_return:
@@ -62,6 +458,65 @@ def do_get_next(endpoint, access_token):
     return vm_dict
 
 
+def get_prefetch_pool():
+    '''Return the small shared thread pool used to prefetch the next page of a list.'''
+    global _prefetch_pool
+    if _prefetch_pool is None:
+        with _session_lock:
+            if _prefetch_pool is None:
+                _prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS,
+                                                    thread_name_prefix='adh-prefetch')
+    return _prefetch_pool
+
+
+def iter_pages(endpoint, access_token, prefetch=True):
+    '''Do an HTTP GET request and yield each page of the nextLink chain as it arrives.
+
+    While the caller processes a page, the next one is already being fetched.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        access_token (str): A valid Azure authentication token.
+        prefetch (bool): Fetch the next page in the background (default True).
+
+    Returns:
+        A generator of JSON pages. Raises RestError if a page is an error body.
+    '''
+    page = response_json(send_request('GET', endpoint, access_token))
+    while True:
+        check_response(endpoint, page)
+        next_link = page.get('nextLink')
+        next_page = None
+        if next_link and prefetch:
+            next_page = get_prefetch_pool().submit(send_request, 'GET', next_link, access_token)
+        yield page
+        if not next_link:
+            return
+        endpoint = next_link
+        if next_page is not None:
+            page = response_json(next_page.result())
+        else:
+            page = response_json(send_request('GET', endpoint, access_token))
+
+
+def iter_get_next(endpoint, access_token, prefetch=True):
+    '''Do an HTTP GET request and yield the list items of the nextLink chain as they arrive.
+
+    Streaming counterpart of do_get_next: only one or two pages are held in memory.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        access_token (str): A valid Azure authentication token.
+        prefetch (bool): Fetch the next page in the background (default True).
+
+    Returns:
+        A generator of JSON objects. Raises RestError if a page is an error body.
+    '''
+    for page in iter_pages(endpoint, access_token, prefetch):
+        for item in page.get('value', []):
+            yield item
+
+
 def do_delete(endpoint, access_token):
     '''Do an HTTP GET request and return JSON.
 
@@ -72,9 +527,7 @@ def do_delete(endpoint, access_token):
     Returns:
         HTTP response.
     '''
-    headers = {"Authorization": 'Bearer ' + access_token}
-    headers['User-Agent'] = get_user_agent()
-    return requests.delete(endpoint, headers=headers)
+    return send_request('DELETE', endpoint, access_token)
 
 
 def do_patch(endpoint, body, access_token):
@@ -88,9 +541,7 @@ def do_patch(endpoint, body, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"content-type": "application/json", "Authorization": 'Bearer ' + access_token}
-    headers['User-Agent'] = get_user_agent()
-    return requests.patch(endpoint, data=body, headers=headers)
+    return send_request('PATCH', endpoint, access_token, body)
 
 
 def do_post(endpoint, body, access_token):
@@ -104,9 +555,7 @@ def do_post(endpoint, body, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"content-type": "application/json", "Authorization": 'Bearer ' + access_token}
-    headers['User-Agent'] = get_user_agent()
-    return requests.post(endpoint, data=body, headers=headers)
+    return send_request('POST', endpoint, access_token, body)
 
 
 def do_put(endpoint, body, access_token):
@@ -120,9 +569,83 @@ def do_put(endpoint, body, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"content-type": "application/json", "Authorization": 'Bearer ' + access_token}
-    headers['User-Agent'] = get_user_agent()
-    return requests.put(endpoint, data=body, headers=headers)
+    return send_request('PUT', endpoint, access_token, body)
+
+
+def _provisioning_state(response_json):
+    properties = response_json.get('properties')
+    if isinstance(properties, dict):
+        return properties.get('provisioningState')
+    return None
+
+
+def wait_for_operation(response, access_token, resource_endpoint=None, timeout=None):
+    '''Wait for an ARM long running operation to finish.
+
+    ARM answers a PUT, POST or DELETE that runs asynchronously with an Azure-AsyncOperation
+    and/or Location header. The operation is polled until it reaches a terminal state; without
+    either header, the provisioningState of the resource is polled. The poll interval follows
+    Retry-After when ARM sends it, else starts at LRO_POLL_MIN seconds and doubles up to
+    LRO_POLL_MAX.
+
+    Args:
+        response: HTTP response of the request that started the operation.
+        access_token (str): A valid Azure authentication token.
+        resource_endpoint (str): Endpoint of the resource, fetched once the operation has succeeded (optional).
+        timeout (float): Seconds to wait (optional, default LRO_TIMEOUT).
+
+    Returns:
+        (status, JSON body). status is Succeeded, Failed, Canceled or TimedOut; the body is the
+        resource if it succeeded, else the operation status or error.
+    '''
+    body = response_json(response)
+    if response.status_code >= 400 or 'error' in body:
+        return 'Failed', body
+    async_url = response.headers.get(ASYNC_OPERATION_HEADER)
+    location_url = response.headers.get(LOCATION_HEADER) if response.status_code == 202 else None
+    if not async_url and not location_url:
+        state = _provisioning_state(body)
+        if state is None or state in TERMINAL_STATES or resource_endpoint is None:
+            return state or 'Succeeded', body
+
+    deadline = time.time() + (LRO_TIMEOUT if timeout is None else timeout)
+    interval = LRO_POLL_MIN
+    headers = response.headers
+    while True:
+        delay = parse_retry_after(headers.get(RETRY_AFTER_HEADER))
+        if delay is None:
+            delay = interval
+            interval = min(interval * 2, LRO_POLL_MAX)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return 'TimedOut', body
+        time.sleep(min(delay, remaining))
+
+        if async_url:
+            poll = send_request('GET', async_url, access_token)
+            body = response_json(poll)
+            state = body.get('status')
+            if state is None and 'error' in body:
+                return 'Failed', body
+        elif location_url:
+            poll = send_request('GET', location_url, access_token)
+            if poll.status_code == 202:
+                state = None
+            else:
+                body = response_json(poll) if poll.content else {}
+                state = 'Failed' if poll.status_code >= 400 or 'error' in body else 'Succeeded'
+        else:
+            poll = send_request('GET', resource_endpoint, access_token)
+            body = response_json(poll)
+            if 'error' in body:
+                return 'Failed', body
+            state = _provisioning_state(body) or 'Succeeded'
+        headers = poll.headers
+
+        if state in TERMINAL_STATES:
+            if state == 'Succeeded' and resource_endpoint and (async_url or location_url):
+                body = do_get(resource_endpoint, access_token)
+            return state, body
 
 
 def get_url(access_token, endpoint=ams_rest_endpoint, flag=True):
@@ -0,0 +1,333 @@
+'''restfns_async - asyncio REST functions for adh-mng
+
+Async counterparts of the helpers in restfns. They share one aiohttp session per event loop,
+so thousands of concurrent ARM calls can run on a single loop without a thread per call.
+Every call accepts an optional timeout (seconds) and can be cancelled like any other task.
+'''
+
+import asyncio
+import json
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from restfns import get_user_agent, get_retry_policy, get_rate_governor, \
+    REMAINING_READS_HEADER, REMAINING_WRITES_HEADER
+from restcache import cacheable, get_response_cache
+from restmetrics import endpoint_template, record_call
+from settings import get_http_pool_maxsize, get_http_keep_alive
+
+# event loop -> its aiohttp session; a session can only be used in the loop it was created in.
+# Loops are kept until a later get_session closes their session.
+_sessions = {}
+# set with set_session outside of a loop, adopted by the next loop that asks for a session
+_unbound_session = None
+# close() tasks of replaced sessions, referenced until done
+_closing = set()
+
+
+class Response:
+    '''A fully read HTTP response, detached from the aiohttp connection.
+
+    Mirrors the parts of requests.Response used by adh-mng (status_code, headers, text, json()).
+    '''
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        try:
+            return json.loads(self.content)
+        except ValueError:
+            return {'error': {'code': str(self.status_code), 'message': self.text[:200]}}
+
+
+def create_session(limit=None, keep_alive=None):
+    '''Create an aiohttp session for ARM calls.
+
+    Must be called from within a running event loop.
+
+    Args:
+        limit (int): Max number of open connections (optional, see settings).
+        keep_alive (bool): Reuse TCP/TLS connections between calls (optional, see settings).
+
+    Returns:
+        An aiohttp.ClientSession with the adh-mng default headers.
+    '''
+    _require_aiohttp()
+    if limit is None:
+        limit = get_http_pool_maxsize()
+    if keep_alive is None:
+        keep_alive = get_http_keep_alive()
+    connector = aiohttp.TCPConnector(limit=limit, force_close=not keep_alive)
+    return aiohttp.ClientSession(connector=connector, headers={'User-Agent': get_user_agent()})
+
+
+def _require_aiohttp():
+    if aiohttp is None:
+        raise ImportError('The asyncio ARM client requires aiohttp (pip install aiohttp)')
+
+
+def get_session():
+    '''Return the aiohttp session of the running loop, creating it on first use.
+
+    Sessions of loops that have been closed since are closed and dropped.
+    '''
+    global _unbound_session
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None and _unbound_session is not None:
+        session, _unbound_session = _unbound_session, None
+        _sessions[loop] = session
+    if session is None or session.closed:
+        for other_loop in [other_loop for other_loop in _sessions if other_loop.is_closed()]:
+            _close_replaced(_sessions.pop(other_loop), other_loop, loop)
+        session = _sessions[loop] = create_session()
+    return session
+
+
+def _close_replaced(session, session_loop, loop):
+    '''Close a session that is replaced, without waiting for it.'''
+    if session.closed:
+        return
+    if session_loop is not loop and session_loop.is_running():
+        asyncio.run_coroutine_threadsafe(session.close(), session_loop)
+        return
+    # the connections of a closed loop are gone with it, close() only releases the session
+    task = loop.create_task(session.close())
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+
+def set_session(session):
+    '''Replace the aiohttp session of the running loop, e.g. with a pre-configured or fake session in tests.
+
+    Called outside of a loop, the session is used by the next loop that asks for one.
+
+    Args:
+        session: An aiohttp.ClientSession compatible object, or None to recreate the default on next use.
+
+    Returns:
+        The previous session (may be None).
+    '''
+    global _unbound_session
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        previous, _unbound_session = _unbound_session, session
+        return previous
+    previous = _sessions.pop(loop, None)
+    if session is not None:
+        _sessions[loop] = session
+    return previous
+
+
+async def close_session():
+    '''Close the aiohttp session of the running loop. Call before the event loop shuts down.
+    '''
+    previous = set_session(None)
+    if previous is not None and not previous.closed:
+        await previous.close()
+
+
+async def _bearer_token(access_token, loop):
+    # a token provider acquires a new token with a blocking call: run that off the event loop
+    if not hasattr(access_token, 'get_token'):
+        return access_token
+    bearer_token = access_token.cached_token() if hasattr(access_token, 'cached_token') else None
+    if bearer_token is None:
+        bearer_token = await loop.run_in_executor(None, access_token.get_token)
+    return bearer_token
+
+
+async def _request(method, endpoint, access_token, body=None):
+    '''Send a request on the shared session and read the whole body.
+
+    Uses the same RetryPolicy, RateGovernor and response cache as the synchronous helpers in
+    restfns, and like them refreshes a token provider once on 401 and records the call in restmetrics.
+    Acquiring a token and the response cache file I/O block, so they run in the loop's default executor.
+    '''
+    _require_aiohttp()
+    loop = asyncio.get_running_loop()
+    bearer_token = await _bearer_token(access_token, loop)
+    headers = {"Authorization": 'Bearer ' + bearer_token}
+    if body is not None:
+        headers["content-type"] = "application/json"
+    cache = get_response_cache() if method == 'GET' and cacheable(endpoint) else None
+    cached = await loop.run_in_executor(None, cache.lookup, endpoint) if cache is not None else None
+    if cached is not None:
+        headers.update(cache.conditional_headers(cached))
+    policy = get_retry_policy()
+    governor = get_rate_governor()
+    attempt = 0
+    replayed = False
+    call = {'method': method, 'template': endpoint_template(endpoint), 'status': None, 'bytes': 0,
+            'retries': 0, 'throttled': 0, 'wait_seconds': 0.0}
+    started = time.perf_counter()
+    try:
+        while True:
+            delay = governor.reserve(method)
+            if delay > 0:
+                call['wait_seconds'] += delay
+                await asyncio.sleep(delay)
+            try:
+                async with get_session().request(method, endpoint, data=body, headers=headers) as response:
+                    content = await response.read()
+                    result = Response(response.status, response.headers, content)
+            except aiohttp.ClientConnectionError:
+                if not policy.should_retry(method, None, attempt):
+                    raise
+                delay = policy.get_delay(attempt)
+                call['wait_seconds'] += delay
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            governor.update(result.headers)
+            if result.status_code == 401 and not replayed and hasattr(access_token, 'refresh'):
+                bearer_token = await loop.run_in_executor(None, access_token.refresh, bearer_token)
+                headers["Authorization"] = 'Bearer ' + bearer_token
+                replayed = True
+                continue
+            if result.status_code == 429:
+                call['throttled'] += 1
+            if not policy.should_retry(method, result.status_code, attempt):
+                call['status'] = result.status_code
+                call['bytes'] = len(result.content)
+                call['remaining_reads'] = result.headers.get(REMAINING_READS_HEADER)
+                call['remaining_writes'] = result.headers.get(REMAINING_WRITES_HEADER)
+                if cache is not None:
+                    if result.status_code == 304 and cached is not None:
+                        await loop.run_in_executor(None, cache.touch, endpoint)
+                        return Response(200, result.headers, cached['body'])
+                    if result.status_code == 200:
+                        await loop.run_in_executor(None, cache.store, endpoint, result.headers, result.content)
+                return result
+            delay = policy.get_delay(attempt, result.headers)
+            if result.status_code == 429:
+                governor.pause(delay)
+            else:
+                call['wait_seconds'] += delay
+                await asyncio.sleep(delay)
+            attempt += 1
+    except BaseException as error:
+        # includes the CancelledError of a timeout
+        call['error'] = type(error).__name__
+        raise
+    finally:
+        call['retries'] = attempt
+        call['seconds'] = time.perf_counter() - started
+        record_call(call)
+
+
+async def _with_timeout(coro, timeout):
+    if timeout is None:
+        return await coro
+    return await asyncio.wait_for(coro, timeout)
+
+
+async def do_get(endpoint, access_token, timeout=None):
+    '''Do an HTTP GET request and return JSON.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        access_token (str): A valid Azure authentication token.
+        timeout (float): Seconds before the call is cancelled with asyncio.TimeoutError (optional).
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    response = await _with_timeout(_request('GET', endpoint, access_token), timeout)
+    return response.json()
+
+
+async def do_get_next(endpoint, access_token, timeout=None):
+    '''Do an HTTP GET request, follow the nextLink chain and return JSON.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        access_token (str): A valid Azure authentication token.
+        timeout (float): Seconds for the whole nextLink chain (optional).
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    async def follow(endpoint):
+        value_list = []
+        while True:
+            get_return = (await _request('GET', endpoint, access_token)).json()
+            if not 'value' in get_return:
+                return get_return
+            value_list += get_return['value']
+            if not 'nextLink' in get_return:
+                return {'value': value_list}
+            endpoint = get_return['nextLink']
+
+    return await _with_timeout(follow(endpoint), timeout)
+
+
+async def do_delete(endpoint, access_token, timeout=None):
+    '''Do an HTTP DELETE request.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        access_token (str): A valid Azure authentication token.
+        timeout (float): Seconds before the call is cancelled (optional).
+
+    Returns:
+        HTTP response.
+    '''
+    return await _with_timeout(_request('DELETE', endpoint, access_token), timeout)
+
+
+async def do_patch(endpoint, body, access_token, timeout=None):
+    '''Do an HTTP PATCH request.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        body (str): JSON body of information to patch.
+        access_token (str): A valid Azure authentication token.
+        timeout (float): Seconds before the call is cancelled (optional).
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    return await _with_timeout(_request('PATCH', endpoint, access_token, body), timeout)
+
+
+async def do_post(endpoint, body, access_token, timeout=None):
+    '''Do an HTTP POST request.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        body (str): JSON body of information to post.
+        access_token (str): A valid Azure authentication token.
+        timeout (float): Seconds before the call is cancelled (optional).
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    return await _with_timeout(_request('POST', endpoint, access_token, body), timeout)
+
+
+async def do_put(endpoint, body, access_token, timeout=None):
+    '''Do an HTTP PUT request.
+
+    Args:
+        endpoint (str): Azure Resource Manager management endpoint.
+        body (str): JSON body of information to put.
+        access_token (str): A valid Azure authentication token.
+        timeout (float): Seconds before the call is cancelled (optional).
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    return await _with_timeout(_request('PUT', endpoint, access_token, body), timeout)
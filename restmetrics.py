@@ -0,0 +1,203 @@
+'''restmetrics - per-call instrumentation of the REST layer
+
+Every call made through restfns.send_request (and the asyncio client) produces one record:
+
+    method, template     HTTP method and endpoint template, ids replaced by {} (see endpoint_template)
+    status               HTTP status of the last attempt (None if the call raised)
+    seconds              wall time of the call, including retries and waits
+    wait_seconds         part of it spent waiting on the rate governor, Retry-After and backoff
+    bytes                size of the response body
+    retries, throttled   number of retries, and how many attempts were answered 429
+    remaining_reads, remaining_writes
+                         x-ms-ratelimit-remaining-subscription-* headers of the last response
+    error                exception class name if the call raised
+
+Token acquisitions are recorded as method AUTH. Records are aggregated into counters and
+latency histograms (get_metrics) that can be exported as Prometheus text or JSON, and passed to
+tracers attached with add_tracer.
+'''
+import json
+import logging
+import threading
+from urllib.parse import urlparse
+
+logger = logging.getLogger('example')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_tracers = []
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def endpoint_template(endpoint):
+    '''Endpoint without host, query and resource names, e.g.
+    /subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/hostGroups/{}/hosts/{}
+    '''
+    segments = [segment for segment in urlparse(endpoint).path.split('/') if segment]
+    template = []
+    position = 0
+    while position < len(segments):
+        segment = segments[position]
+        template.append(segment)
+        if segment.lower() == 'providers' and position + 1 < len(segments):
+            # the resource provider namespace is part of the template
+            template.append(segments[position + 1])
+            position += 2
+        elif position + 1 < len(segments):
+            template.append('{}')
+            position += 2
+        else:
+            position += 1
+    return '/' + '/'.join(template)
+
+
+class Histogram:
+    '''Cumulative latency histogram with fixed bucket bounds.'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''[(upper bound, calls at or below it)], the last bound being +Inf.'''
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    '''Counters and latency histograms of the REST calls, keyed by (method, endpoint template).'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.statuses = {}
+            self.latency = {}
+            self.remaining = {}
+
+    def record(self, call):
+        key = (call['method'], call['template'])
+        status = 'error' if call.get('status') is None else str(call['status'])
+        with self.lock:
+            totals = self.calls.get(key)
+            if totals is None:
+                totals = self.calls[key] = {'calls': 0, 'retries': 0, 'throttled': 0, 'bytes': 0,
+                                            'wait_seconds': 0.0}
+                self.latency[key] = Histogram()
+            totals['calls'] += 1
+            totals['retries'] += call.get('retries', 0)
+            totals['throttled'] += call.get('throttled', 0)
+            totals['bytes'] += call.get('bytes', 0)
+            totals['wait_seconds'] += call.get('wait_seconds', 0.0)
+            self.latency[key].observe(call['seconds'])
+            self.statuses[key + (status,)] = self.statuses.get(key + (status,), 0) + 1
+            for name in ('remaining_reads', 'remaining_writes'):
+                if call.get(name) is not None:
+                    self.remaining[name] = call[name]
+
+    def to_json(self):
+        '''Dictionary of the metrics, per method and endpoint template.'''
+        with self.lock:
+            endpoints = []
+            for (method, template), totals in sorted(self.calls.items()):
+                histogram = self.latency[(method, template)]
+                endpoints.append(dict(totals, method=method, template=template,
+                                      seconds=histogram.sum,
+                                      statuses={status: count for (status_method, status_template, status), count
+                                                in self.statuses.items()
+                                                if status_method == method and status_template == template},
+                                      latency_buckets=[[bound if bound != float('inf') else '+Inf', count]
+                                                       for bound, count in histogram.cumulative()]))
+            return {'endpoints': endpoints, 'ratelimit_remaining': dict(self.remaining)}
+
+    def to_prometheus(self):
+        '''The metrics in the Prometheus text exposition format.'''
+        def labels(method, template, **extra):
+            pairs = [('method', method), ('endpoint', template)] + sorted(extra.items())
+            return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, value in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            lines.append('# TYPE adh_arm_requests_total counter')
+            for (method, template, status), count in sorted(self.statuses.items()):
+                lines.append('adh_arm_requests_total{} {}'.format(labels(method, template, status=status), count))
+            for name, field in (('retries', 'retries'), ('throttled', 'throttled'),
+                                ('response_bytes', 'bytes'), ('wait_seconds', 'wait_seconds')):
+                lines.append('# TYPE adh_arm_{}_total counter'.format(name))
+                for (method, template), totals in sorted(self.calls.items()):
+                    lines.append('adh_arm_{}_total{} {}'.format(name, labels(method, template), totals[field]))
+            lines.append('# TYPE adh_arm_request_seconds histogram')
+            for (method, template), histogram in sorted(self.latency.items()):
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('adh_arm_request_seconds_bucket{} {}'.format(labels(method, template, le=le), count))
+                lines.append('adh_arm_request_seconds_sum{} {}'.format(labels(method, template), histogram.sum))
+                lines.append('adh_arm_request_seconds_count{} {}'.format(labels(method, template), histogram.count))
+            lines.append('# TYPE adh_arm_ratelimit_remaining gauge')
+            for name, value in sorted(self.remaining.items()):
+                lines.append('adh_arm_ratelimit_remaining{{quota="{}"}} {}'.format(name[len('remaining_'):], value))
+        return '\n'.join(lines) + '\n'
+
+
+def get_metrics():
+    '''Return the process-wide Metrics.'''
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            # the first calls of a concurrent crawl arrive together: create it once
+            if _metrics is None:
+                _metrics = Metrics()
+    return _metrics
+
+
+def add_tracer(tracer):
+    '''Call tracer(record) after every REST call; see the module docstring for the record fields.
+
+    Tracers run on the thread that made the call and must not raise.
+    '''
+    _tracers.append(tracer)
+
+
+def remove_tracer(tracer):
+    _tracers.remove(tracer)
+
+
+def record_call(call):
+    '''Aggregate a call record and pass it to the tracers.'''
+    get_metrics().record(call)
+    for tracer in list(_tracers):
+        try:
+            tracer(call)
+        except Exception:
+            logger.exception ("restmetrics: tracer failed")
+
+
+def write_metrics(filename):
+    '''Write the metrics to a file: Prometheus text if it ends in .prom, else JSON.'''
+    metrics = get_metrics()
+    with open(filename, 'w') as metrics_file:
+        if filename.endswith('.prom'):
+            metrics_file.write(metrics.to_prometheus())
+        else:
+            json.dump(metrics.to_json(), metrics_file, indent=2)
@@ -15,6 +15,64 @@ BASE_API = '2016-06-01'
 COMP_API = '2018-10-01'
 DEPLOYMENTS_API = '2018-05-01'
 RESOURCE_API = '2017-05-10'
+RESOURCE_GRAPH_API = '2021-03-01'
+
+# HTTP connection pool defaults for the shared ARM session
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 32
+HTTP_KEEP_ALIVE = True
+
+# ARM retry policy and client-side rate governor defaults
+ARM_MAX_RETRIES = 5
+ARM_BACKOFF_BASE = 1.0
+ARM_BACKOFF_MAX = 60.0
+ARM_READ_RATE = 50.0
+ARM_READ_BURST = 100
+ARM_READ_LOW_WATER = 1000
+ARM_WRITE_RATE = 10.0
+ARM_WRITE_BURST = 20
+ARM_WRITE_LOW_WATER = 200
+
+# number of parallel requests used by analyze when crawling host groups and hosts
+CRAWL_WORKERS = 8
+
+# number of subscriptions analyze crawls at the same time, each in a worker process of its own
+CRAWL_PROCESSES = 4
+
+# number of hosts created in parallel by create-host, and long running operation polling (seconds)
+HOST_CREATE_WORKERS = 20
+LRO_POLL_MIN = 1.0
+LRO_POLL_MAX = 15.0
+LRO_TIMEOUT = 1800.0
+
+# delta sync: changes older than the window are not in the change feed, so a cache synced
+# longer ago than that is refreshed instead; each query reaches back the overlap (seconds)
+# further, as change records show up in the feed a few minutes after the change
+DELTA_SYNC_WINDOW = 7 * 24 * 3600
+DELTA_SYNC_OVERLAP = 300
+
+# adh_mng.py serve: default TCP port on 127.0.0.1 and seconds between scheduled cache refreshes
+SERVE_PORT = 8750
+SERVE_REFRESH_INTERVAL = 300
+
+# seconds a reserved slot is held before it returns to the host unless the reservation is confirmed
+RESERVATION_TTL = 600
+
+# seconds adh_server holds a slot it recommended without a reservation, replayed on every refresh
+# until the VM can show up in the host's instance view
+PLACEMENT_HOLD = 900
+
+# access token cache: refresh in the background this many seconds before expiry, and in the
+# foreground once less than TOKEN_MIN_VALIDITY seconds are left
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_MIN_VALIDITY = 60
+TOKEN_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.adh_mng_tokens.json')
+
+# on-disk cache of GET responses with an ETag or Last-Modified, revalidated with conditional
+# requests: directory, size above which least recently used entries are evicted, and max age (seconds)
+RESPONSE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.adh_mng_http_cache')
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_MAX_AGE = 24 * 3600
 
 # AMS Headers
 json_only_acceptformat = "application/json"
@@ -60,3 +118,119 @@ def get_resource_endpoint():
     else:
         return resource_endpoint
 
+
+
+def get_http_pool_connections():
+    '''Number of per-host connection pools kept by the shared session.
+
+    Set by the ADH_HTTP_POOL_CONNECTIONS environment variable, else return default value.
+    '''
+    return int(os.environ.get('ADH_HTTP_POOL_CONNECTIONS', HTTP_POOL_CONNECTIONS))
+
+
+def get_http_pool_maxsize():
+    '''Max number of open connections kept per host by the shared session.
+
+    Set by the ADH_HTTP_POOL_MAXSIZE environment variable, else return default value.
+    Should be at least as large as the number of concurrent crawl workers.
+    '''
+    return int(os.environ.get('ADH_HTTP_POOL_MAXSIZE', HTTP_POOL_MAXSIZE))
+
+
+def get_http_keep_alive():
+    '''Whether connections are reused between ARM calls.
+
+    Set by the ADH_HTTP_KEEP_ALIVE environment variable (0/false disables), else return default value.
+    '''
+    keep_alive = os.environ.get('ADH_HTTP_KEEP_ALIVE')
+    if keep_alive is None:
+        return HTTP_KEEP_ALIVE
+    return keep_alive.lower() not in ('0', 'false', 'no')
+
+
+def get_crawl_workers():
+    '''Default fan-out for the analyze crawl.
+
+    Set by the ADH_CRAWL_WORKERS environment variable, else return default value.
+    '''
+    return int(os.environ.get('ADH_CRAWL_WORKERS', CRAWL_WORKERS))
+
+
+def get_crawl_processes():
+    '''Number of subscriptions crawled at the same time, see adh_shards.
+
+    Set by the ADH_CRAWL_PROCESSES environment variable, else return default value.
+    '''
+    return int(os.environ.get('ADH_CRAWL_PROCESSES', CRAWL_PROCESSES))
+
+
+def get_host_create_workers():
+    '''Number of hosts create-host provisions in parallel.
+
+    Set by the ADH_HOST_CREATE_WORKERS environment variable, else return default value.
+    '''
+    return int(os.environ.get('ADH_HOST_CREATE_WORKERS', HOST_CREATE_WORKERS))
+
+
+def get_placement_hold():
+    '''Seconds adh_server holds a slot recommended without a reservation.
+
+    Set by the ADH_PLACEMENT_HOLD environment variable, else return default value.
+    '''
+    return float(os.environ.get('ADH_PLACEMENT_HOLD', PLACEMENT_HOLD))
+
+
+def get_delta_sync_window():
+    '''Max age in seconds of a cache that is delta synced rather than refreshed.
+
+    Set by the ADH_DELTA_SYNC_WINDOW environment variable, else return default value.
+    '''
+    return float(os.environ.get('ADH_DELTA_SYNC_WINDOW', DELTA_SYNC_WINDOW))
+
+
+def get_delta_sync_overlap():
+    '''Seconds before the last sync from which a delta sync reads the change feed.
+
+    Set by the ADH_DELTA_SYNC_OVERLAP environment variable, else return default value.
+    '''
+    return float(os.environ.get('ADH_DELTA_SYNC_OVERLAP', DELTA_SYNC_OVERLAP))
+
+
+def get_token_cache_file():
+    '''Path of the access token cache file.
+
+    Set by the ADH_TOKEN_CACHE environment variable (empty disables the file cache), else return default value.
+    '''
+    return os.environ.get('ADH_TOKEN_CACHE', TOKEN_CACHE_FILE)
+
+
+def get_response_cache_dir():
+    '''Directory of the GET response cache.
+
+    Set by the ADH_RESPONSE_CACHE environment variable (empty disables the cache), else return default value.
+    '''
+    return os.environ.get('ADH_RESPONSE_CACHE', RESPONSE_CACHE_DIR)
+
+
+def get_response_cache_max_bytes():
+    '''Size in bytes of the GET response cache above which entries are evicted.
+
+    Set by the ADH_RESPONSE_CACHE_MAX_BYTES environment variable, else return default value.
+    '''
+    return int(os.environ.get('ADH_RESPONSE_CACHE_MAX_BYTES', RESPONSE_CACHE_MAX_BYTES))
+
+
+def get_response_cache_max_age():
+    '''Seconds a cached GET response is revalidated and served for.
+
+    Set by the ADH_RESPONSE_CACHE_MAX_AGE environment variable, else return default value.
+    '''
+    return float(os.environ.get('ADH_RESPONSE_CACHE_MAX_AGE', RESPONSE_CACHE_MAX_AGE))
+
+
+def get_arm_max_retries():
+    '''Number of retries for throttled or failed ARM calls.
+
+    Set by the ADH_ARM_MAX_RETRIES environment variable, else return default value.
+    '''
+    return int(os.environ.get('ADH_ARM_MAX_RETRIES', ARM_MAX_RETRIES))
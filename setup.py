@@ -21,4 +21,9 @@ setup(name='adh-mng',
           'adal',
           'requests',
       ],
+      extras_require={
+          'async': ['aiohttp'],
+          'capacity': ['numpy'],
+          'test': ['pytest'],
+      },
       zip_safe=False)
@@ -0,0 +1,55 @@
+'''Fixtures of the test suite: a mock ARM server (adh_mockarm) on a local port.'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# no token or response cache files in the user's home directory
+os.environ['ADH_TOKEN_CACHE'] = ''
+os.environ['ADH_RESPONSE_CACHE'] = ''
+
+from adh_mockarm import start_mock_arm  # noqa: E402
+from restcache import set_response_cache  # noqa: E402
+from restfns import RateGovernor, set_rate_governor  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fast_client():
+    '''No client-side throttling and no response cache: the mock answers at once.'''
+    set_rate_governor(RateGovernor(read_rate=10000.0, read_burst=10000))
+    set_response_cache(None)
+    yield
+    set_rate_governor(None)
+    set_response_cache(None)
+
+
+@pytest.fixture
+def mock_arm(monkeypatch):
+    '''Start a mock ARM server for an estate and point the client at it.
+
+    Returns:
+        A function taking the MockEstate (or a list of them) and the MockARMServer options,
+        returning the running server.
+    '''
+    servers = []
+
+    def start(estate, **options):
+        server = start_mock_arm(estate, **options)
+        servers.append(server)
+        monkeypatch.setenv('AZURE_RM_ENDPOINT', server.endpoint)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def host_state(local_cache):
+    '''Everything recommend depends on, per host: SKU, allocatable counts, VMs and utilization.'''
+    return {host.id.upper(): (host.sku, dict(host.allocatableVMs.items()),
+                              sorted((vm_id, vm.size) for vm_id, vm in host.vm_list.items()),
+                              host.utilized_cores, host.utilized_mem)
+            for dhg in local_cache.host_group_list.values() for host in dhg.host_list.values()}
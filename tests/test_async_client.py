@@ -0,0 +1,41 @@
+'''The asyncio ARM client (restfns_async) against the mock ARM server.'''
+import asyncio
+import time
+
+import pytest
+
+import adh_crp
+import restfns_async
+from adh_mockarm import MOCK_SUBSCRIPTION, MockEstate
+from adh_token import TokenProvider
+
+pytest.importorskip('aiohttp')
+
+
+def test_token_is_acquired_off_the_event_loop(mock_arm):
+    mock_arm(MockEstate(10))
+    endpoint = adh_crp.get_dh_endpoint(MOCK_SUBSCRIPTION, 'adh-rg0', 'adh-hg0', 'adh-h0-1')
+
+    def acquire():
+        time.sleep(0.3)
+        return 'token', time.time() + 3600
+
+    provider = TokenProvider(acquire, 'test')
+    ticks = []
+
+    async def tick():
+        while len(ticks) < 10:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.02)
+
+    async def main():
+        try:
+            host, ticked = await asyncio.gather(restfns_async.do_get(endpoint, provider, timeout=10), tick())
+        finally:
+            await restfns_async.close_session()
+        return host
+
+    assert asyncio.run(main())['name'] == 'adh-h0-1'
+    assert provider.cached_token() == 'token'
+    # the loop kept running while the token was acquired
+    assert max(later - earlier for earlier, later in zip(ticks, ticks[1:])) < 0.2
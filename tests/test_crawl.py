@@ -0,0 +1,108 @@
+'''analyze (DedicateHostCache.build_cache) and the snapshot file against the mock ARM server.'''
+import os
+import threading
+import time
+
+from adh_cache import DedicateHostCache
+from adh_mockarm import MOCK_SUBSCRIPTION, MockEstate
+from adh_reservation import FileLock
+from adh_store import load_snapshot, save_snapshot
+from restfns import RestError
+
+from conftest import host_state
+
+
+def crawl(max_workers):
+    local_cache = DedicateHostCache()
+    returnObj = local_cache.build_cache('token', MOCK_SUBSCRIPTION, None, None, None, max_workers)
+    assert returnObj.code == 0
+    return local_cache
+
+
+def test_concurrent_crawl_equals_serial(mock_arm):
+    estate = MockEstate(120, hosts_per_group=10)
+    mock_arm(estate, page_size=7)
+    serial = crawl(None)
+    concurrent = crawl(8)
+    assert list(serial.host_group_list) == list(concurrent.host_group_list)
+    assert host_state(serial) == host_state(concurrent)
+    assert len(host_state(serial)) == estate.host_count()
+
+
+def test_crawl_survives_throttling(mock_arm):
+    mock_arm(MockEstate(40, hosts_per_group=10), throttle=0.2, retry_after=0)
+    throttled = crawl(4)
+    assert len(host_state(throttled)) == 40
+
+
+def test_failed_crawl_stops_the_vm_listing(mock_arm, monkeypatch):
+    server = mock_arm(MockEstate(200, hosts_per_group=10), page_size=5, latency=0.02)
+
+    def fail(*args):
+        time.sleep(0.1)
+        raise RestError('hosts', {'error': {'code': 'InternalServerError'}})
+
+    monkeypatch.setattr(DedicateHostCache, 'populate_host_groups', fail)
+    started = time.perf_counter()
+    returnObj = DedicateHostCache().build_cache('token', MOCK_SUBSCRIPTION, None, None, None, 4)
+    assert returnObj.code == -1
+    assert time.perf_counter() - started < 1.0
+    time.sleep(0.1)
+    requests = server.counters['requests']
+    time.sleep(0.2)
+    assert server.counters['requests'] == requests
+
+
+def test_snapshot_round_trip(mock_arm, tmp_path):
+    mock_arm(MockEstate(60, hosts_per_group=5))
+    local_cache = crawl(4)
+    filename = str(tmp_path / 'adhcache.txt')
+    save_snapshot(local_cache, filename)
+    loaded = load_snapshot(filename)
+    assert host_state(loaded) == host_state(local_cache)
+    assert loaded.synced == local_cache.synced
+    for dhg_id, dhg in local_cache.host_group_list.items():
+        copy = loaded.host_group_list[dhg_id]
+        assert (copy.name, copy.resource_group, copy.location, copy.az, copy.subscription_id) == \
+            (dhg.name, dhg.resource_group, dhg.location, dhg.az, dhg.subscription_id)
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
+
+
+def test_concurrent_snapshot_saves(mock_arm, tmp_path):
+    mock_arm(MockEstate(60, hosts_per_group=5))
+    local_cache = crawl(4)
+    filename = str(tmp_path / 'adhcache.txt')
+
+    def save():
+        for attempt in range(5):
+            save_snapshot(local_cache, filename)
+
+    threads = [threading.Thread(target=save) for count in range(4)]
+    for thread in threads:
+        thread.start()
+    # a caller holding the cache lock can still save
+    with FileLock(filename + '.lock'):
+        save_snapshot(local_cache, filename)
+    for thread in threads:
+        thread.join()
+    assert host_state(load_snapshot(filename)) == host_state(local_cache)
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
+
+
+def test_snapshot_loads_one_location_and_zone(mock_arm, tmp_path):
+    mock_arm(MockEstate(60, hosts_per_group=5))
+    local_cache = crawl(4)
+    filename = str(tmp_path / 'adhcache.txt')
+    save_snapshot(local_cache, filename)
+
+    eastus = load_snapshot(filename, locations=['EastUS'])
+    assert set(dhg.location for dhg in eastus.host_group_list.values()) == {'eastus'}
+    assert host_state(eastus) == {host_id: state for host_id, state in host_state(local_cache).items()
+                                  if host_id in host_state(eastus)}
+    zonal = load_snapshot(filename, locations=['eastus'], zones=['1'])
+    assert set(dhg.az for dhg in zonal.host_group_list.values()) == {'1'}
+    assert load_snapshot(filename, locations=['nowhere']).host_group_list == {}
+    for vm_size in ('Standard_D2s_v3', 'Standard_E8s_v3'):
+        expected = local_cache.find_host('eastus', '1', None, vm_size)
+        found = zonal.find_host('eastus', '1', None, vm_size)
+        assert (found[1].id if found else None) == (expected[1].id if expected else None)
@@ -0,0 +1,170 @@
+'''Reservations of recommended slots (adh_reservation), in the CLI and the placement service.'''
+import json
+import threading
+import time
+
+import adh_mng
+from adh_cache import DedicateHostCache
+from adh_mockarm import MOCK_SUBSCRIPTION, MockEstate
+from adh_reservation import ReservationBook
+from adh_server import PlacementService
+
+VM_SIZE = 'Standard_D8s_v3'
+
+
+def crawl():
+    local_cache = DedicateHostCache()
+    assert local_cache.build_cache('token', MOCK_SUBSCRIPTION, None, None, None, 4).code == 0
+    return local_cache
+
+
+def capacity(local_cache, vm_size=VM_SIZE):
+    return sum(host.allocatableVMs.get(vm_size, 0)
+               for dhg in local_cache.host_group_list.values() if dhg.location == 'eastus'
+               for host in dhg.host_list.values())
+
+
+def test_reserve_release_and_expire(mock_arm):
+    mock_arm(MockEstate(16, hosts_per_group=8))
+    local_cache = crawl()
+    book = ReservationBook()
+    before = capacity(local_cache)
+    first = book.reserve(local_cache, 'eastus', None, None, VM_SIZE, ttl=60)[0]
+    book.reserve(local_cache, 'eastus', None, None, VM_SIZE, ttl=-1)
+    assert capacity(local_cache) == before - 2
+    assert len(book.expire(local_cache)) == 1
+    assert book.release(local_cache, first.id) is first
+    assert capacity(local_cache) == before
+    assert book.release(local_cache, first.id) is None
+
+
+def test_confirmed_reservation_is_kept_until_the_cache_counts_it(mock_arm, monkeypatch):
+    estate = MockEstate(16, hosts_per_group=8)
+    mock_arm(estate)
+    monkeypatch.setenv('ADH_DELTA_SYNC_OVERLAP', '300')
+    local_cache = crawl()
+    book = ReservationBook()
+    by_time = book.reserve(local_cache, 'eastus', None, None, VM_SIZE)[0]
+    by_vm, host_group, host = book.reserve(local_cache, 'eastus', None, None, VM_SIZE)
+    book.confirm(by_time.id)
+    vm = estate.add_vm(host.id, VM_SIZE)
+    book.confirm(by_vm.id, vm['id'])
+
+    # a crawl right after the confirmation may not see the VM yet (change feed lag)
+    refreshed = crawl()
+    before = capacity(refreshed)
+    book.apply(refreshed)
+    assert set(book.reservations) == {by_time.id}
+    assert capacity(refreshed) == before - 1
+
+    later = crawl()
+    later.synced[MOCK_SUBSCRIPTION] = by_time.confirmed + 301
+    book.apply(later)
+    assert book.reservations == {}
+
+
+def test_concurrent_cli_recommends_get_different_slots(mock_arm, tmp_path, monkeypatch):
+    mock_arm(MockEstate(16, hosts_per_group=8))
+    monkeypatch.chdir(tmp_path)
+    local_cache = crawl()
+    adh_mng.save_cache(local_cache)
+    slots = {host.id: host.allocatableVMs.get(VM_SIZE, 0)
+             for dhg in local_cache.host_group_list.values() if dhg.location == 'eastus'
+             for host in dhg.host_list.values()}
+    results = []
+
+    def recommend():
+        for attempt in range(10):
+            returnObj = adh_mng.recommend_vm_placement('token', MOCK_SUBSCRIPTION, 'eastus', None, None, VM_SIZE,
+                                                       None, None, None, True, 60)
+            if returnObj.code == 0:
+                results.append(json.loads(returnObj.body)['host'])
+
+    threads = [threading.Thread(target=recommend) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == min(40, sum(slots.values()))
+    for host_id in set(results):
+        assert results.count(host_id) <= slots[host_id]
+
+
+def test_service_keeps_reservations_across_refresh(mock_arm):
+    mock_arm(MockEstate(16, hosts_per_group=8))
+    service = PlacementService('token', MOCK_SUBSCRIPTION, max_workers=4)
+    assert service.start().code == 0
+    before = capacity(service.cache)
+    held = service.recommend('eastus', None, None, VM_SIZE, reserve=True, ttl=60).body
+    service.recommend('eastus', None, None, VM_SIZE, reserve=True, ttl=0.05)
+    time.sleep(0.1)
+    # expired reservations are given back on the next request
+    service.health()
+    assert service.refresh().code == 0
+    assert capacity(service.cache) == before - 1
+    assert service.release(held['reservation']).code == 0
+    assert capacity(service.cache) == before
+
+
+def test_service_holds_unreserved_slots_across_refresh(mock_arm):
+    estate = MockEstate(16, hosts_per_group=8)
+    mock_arm(estate)
+    service = PlacementService('token', MOCK_SUBSCRIPTION, max_workers=4)
+    assert service.start().code == 0
+    held = service.recommend('eastus', None, None, VM_SIZE).body['host']
+    # another VM lands on the host, so the refresh re-reads it before the recommended VM is deployed
+    estate.add_vm(held, 'Standard_D2s_v3')
+    assert service.refresh().code == 0
+    assert capacity(service.cache) == capacity(crawl()) - 1
+
+    service.recommend('eastus', None, None, VM_SIZE)
+    for hold in service.holds.reservations.values():
+        hold.expires = 0
+    # the hold on the re-read host is given back; the other host was not re-read and keeps its slot
+    assert service.health().body['holds'] == 0
+    assert capacity(service.cache) == capacity(crawl()) - 1
+
+
+def test_service_creates_one_host_for_concurrent_callers(mock_arm):
+    estate = MockEstate(1, hosts_per_group=1)
+    mock_arm(estate, create_delay=0.2)
+    service = PlacementService('token', MOCK_SUBSCRIPTION)
+    assert service.start().code == 0
+    dhg = next(iter(service.cache.host_group_list.values()))
+    host = next(iter(dhg.host_list.values()))
+    while host.allocatableVMs.get(VM_SIZE, 0) > 0:
+        assert service.recommend(dhg.location, None, None, VM_SIZE, dhg.resource_group, dhg.name).code == 0
+    results = []
+
+    def recommend(reserve):
+        results.append(service.recommend(dhg.location, None, None, VM_SIZE, dhg.resource_group, dhg.name,
+                                         reserve=reserve, ttl=60))
+
+    threads = [threading.Thread(target=recommend, args=(thread == 0,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(returnObj.code == 0 for returnObj in results)
+    assert sum(1 for returnObj in results if returnObj.body['created']) == 1
+    assert sum(1 for returnObj in results if 'reservation' in returnObj.body) == 1
+    new_host_ids = set(returnObj.body['host'] for returnObj in results)
+    assert len(new_host_ids) == 1 and len(dhg.host_list) == 2
+    new_host = service.cache.get_placement_index().hosts[new_host_ids.pop()][1]
+    assert new_host.allocatableVMs[VM_SIZE] == 8 - 4
+
+
+def test_malformed_batches_are_rejected(mock_arm, tmp_path, monkeypatch):
+    mock_arm(MockEstate(16, hosts_per_group=8))
+    monkeypatch.chdir(tmp_path)
+    adh_mng.save_cache(crawl())
+    service = PlacementService('token', MOCK_SUBSCRIPTION, max_workers=4)
+    assert service.start().code == 0
+    before = capacity(service.cache)
+    for vm_requests in ({'size': VM_SIZE}, [VM_SIZE], [{'count': 1}], [{'size': VM_SIZE, 'count': '2'}],
+                        [{'size': VM_SIZE}, {'size': VM_SIZE, 'count': 0}]):
+        input_file = tmp_path / 'batch.json'
+        input_file.write_text(json.dumps(vm_requests))
+        assert adh_mng.recommend_batch_placement('eastus', None, None, str(input_file)).code == -1
+        assert service.recommend_batch(vm_requests, 'eastus').code == -1
+    assert capacity(service.cache) == before
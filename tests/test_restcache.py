@@ -0,0 +1,45 @@
+'''The response cache (restcache) with the synchronous and the asyncio client.'''
+import asyncio
+
+import pytest
+
+import adh_crp
+import restfns_async
+from adh_mockarm import MOCK_SUBSCRIPTION, MockEstate
+from restcache import ResponseCache, cacheable, set_response_cache
+from restfns import do_get
+
+
+def test_operation_status_urls_are_not_cached():
+    assert cacheable(adh_crp.get_dh_endpoint(MOCK_SUBSCRIPTION, 'adh-rg0', 'adh-hg0', 'adh-h0-1'))
+    assert not cacheable('https://management.azure.com/subscriptions/{}/providers/Microsoft.Compute/'
+                         'locations/eastus/operations/1234?api-version=2021-03-01'.format(MOCK_SUBSCRIPTION))
+    assert not cacheable('https://management.azure.com/subscriptions/{}/providers/Microsoft.Compute/'
+                         'locations/eastus/operationResults/1234'.format(MOCK_SUBSCRIPTION))
+    assert not cacheable('http://127.0.0.1:8800/mockarm/operations/1234')
+
+
+def test_get_is_revalidated(mock_arm, tmp_path):
+    server = mock_arm(MockEstate(10))
+    set_response_cache(ResponseCache(str(tmp_path)))
+    endpoint = adh_crp.get_dh_endpoint(MOCK_SUBSCRIPTION, 'adh-rg0', 'adh-hg0', 'adh-h0-1')
+    assert do_get(endpoint, 'token') == do_get(endpoint, 'token')
+    assert server.counters['not_modified'] == 1
+
+
+def test_async_get_is_revalidated(mock_arm, tmp_path):
+    pytest.importorskip('aiohttp')
+    server = mock_arm(MockEstate(10))
+    set_response_cache(ResponseCache(str(tmp_path)))
+    endpoint = adh_crp.get_dh_endpoint(MOCK_SUBSCRIPTION, 'adh-rg0', 'adh-hg0', 'adh-h0-1')
+
+    async def get_twice():
+        try:
+            return [await restfns_async.do_get(endpoint, 'token', timeout=10) for attempt in range(2)]
+        finally:
+            await restfns_async.close_session()
+
+    first, second = asyncio.run(get_twice())
+    assert first == second
+    assert 'instanceView' in first['properties']
+    assert server.counters['not_modified'] == 1
@@ -0,0 +1,56 @@
+'''Delta sync (DedicateHostCache.sync_cache) against the mock's Resource Graph change feed.'''
+from adh_cache import DedicateHostCache
+from adh_mockarm import MOCK_SUBSCRIPTION, MockEstate
+
+from conftest import host_state
+
+
+def crawl(**scope):
+    local_cache = DedicateHostCache()
+    returnObj = local_cache.build_cache('token', MOCK_SUBSCRIPTION, None, scope.get('resource_group'),
+                                        scope.get('host_group'), 4)
+    assert returnObj.code == 0
+    return local_cache
+
+
+def test_sync_equals_fresh_crawl(mock_arm):
+    estate = MockEstate(64, hosts_per_group=8)
+    mock_arm(estate, page_size=10)
+    local_cache = crawl()
+    assert MOCK_SUBSCRIPTION in local_cache.synced
+
+    estate.add_vm(estate.hosts['adh-hg1']['adh-h1-2']['id'], 'Standard_D8s_v3')
+    estate.delete_vm(estate.vms[3]['id'])
+    estate.delete_host(estate.hosts['adh-hg2']['adh-h2-0']['id'])
+    estate.add_host(estate.groups[4], 'adh-rg0', 'adh-new', 'ESv3-Type1', 1)
+
+    returnObj = local_cache.sync_cache('token', MOCK_SUBSCRIPTION, None, None, None, 4)
+    assert returnObj.code == 0
+    assert returnObj.body['mode'] == 'delta'
+    assert returnObj.body['new'] == 1
+    assert returnObj.body['deleted'] == 1
+    assert host_state(local_cache) == host_state(crawl())
+
+
+def test_sync_without_changes_is_one_request(mock_arm):
+    server = mock_arm(MockEstate(16, hosts_per_group=8))
+    local_cache = crawl()
+    server.reset_stats()
+    returnObj = local_cache.sync_cache('token', MOCK_SUBSCRIPTION, None, None, None, 4)
+    assert returnObj.body['mode'] == 'delta'
+    assert returnObj.body['changes'] == 0
+    assert server.counters['requests'] == 1
+
+
+def test_narrowed_analyze_is_not_a_sync_point(mock_arm):
+    estate = MockEstate(64, hosts_per_group=8)
+    mock_arm(estate)
+    local_cache = crawl(resource_group='adh-rg0')
+    assert MOCK_SUBSCRIPTION not in local_cache.synced
+
+    # the sync falls back to a refresh of the whole subscription
+    returnObj = local_cache.sync_cache('token', MOCK_SUBSCRIPTION, None, None, None, 4)
+    assert returnObj.code == 0
+    assert returnObj.body['mode'] == 'refresh'
+    assert len(local_cache.host_group_list) == len(estate.groups)
+    assert host_state(local_cache) == host_state(crawl())